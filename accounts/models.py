@@ -1,10 +1,6 @@
 # coding=utf-8
 from decimal import Decimal
-from django.utils.formats import localize
 import datetime
-from reportlab.platypus import Paragraph, Spacer
-from reportlab.lib.units import inch
-from reportlab.platypus import Table, TableStyle
 from django.db import models, connection
 from core.models import OwnedObject
 from django.utils.translation import ugettext_lazy as _, ugettext
@@ -16,7 +12,6 @@ from project.models import Row, Proposal, update_row_amount, \
 from django.db.models.aggregates import Sum, Min, Max
 from django.db.models.signals import post_save, pre_save, post_delete
 from django.core.validators import MaxValueValidator
-from accounts.utils.pdf import InvoiceTemplate
 
 PAYMENT_TYPE_CASH = 1
 PAYMENT_TYPE_BANK_CARD = 2
@@ -280,54 +275,8 @@ class Invoice(OwnedObject):
         return self.amount + self.get_vat()
 
     def to_pdf(self, user, response):
-        filename = ugettext('invoice_%(invoice_id)d.pdf') % {'invoice_id': self.invoice_id}
-        response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
-
-        invoice_template = InvoiceTemplate(response, user)
-
-        invoice_template.init_doc(ugettext('Invoice #%(invoice_id)d') % {'invoice_id': self.invoice_id})
-        invoice_template.add_headers(self, self.customer, self.edition_date)
-        invoice_template.add_title(_("INVOICE #%d") % (self.invoice_id))
-
-        # proposal row list
-        rows = self.invoice_rows.all()
-        invoice_template.add_rows(rows)
-
-        # total amount on the right side of footer
-        right_block = invoice_template.get_total_amount(self.amount, rows)
-
-        invoice_amount = self.amount
-        invoice_amount = invoice_amount.quantize(Decimal(1)) if invoice_amount == invoice_amount.to_integral() else invoice_amount.normalize()
-        left_block = [Paragraph(_("Payment date : %s") % (localize(self.payment_date)), InvoiceTemplate.styleN),
-                      Paragraph(_("Penalty begins on : %s") % (localize(self.penalty_date) or ''), InvoiceTemplate.styleN),
-                      Paragraph(_("Penalty rate : %s") % (localize(self.penalty_rate) or ''), InvoiceTemplate.styleN),
-                      Paragraph(_("Discount conditions : %s") % (self.discount_conditions or ''), InvoiceTemplate.styleN)]
-
-        if self.footer_note:
-            left_block.append(Spacer(invoice_template.doc.width, 0.1 * inch))
-            left_block.append(Paragraph(self.footer_note, InvoiceTemplate.styleNSmall))
-        else:
-            left_block.append(Spacer(invoice_template.doc.width, 0.2 * inch))
-        if self.owner.get_profile().iban_bban:
-            left_block.append(Paragraph(_("IBAN/BBAN : %s") % (self.owner.get_profile().iban_bban), InvoiceTemplate.styleNSmall))
-            if self.owner.get_profile().bic:
-                left_block.append(Paragraph(_("BIC/SWIFT : %s") % (self.owner.get_profile().bic), InvoiceTemplate.styleNSmall))
-
-        data = [[left_block,
-                '',
-                right_block], ]
-
-        if self.execution_begin_date and self.execution_end_date:
-            data[0][0].insert(1, Paragraph(_("Execution dates : %(begin_date)s to %(end_date)s") % {'begin_date': localize(self.execution_begin_date), 'end_date' : localize(self.execution_end_date)}, InvoiceTemplate.styleN))
-
-        footer_table = Table(data, [4.5 * inch, 0.3 * inch, 2.5 * inch], [1 * inch])
-        footer_table.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ]))
-
-        invoice_template.append_to_story(footer_table)
-
-        invoice_template.build()
-
-        return response
+        from accounts.utils.pdf import invoice_to_pdf
+        return invoice_to_pdf(self, user, response)
 
 class InvoiceRowAmountError(Exception):
     pass
@@ -1,6 +1,15 @@
+from decimal import Decimal
+from django.utils.formats import localize
+from django.utils.translation import ugettext_lazy as _, ugettext
 from project.utils.pdf import ProposalTemplate
+from reportlab.platypus import Paragraph, Frame, Spacer, BaseDocTemplate, PageTemplate
+from reportlab.platypus import Table, TableStyle
 from reportlab.lib.styles import ParagraphStyle
+from reportlab.rl_config import defaultPageSize
 from reportlab.lib.units import inch
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib import colors
+from custom_canvas import NumberedCanvas
 
 class InvoiceTemplate(ProposalTemplate):
 
@@ -13,3 +22,113 @@ class InvoiceTemplate(ProposalTemplate):
         if row.proposal and row.proposal.reference:
             label = u"%s - [%s]" % (label, row.proposal.reference)
         return label
+
+# columns of the purchase book: date, reference, supplier, nature, amount, payment type
+PURCHASE_BOOK_COL_WIDTHS = [0.8 * inch, 0.9 * inch, 1.6 * inch, 1.7 * inch, 0.7 * inch, 1.2 * inch]
+PURCHASE_BOOK_ALIGNMENTS = [('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+                            ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+                            ('ALIGN', (2, 1), (3, -1), 'LEFT'),
+                            ('ALIGN', (4, 1), (4, -1), 'RIGHT')]
+# columns of the invoice book: date, reference, customer, nature, amount, payment type
+INVOICE_BOOK_COL_WIDTHS = [0.8 * inch, 0.4 * inch, 2.5 * inch, 1.2 * inch, 0.8 * inch, 1.2 * inch]
+INVOICE_BOOK_ALIGNMENTS = [('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+                           ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+                           ('ALIGN', (2, 1), (2, -1), 'LEFT')]
+
+def book_to_pdf(response, user, title, data, col_widths, alignments):
+    """
+    Writes a yearly book (purchases or paid invoices) as a single table.
+    data holds the header line followed by one line per entry.
+    """
+    def book_footer(canvas, doc):
+        canvas.saveState()
+        canvas.setFont('Times-Roman', 10)
+        PAGE_WIDTH = defaultPageSize[0]
+        footer_text = "%s %s - SIRET : %s - %s, %s %s" % (user.first_name,
+                                                          user.last_name,
+                                                          user.get_profile().company_id,
+                                                          user.get_profile().address.street,
+                                                          user.get_profile().address.zipcode,
+                                                          user.get_profile().address.city)
+        if user.get_profile().address.country:
+            footer_text = footer_text + ", %s" % (user.get_profile().address.country)
+        canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.5 * inch, footer_text)
+        canvas.restoreState()
+
+    doc = BaseDocTemplate(response, title=title)
+    frameT = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
+    doc.addPageTemplates([PageTemplate(id='all', frames=frameT, onPage=book_footer), ])
+
+    styleH = ParagraphStyle({})
+    styleH.fontSize = 14
+    styleH.borderColor = colors.black
+    styleH.alignment = TA_CENTER
+
+    p = Paragraph(title, styleH)
+    spacer = Spacer(1 * inch, 0.5 * inch)
+
+    t = Table(data, col_widths, len(data) * [0.3 * inch])
+    t.setStyle(TableStyle(alignments + [('FONT', (0, 0), (-1, 0), 'Times-Bold'),
+                                        ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
+                                        ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
+                                        ]))
+
+    story = []
+    story.append(p)
+    story.append(spacer)
+    story.append(t)
+    doc.build(story, canvasmaker=NumberedCanvas)
+    return response
+
+def invoice_to_pdf(invoice, user, response):
+    """
+    Generate a PDF file for the invoice
+    """
+    filename = ugettext('invoice_%(invoice_id)d.pdf') % {'invoice_id': invoice.invoice_id}
+    response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
+
+    invoice_template = InvoiceTemplate(response, user)
+
+    invoice_template.init_doc(ugettext('Invoice #%(invoice_id)d') % {'invoice_id': invoice.invoice_id})
+    invoice_template.add_headers(invoice, invoice.customer, invoice.edition_date)
+    invoice_template.add_title(_("INVOICE #%d") % (invoice.invoice_id))
+
+    # proposal row list
+    rows = invoice.invoice_rows.all()
+    invoice_template.add_rows(rows)
+
+    # total amount on the right side of footer
+    right_block = invoice_template.get_total_amount(invoice.amount, rows)
+
+    invoice_amount = invoice.amount
+    invoice_amount = invoice_amount.quantize(Decimal(1)) if invoice_amount == invoice_amount.to_integral() else invoice_amount.normalize()
+    left_block = [Paragraph(_("Payment date : %s") % (localize(invoice.payment_date)), InvoiceTemplate.styleN),
+                  Paragraph(_("Penalty begins on : %s") % (localize(invoice.penalty_date) or ''), InvoiceTemplate.styleN),
+                  Paragraph(_("Penalty rate : %s") % (localize(invoice.penalty_rate) or ''), InvoiceTemplate.styleN),
+                  Paragraph(_("Discount conditions : %s") % (invoice.discount_conditions or ''), InvoiceTemplate.styleN)]
+
+    if invoice.footer_note:
+        left_block.append(Spacer(invoice_template.doc.width, 0.1 * inch))
+        left_block.append(Paragraph(invoice.footer_note, InvoiceTemplate.styleNSmall))
+    else:
+        left_block.append(Spacer(invoice_template.doc.width, 0.2 * inch))
+    if invoice.owner.get_profile().iban_bban:
+        left_block.append(Paragraph(_("IBAN/BBAN : %s") % (invoice.owner.get_profile().iban_bban), InvoiceTemplate.styleNSmall))
+        if invoice.owner.get_profile().bic:
+            left_block.append(Paragraph(_("BIC/SWIFT : %s") % (invoice.owner.get_profile().bic), InvoiceTemplate.styleNSmall))
+
+    data = [[left_block,
+            '',
+            right_block], ]
+
+    if invoice.execution_begin_date and invoice.execution_end_date:
+        data[0][0].insert(1, Paragraph(_("Execution dates : %(begin_date)s to %(end_date)s") % {'begin_date': localize(invoice.execution_begin_date), 'end_date' : localize(invoice.execution_end_date)}, InvoiceTemplate.styleN))
+
+    footer_table = Table(data, [4.5 * inch, 0.3 * inch, 2.5 * inch], [1 * inch])
+    footer_table.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ]))
+
+    invoice_template.append_to_story(footer_table)
+
+    invoice_template.build()
+
+    return response
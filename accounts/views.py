@@ -17,19 +17,11 @@ from project.models import Proposal, PROPOSAL_STATE_BALANCED, \
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from custom_canvas import NumberedCanvas
 from core.decorators import settings_required
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from autoentrepreneur.decorators import subscription_required
 from django.db.models.query_utils import Q
 import datetime
-from reportlab.platypus import Paragraph, Frame, Spacer, BaseDocTemplate, PageTemplate
-from reportlab.lib.styles import ParagraphStyle
-from reportlab.rl_config import defaultPageSize
-from reportlab.lib.units import inch
-from reportlab.lib.enums import TA_CENTER
-from reportlab.platypus import Table, TableStyle
-from reportlab.lib import colors
 from contact.forms import ContactQuickCreateForm, AddressForm
 
 @settings_required
@@ -140,23 +132,10 @@ def expense_delete(request):
 @settings_required
 @subscription_required
 def expense_list_export(request):
-    user = request.user
-
-    def expense_list_footer(canvas, doc):
-        canvas.saveState()
-        canvas.setFont('Times-Roman', 10)
-        PAGE_WIDTH = defaultPageSize[0]
-        footer_text = "%s %s - SIRET : %s - %s, %s %s" % (user.first_name,
-                                                          user.last_name,
-                                                          user.get_profile().company_id,
-                                                          user.get_profile().address.street,
-                                                          user.get_profile().address.zipcode,
-                                                          user.get_profile().address.city)
-        if user.get_profile().address.country:
-            footer_text = footer_text + ", %s" % (user.get_profile().address.country)
-        canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.5 * inch, footer_text)
-        canvas.restoreState()
+    from accounts.utils.pdf import book_to_pdf, PURCHASE_BOOK_COL_WIDTHS, \
+        PURCHASE_BOOK_ALIGNMENTS
 
+    user = request.user
     year = int(request.GET.get('year'))
     expenses = Expense.objects.filter(owner=user,
                                       date__year=year).order_by('date')
@@ -164,38 +143,17 @@ def expense_list_export(request):
     response = HttpResponse(mimetype='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
 
-    doc = BaseDocTemplate(response, title=ugettext('Purchase book %(year)d') % {'year': year})
-    frameT = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
-    doc.addPageTemplates([PageTemplate(id='all', frames=frameT, onPage=expense_list_footer), ])
-
-    styleH = ParagraphStyle({})
-    styleH.fontSize = 14
-    styleH.borderColor = colors.black
-    styleH.alignment = TA_CENTER
-
-    p = Paragraph(ugettext('Purchase book %(year)d') % {'year': year}, styleH)
-    spacer = Spacer(1 * inch, 0.5 * inch)
-
     data = [[ugettext('Date'), ugettext('Ref.'), ugettext('Supplier'), ugettext('Nature'), ugettext('Amount'), ugettext('Payment type')]]
 
     for expense in expenses:
         data.append([localize(expense.date), expense.reference, expense.supplier, expense.description, localize(expense.amount), expense.get_payment_type_display()])
-    t = Table(data, [0.8 * inch, 0.9 * inch, 1.6 * inch, 1.7 * inch, 0.7 * inch, 1.2 * inch], (len(expenses) + 1) * [0.3 * inch])
-    t.setStyle(TableStyle([('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-                           ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                           ('ALIGN', (2, 1), (3, -1), 'LEFT'),
-                           ('ALIGN', (4, 1), (4, -1), 'RIGHT'),
-                           ('FONT', (0, 0), (-1, 0), 'Times-Bold'),
-                           ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
-                           ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
-                           ]))
-
-    story = []
-    story.append(p)
-    story.append(spacer)
-    story.append(t)
-    doc.build(story, canvasmaker=NumberedCanvas)
-    return response
+
+    return book_to_pdf(response,
+                       user,
+                       ugettext('Purchase book %(year)d') % {'year': year},
+                       data,
+                       PURCHASE_BOOK_COL_WIDTHS,
+                       PURCHASE_BOOK_ALIGNMENTS)
 
 @settings_required
 @subscription_required
@@ -213,23 +171,10 @@ def invoice_list(request):
 @settings_required
 @subscription_required
 def invoice_list_export(request):
-    user = request.user
-
-    def invoice_list_footer(canvas, doc):
-        canvas.saveState()
-        canvas.setFont('Times-Roman', 10)
-        PAGE_WIDTH = defaultPageSize[0]
-        footer_text = "%s %s - SIRET : %s - %s, %s %s" % (user.first_name,
-                                                          user.last_name,
-                                                          user.get_profile().company_id,
-                                                          user.get_profile().address.street,
-                                                          user.get_profile().address.zipcode,
-                                                          user.get_profile().address.city)
-        if user.get_profile().address.country:
-            footer_text = footer_text + ", %s" % (user.get_profile().address.country)
-        canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.5 * inch, footer_text)
-        canvas.restoreState()
+    from accounts.utils.pdf import book_to_pdf, INVOICE_BOOK_COL_WIDTHS, \
+        INVOICE_BOOK_ALIGNMENTS
 
+    user = request.user
     year = int(request.GET.get('year'))
     invoices = Invoice.objects.filter(owner=user,
                                       state__gte=INVOICE_STATE_PAID,
@@ -238,37 +183,17 @@ def invoice_list_export(request):
     response = HttpResponse(mimetype='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
 
-    doc = BaseDocTemplate(response, title=ugettext('Invoice book %(year)d') % {'year': year})
-    frameT = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
-    doc.addPageTemplates([PageTemplate(id='all', frames=frameT, onPage=invoice_list_footer), ])
-
-    styleH = ParagraphStyle({})
-    styleH.fontSize = 14
-    styleH.borderColor = colors.black
-    styleH.alignment = TA_CENTER
-
-    p = Paragraph(ugettext('Invoice book %(year)d') % {'year': year}, styleH)
-    spacer = Spacer(1 * inch, 0.5 * inch)
-
     data = [[ugettext('Date'), ugettext('Ref.'), ugettext('Customer'), ugettext('Nature'), ugettext('Amount'), ugettext('Payment type')]]
 
     for invoice in invoices:
         data.append([localize(invoice.paid_date), invoice.invoice_id, invoice.customer, invoice.getNature(), localize(invoice.amount), invoice.get_payment_type_display()])
-    t = Table(data, [0.8 * inch, 0.4 * inch, 2.5 * inch, 1.2 * inch, 0.8 * inch, 1.2 * inch], (len(invoices) + 1) * [0.3 * inch])
-    t.setStyle(TableStyle([('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-                           ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                           ('ALIGN', (2, 1), (2, -1), 'LEFT'),
-                           ('FONT', (0, 0), (-1, 0), 'Times-Bold'),
-                           ('BOX', (0, 0), (-1, -1), 0.25, colors.black),
-                           ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
-                           ]))
-
-    story = []
-    story.append(p)
-    story.append(spacer)
-    story.append(t)
-    doc.build(story, canvasmaker=NumberedCanvas)
-    return response
+
+    return book_to_pdf(response,
+                       user,
+                       ugettext('Invoice book %(year)d') % {'year': year},
+                       data,
+                       INVOICE_BOOK_COL_WIDTHS,
+                       INVOICE_BOOK_ALIGNMENTS)
 
 @settings_required
 @subscription_required
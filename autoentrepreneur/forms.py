@@ -26,10 +26,9 @@ class UserProfileForm(ModelForm):
     def clean_logo_file(self):
         picture = self.cleaned_data.get("logo_file")
         if picture:
+            # bigger pictures are scaled down to the header box once uploaded
             try:
                 w, h = get_image_dimensions(picture)
-                if w > 252 or h > 137:
-                    raise forms.ValidationError(_('Your customer header is too big'))
             except TypeError:
                 raise forms.ValidationError(_('Unsupported format'))
         return picture
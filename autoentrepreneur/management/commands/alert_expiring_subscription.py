@@ -1,85 +1,38 @@
 from django.core.management.base import BaseCommand
-from autoentrepreneur.models import Subscription
+from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_TRIAL, \
+    SUBSCRIPTION_STATE_PAID
 from django.conf import settings
-from django.core.mail import send_mass_mail
-from django.template import loader
-from django.contrib.sites.models import Site
-from django.template.context import Context
+from core.mail import enqueue_mass_mail, send_spooled_mail, MailRenderer, \
+    format_recipient
+import datetime
 
 class Command(BaseCommand):
     help = 'Send an email to users whose subscription will expire soon'
 
     def handle(self, *args, **options):
-        messages = []
-
-        trial_expire_email_subject_template = loader.get_template('core/trial_expire_email_subject.html')
-        trial_expire_email_subject_context = {'site': Site.objects.get_current()}
-        trial_expire_email_template = loader.get_template('core/trial_expire_email.html')
-        trial_expire_email_context = {'site': Site.objects.get_current()}
-
-        expire_in = 7
-        trial_expire_email_subject_context['days'] = expire_in
-        trial_expire_email_subject = trial_expire_email_subject_template.render(Context(trial_expire_email_subject_context))
-        trial_expire_email_context['days'] = expire_in
-        trial_expire_email = trial_expire_email_template.render(Context(trial_expire_email_context))
-        for recipient in Subscription.objects.get_users_with_trial_subscription_expiring_in(expire_in):
-            to = '%s %s <%s>' % (recipient['owner__first_name'],
-                                 recipient['owner__last_name'],
-                                 recipient['owner__email'])
-            messages.append((trial_expire_email_subject,
-                             trial_expire_email,
-                             settings.DEFAULT_FROM_EMAIL,
-                             [to]))
-
-        expire_in = 1
-        trial_expire_email_subject_context['days'] = expire_in
-        trial_expire_email_subject = trial_expire_email_subject_template.render(Context(trial_expire_email_subject_context))
-        trial_expire_email_context['days'] = expire_in
-        trial_expire_email = trial_expire_email_template.render(Context(trial_expire_email_context))
-        for recipient in Subscription.objects.get_users_with_trial_subscription_expiring_in(expire_in):
-            to = '%s %s <%s>' % (recipient['owner__first_name'],
-                                 recipient['owner__last_name'],
-                                 recipient['owner__email'])
-            messages.append((trial_expire_email_subject,
-                             trial_expire_email,
-                             settings.DEFAULT_FROM_EMAIL,
-                             [to]))
-
-        subscription_expire_email_subject_template = loader.get_template('core/subscription_expire_email_subject.html')
-        subscription_expire_email_subject_context = {'site': Site.objects.get_current()}
-        subscription_expire_email_template = loader.get_template('core/subscription_expire_email.html')
-        subscription_expire_email_context = {'site': Site.objects.get_current()}
-
-        expire_in = 7
-        subscription_expire_email_subject_context['days'] = expire_in
-        subscription_expire_email_subject = subscription_expire_email_subject_template.render(Context(subscription_expire_email_subject_context))
-        subscription_expire_email_context['days'] = expire_in
-        subscription_expire_email = subscription_expire_email_template.render(Context(subscription_expire_email_context))
-        for recipient in Subscription.objects.get_users_with_paid_subscription_expiring_in(expire_in):
-            to = '%s %s <%s>' % (recipient['owner__first_name'],
-                                 recipient['owner__last_name'],
-                                 recipient['owner__email'])
-            messages.append((subscription_expire_email_subject,
-                             subscription_expire_email,
-                             settings.DEFAULT_FROM_EMAIL,
-                             [to]))
-
-        expire_in = 1
-        subscription_expire_email_subject_context['days'] = expire_in
-        subscription_expire_email_subject = subscription_expire_email_subject_template.render(Context(subscription_expire_email_subject_context))
-        subscription_expire_email_context['days'] = expire_in
-        subscription_expire_email = subscription_expire_email_template.render(Context(subscription_expire_email_context))
-        for recipient in Subscription.objects.get_users_with_paid_subscription_expiring_in(expire_in):
-            to = '%s %s <%s>' % (recipient['owner__first_name'],
-                                 recipient['owner__last_name'],
-                                 recipient['owner__email'])
-            messages.append((subscription_expire_email_subject,
-                             subscription_expire_email,
-                             settings.DEFAULT_FROM_EMAIL,
-                             [to]))
-
-        if messages:
-            print "Sending alert mail to %d users" % (len(messages))
-            send_mass_mail(messages, fail_silently=False)
+        # alerts only depend on the kind of subscription and the days left
+        renderers = {SUBSCRIPTION_STATE_TRIAL: MailRenderer('core/trial_expire_email_subject.html',
+                                                            'core/trial_expire_email.html',
+                                                            signature=False),
+                     SUBSCRIPTION_STATE_PAID: MailRenderer('core/subscription_expire_email_subject.html',
+                                                           'core/subscription_expire_email.html',
+                                                           signature=False)}
+
+        def get_messages():
+            today = datetime.date.today()
+            for recipient in Subscription.objects.get_users_with_subscription_expiring_in_days(settings.SUBSCRIPTION_EXPIRATION_ALERT_DAYS):
+                days = (recipient['expiration_date'] - today).days
+                subject, body = renderers[recipient['state']].render({'days': days}, days)
+                yield (subject,
+                       body,
+                       settings.DEFAULT_FROM_EMAIL,
+                       [format_recipient(recipient['owner__first_name'],
+                                         recipient['owner__last_name'],
+                                         recipient['owner__email'])])
+
+        message_count = enqueue_mass_mail(get_messages())
+        if message_count:
+            print "Sending alert mail to %d users" % (message_count)
+            send_spooled_mail()
         else:
             print "No users with expiring subscription"
@@ -1,13 +1,12 @@
-from django.core.management.base import BaseCommand
-from bugtracker.models import Issue, Comment, Vote
 from django.conf import settings
+from core.purge import PurgeCommand
 import datetime
 from registration.models import RegistrationProfile
 
-class Command(BaseCommand):
+class Command(PurgeCommand):
     help = 'Delete users with expired registration'
 
-    def handle(self, *args, **options):
+    def get_user_ids(self):
         """
         Delete inactive users which have an expired registration
         Expired registrations have expiration_key <> from RegistrationProfile.ACTIVATED
@@ -16,10 +15,4 @@ class Command(BaseCommand):
         """
         expired_registrations = RegistrationProfile.objects.filter(user__is_active=False,
                                                                    user__date_joined__lte=datetime.date.today() - datetime.timedelta(settings.ACCOUNT_ACTIVATION_DAYS)).exclude(activation_key=RegistrationProfile.ACTIVATED)
-
-        i = 0
-        for registration in expired_registrations:
-            i = i + 1
-            registration.user.delete()
-
-        print "%i expired subscription(s) deleted" % (i)
+        return list(expired_registrations.values_list('user', flat=True))
@@ -1,26 +1,12 @@
-from django.core.management.base import BaseCommand
-from bugtracker.models import Issue, Comment, Vote
 from django.conf import settings
 from autoentrepreneur.models import UserProfile
+from core.purge import PurgeCommand
 import datetime
-import shutil
 
-class Command(BaseCommand):
+class Command(PurgeCommand):
     help = 'Delete unregistered users'
 
-    def handle(self, *args, **options):
+    def get_user_ids(self):
         unregistered_profiles = UserProfile.objects.filter(user__is_active=False,
                                                            unregister_datetime__lt=datetime.datetime.now() - datetime.timedelta(settings.ACCOUNT_UNREGISTER_DAYS))
-
-        i = 0
-        for profile in unregistered_profiles:
-            i = i + 1
-            shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR,
-                                    profile.uuid),
-                                    True)
-            Issue.objects.filter(owner=profile.user).update(owner=None)
-            Comment.objects.filter(owner=profile.user).update(owner=None)
-            Vote.objects.filter(owner=profile.user).delete()
-            profile.user.delete()
-
-        print "%i user(s) deleted" % (i)
+        return list(unregistered_profiles.values_list('user', flat=True))
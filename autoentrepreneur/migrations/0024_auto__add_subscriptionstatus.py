@@ -0,0 +1,137 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'SubscriptionStatus'
+        db.create_table('autoentrepreneur_subscriptionstatus', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('owner', self.gf('django.db.models.fields.related.OneToOneField')(related_name='subscription_status', unique=True, to=orm['auth.User'])),
+            ('state', self.gf('django.db.models.fields.IntegerField')(db_index=True)),
+            ('expiration_date', self.gf('django.db.models.fields.DateField')(null=True, db_index=True)),
+            ('last_paid_date', self.gf('django.db.models.fields.DateField')(null=True, db_index=True)),
+        ))
+        db.send_create_signal('autoentrepreneur', ['SubscriptionStatus'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'SubscriptionStatus'
+        db.delete_table('autoentrepreneur_subscriptionstatus')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'autoentrepreneur.saleslimit': {
+            'Meta': {'object_name': 'SalesLimit'},
+            'activity': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'limit': ('django.db.models.fields.IntegerField', [], {}),
+            'limit2': ('django.db.models.fields.IntegerField', [], {}),
+            'year': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'autoentrepreneur.subscription': {
+            'Meta': {'object_name': 'Subscription', '_ormbases': ['core.OwnedObject']},
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '150', 'null': 'True', 'blank': 'True'}),
+            'expiration_date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'ownedobject_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['core.OwnedObject']", 'unique': 'True', 'primary_key': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'transaction_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'autoentrepreneur.subscriptionstatus': {
+            'Meta': {'object_name': 'SubscriptionStatus'},
+            'expiration_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_paid_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'db_index': 'True'}),
+            'owner': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'subscription_status'", 'unique': 'True', 'to': "orm['auth.User']"}),
+            'state': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        'autoentrepreneur.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'activity': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'address': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contact.Address']"}),
+            'bic': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '11', 'blank': 'True'}),
+            'company_id': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'blank': 'True'}),
+            'company_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'creation_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'creation_help': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'freeing_tax_payment': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'iban_bban': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '34', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'logo_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'payment_option': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'phonenumber': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'blank': 'True'}),
+            'professional_category': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'professional_email': ('django.db.models.fields.EmailField', [], {'default': "''", 'max_length': '75', 'blank': 'True'}),
+            'register': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'registration_city': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'unregister_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'}),
+            'uuid': ('django.db.models.fields.CharField', [], {'default': "''", 'unique': 'True', 'max_length': '36'}),
+            'vat_number': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'null': 'True', 'blank': 'True'})
+        },
+        'contact.address': {
+            'Meta': {'object_name': 'Address', '_ormbases': ['core.OwnedObject']},
+            'city': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contact.Country']", 'null': 'True', 'blank': 'True'}),
+            'ownedobject_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['core.OwnedObject']", 'unique': 'True', 'primary_key': 'True'}),
+            'street': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'zipcode': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'blank': 'True'})
+        },
+        'contact.country': {
+            'Meta': {'ordering': "['country_name']", 'object_name': 'Country'},
+            'country_code2': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'country_code3': ('django.db.models.fields.CharField', [], {'max_length': '3'}),
+            'country_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'core.ownedobject': {
+            'Meta': {'object_name': 'OwnedObject'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_datetime': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'uuid': ('django.db.models.fields.CharField', [], {'default': "''", 'unique': 'True', 'max_length': '36'})
+        }
+    }
+
+    complete_apps = ['autoentrepreneur']
@@ -0,0 +1,145 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from itertools import groupby
+
+# same as autoentrepreneur.models
+SUBSCRIPTION_STATE_NOT_PAID = 1
+SUBSCRIPTION_STATE_PAID = 2
+SUBSCRIPTION_STATE_TRIAL = 3
+SUBSCRIPTION_STATE_FREE = 4
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        subscriptions = orm['autoentrepreneur.subscription'].objects.values_list('owner', 'state', 'expiration_date').order_by('owner')
+        for owner_id, owner_subscriptions in groupby(subscriptions.iterator(), lambda subscription: subscription[0]):
+            owner_subscriptions = list(owner_subscriptions)
+            states = set([state for owner, state, expiration_date in owner_subscriptions])
+            for state in [SUBSCRIPTION_STATE_FREE, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_TRIAL, SUBSCRIPTION_STATE_NOT_PAID]:
+                if state in states:
+                    break
+            expiration_dates = [expiration_date for owner, state, expiration_date in owner_subscriptions if state in [SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_TRIAL]]
+            paid_dates = [expiration_date for owner, state, expiration_date in owner_subscriptions if state == SUBSCRIPTION_STATE_PAID]
+            orm['autoentrepreneur.subscriptionstatus'].objects.create(owner_id=owner_id,
+                                                                      state=state,
+                                                                      expiration_date=expiration_dates and max(expiration_dates) or None,
+                                                                      last_paid_date=paid_dates and max(paid_dates) or None)
+
+
+    def backwards(self, orm):
+        orm['autoentrepreneur.subscriptionstatus'].objects.all().delete()
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'autoentrepreneur.saleslimit': {
+            'Meta': {'object_name': 'SalesLimit'},
+            'activity': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'limit': ('django.db.models.fields.IntegerField', [], {}),
+            'limit2': ('django.db.models.fields.IntegerField', [], {}),
+            'year': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'autoentrepreneur.subscription': {
+            'Meta': {'object_name': 'Subscription', '_ormbases': ['core.OwnedObject']},
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '150', 'null': 'True', 'blank': 'True'}),
+            'expiration_date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'ownedobject_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['core.OwnedObject']", 'unique': 'True', 'primary_key': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'transaction_id': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '50'})
+        },
+        'autoentrepreneur.subscriptionstatus': {
+            'Meta': {'object_name': 'SubscriptionStatus'},
+            'expiration_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_paid_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'db_index': 'True'}),
+            'owner': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'subscription_status'", 'unique': 'True', 'to': "orm['auth.User']"}),
+            'state': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'})
+        },
+        'autoentrepreneur.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'activity': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'address': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contact.Address']"}),
+            'bic': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '11', 'blank': 'True'}),
+            'company_id': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'blank': 'True'}),
+            'company_name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'creation_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'creation_help': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'freeing_tax_payment': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'iban_bban': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '34', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'logo_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'payment_option': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'phonenumber': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'blank': 'True'}),
+            'professional_category': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'professional_email': ('django.db.models.fields.EmailField', [], {'default': "''", 'max_length': '75', 'blank': 'True'}),
+            'register': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'registration_city': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'unregister_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'}),
+            'uuid': ('django.db.models.fields.CharField', [], {'default': "''", 'unique': 'True', 'max_length': '36'}),
+            'vat_number': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'null': 'True', 'blank': 'True'})
+        },
+        'contact.address': {
+            'Meta': {'object_name': 'Address', '_ormbases': ['core.OwnedObject']},
+            'city': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'country': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contact.Country']", 'null': 'True', 'blank': 'True'}),
+            'ownedobject_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['core.OwnedObject']", 'unique': 'True', 'primary_key': 'True'}),
+            'street': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'zipcode': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'blank': 'True'})
+        },
+        'contact.country': {
+            'Meta': {'ordering': "['country_name']", 'object_name': 'Country'},
+            'country_code2': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'country_code3': ('django.db.models.fields.CharField', [], {'max_length': '3'}),
+            'country_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'core.ownedobject': {
+            'Meta': {'object_name': 'OwnedObject'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_datetime': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'uuid': ('django.db.models.fields.CharField', [], {'default': "''", 'unique': 'True', 'max_length': '36'})
+        }
+    }
+
+    complete_apps = ['autoentrepreneur']
@@ -2,11 +2,11 @@
 import logging
 import uuid
 from django.db import models
+from django.db.models.query_utils import Q
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from contact.models import Address
-from django.db.models.signals import post_save
-from django.db.models.aggregates import Max, Count
+from django.db.models.signals import post_save, post_delete
 from core.models import OwnedObject
 from bugtracker.models import Issue
 from django.core.mail import send_mail
@@ -54,58 +54,71 @@ class SubscriptionManager(models.Manager):
                            owner=user).order_by('-expiration_date')
 
     def get_users_with_paid_subscription(self):
-        return self.filter(expiration_date__gte=datetime.date.today(),
-                           owner__is_active=True,
-                           state=SUBSCRIPTION_STATE_PAID).values('owner__email',
-                                                                 'owner__first_name',
-                                                                 'owner__last_name').distinct()
+        return SubscriptionStatus.objects.filter(last_paid_date__gte=datetime.date.today(),
+                                                 owner__is_active=True).values('owner__email',
+                                                                               'owner__first_name',
+                                                                               'owner__last_name')
 
     def get_users_with_trial_subscription(self):
-        return self.filter(owner__is_active=True).values('owner').annotate(sub_count=Count('id'),
-                                                                           state=Max('state'),
-                                                                           date=Max('expiration_date')).values('owner__email',
-                                                                                                               'owner__first_name',
-                                                                                                               'owner__last_name').filter(sub_count=1,
-                                                                                                                                          date__gte=datetime.date.today(),
-                                                                                                                                          state=SUBSCRIPTION_STATE_TRIAL).distinct()
+        return SubscriptionStatus.objects.filter(state=SUBSCRIPTION_STATE_TRIAL,
+                                                 expiration_date__gte=datetime.date.today(),
+                                                 owner__is_active=True).values('owner__email',
+                                                                               'owner__first_name',
+                                                                               'owner__last_name')
 
     def get_users_with_expired_subscription(self):
-        return self.filter(owner__is_active=True)\
-                   .values('owner')\
-                   .annotate(max_date=Max('expiration_date'),
-                             max_state=Max('state'))\
-                   .values('owner__email',
-                           'owner__first_name',
-                           'owner__last_name')\
-                   .filter(max_date__lt=datetime.date.today(),
-                           max_state__lt=SUBSCRIPTION_STATE_FREE)\
-                   .distinct()
+        return SubscriptionStatus.objects.filter(Q(expiration_date__lt=datetime.date.today()) | Q(expiration_date=None),
+                                                 owner__is_active=True)\
+                                         .exclude(state=SUBSCRIPTION_STATE_FREE)\
+                                         .values('owner__email',
+                                                 'owner__first_name',
+                                                 'owner__last_name')
 
     def get_users_with_paid_subscription_expiring_in(self, days=30):
-        return self.filter(expiration_date=datetime.date.today() + datetime.timedelta(days),
-                           owner__is_active=True,
-                           state=SUBSCRIPTION_STATE_PAID).values('owner__email',
-                                                                 'owner__first_name',
-                                                                 'owner__last_name').distinct().order_by('owner__email')
+        return SubscriptionStatus.objects.filter(state=SUBSCRIPTION_STATE_PAID,
+                                                 expiration_date=datetime.date.today() + datetime.timedelta(days),
+                                                 owner__is_active=True).values('owner__email',
+                                                                               'owner__first_name',
+                                                                               'owner__last_name').order_by('owner__email')
 
     def get_users_with_trial_subscription_expiring_in(self, days=7):
-        return self.all().values('owner').annotate(sub_count=Count('id'),
-                                                   state=Max('state'),
-                                                   date=Max('expiration_date')).values('owner__email',
-                                                                                       'owner__first_name',
-                                                                                       'owner__last_name').filter(sub_count=1,
-                                                                                                                  date=datetime.date.today() + datetime.timedelta(days),
-                                                                                                                  state=SUBSCRIPTION_STATE_TRIAL).distinct().order_by('owner__email')
+        return SubscriptionStatus.objects.filter(state=SUBSCRIPTION_STATE_TRIAL,
+                                                 expiration_date=datetime.date.today() + datetime.timedelta(days)).values('owner__email',
+                                                                                                                          'owner__first_name',
+                                                                                                                          'owner__last_name').order_by('owner__email')
+
+    def get_users_with_subscription_expiring_in_days(self, days_list):
+        """
+        Returns state, expiration_date, owner__email, owner__first_name and
+        owner__last_name of users in trial or having paid whose access
+        expires in one of days_list, trial first, then latest expiration
+        first.
+        """
+        today = datetime.date.today()
+        return SubscriptionStatus.objects.filter(expiration_date__in=[today + datetime.timedelta(days) for days in days_list])\
+                                         .filter(Q(state=SUBSCRIPTION_STATE_PAID, owner__is_active=True) | Q(state=SUBSCRIPTION_STATE_TRIAL))\
+                                         .values('state',
+                                                 'expiration_date',
+                                                 'owner__email',
+                                                 'owner__first_name',
+                                                 'owner__last_name')\
+                                         .order_by('-state', '-expiration_date', 'owner__email')
 
     def get_users_with_subscription_expired_for(self, days):
-        return self.filter(owner__is_active=True).exclude(state=SUBSCRIPTION_STATE_FREE)\
-                   .values_list('owner', flat=True)\
-                   .annotate(max_date=Max('expiration_date'))\
-                   .filter(max_date__lte=datetime.date.today() - datetime.timedelta(days)).distinct()
+        return SubscriptionStatus.objects.filter(expiration_date__lte=datetime.date.today() - datetime.timedelta(days),
+                                                 owner__is_active=True)\
+                                         .exclude(state=SUBSCRIPTION_STATE_FREE)\
+                                         .values_list('owner', flat=True)
 
     def add_days(self, days):
         """Add hours and days to active subscriptions"""
-        return self.filter(expiration_date__gte=datetime.date.today()).update(expiration_date=F('expiration_date') + days)
+        today = datetime.date.today()
+        count = self.filter(expiration_date__gte=today).update(expiration_date=F('expiration_date') + days,
+                                                               modification_datetime=datetime.datetime.now())
+        # the latest dates are moved the same way
+        SubscriptionStatus.objects.filter(expiration_date__gte=today).update(expiration_date=F('expiration_date') + days)
+        SubscriptionStatus.objects.filter(last_paid_date__gte=today).update(last_paid_date=F('last_paid_date') + days)
+        return count
 
 class Subscription(OwnedObject):
     state = models.IntegerField(choices=SUBSCRIPTION_STATE, verbose_name=_('State'), db_index=True)
@@ -120,6 +133,63 @@ class Subscription(OwnedObject):
                                  self.get_state_display(),
                                  self.expiration_date)
 
+class SubscriptionStatusManager(models.Manager):
+    def refresh(self, owner_id, create=True):
+        """
+        Computes the status of owner from their subscriptions
+        """
+        subscriptions = list(Subscription.objects.filter(owner=owner_id).values_list('state', 'expiration_date'))
+        if not subscriptions:
+            self.filter(owner=owner_id).delete()
+            return
+
+        states = set([state for state, expiration_date in subscriptions])
+        for state in [SUBSCRIPTION_STATE_FREE, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_TRIAL, SUBSCRIPTION_STATE_NOT_PAID]:
+            if state in states:
+                break
+        expiration_dates = [expiration_date for state, expiration_date in subscriptions if state in [SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_TRIAL]]
+        paid_dates = [expiration_date for state, expiration_date in subscriptions if state == SUBSCRIPTION_STATE_PAID]
+        values = {'state': state,
+                  'expiration_date': expiration_dates and max(expiration_dates) or None,
+                  'last_paid_date': paid_dates and max(paid_dates) or None}
+        # not created while the owner is being deleted
+        if not self.filter(owner=owner_id).update(**values) and create:
+            self.create(owner_id=owner_id, **values)
+
+class SubscriptionStatus(models.Model):
+    """
+    Current subscription of a user, derived from their subscriptions.
+    state is free if they have a free pass, else paid if they ever paid,
+    else trial. expiration_date is the end of their latest paid or trial
+    subscription and last_paid_date the end of their latest paid one.
+    """
+    owner = models.OneToOneField(User, related_name='subscription_status')
+    state = models.IntegerField(choices=SUBSCRIPTION_STATE, db_index=True)
+    expiration_date = models.DateField(null=True, db_index=True)
+    last_paid_date = models.DateField(null=True, db_index=True)
+
+    objects = SubscriptionStatusManager()
+
+    def __unicode__(self):
+        return "%s - %s - %s" % (self.owner_id,
+                                 self.get_state_display(),
+                                 self.expiration_date)
+
+    def is_allowed(self):
+        if self.state == SUBSCRIPTION_STATE_FREE:
+            return True
+        return self.expiration_date is not None and self.expiration_date >= datetime.date.today()
+
+def subscription_post_save(sender, instance, **kwargs):
+    owner_id = instance.owner_id
+    if kwargs.get('raw', False):
+        # fixtures only hold fields of the subscription table
+        owner_id = OwnedObject.objects.get(pk=instance.pk).owner_id
+    SubscriptionStatus.objects.refresh(owner_id)
+
+def subscription_post_delete(sender, instance, **kwargs):
+    SubscriptionStatus.objects.refresh(instance.owner_id, create=False)
+
 AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY = 1
 AUTOENTREPRENEUR_PAYMENT_OPTION_MONTHLY = 2
 AUTOENTREPRENEUR_PAYMENT_OPTION = ((AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY, _('Quaterly')),
@@ -254,27 +324,23 @@ class UserProfile(models.Model):
 
         return settings_defined
 
-    def is_allowed(self):
-        if Subscription.objects.filter(owner=self.user,
-                                       state__in=[SUBSCRIPTION_STATE_FREE]).count():
-            return True
-
-        if Subscription.objects.filter(owner=self.user,
-                                       state__in=[SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_TRIAL],
-                                       expiration_date__gte=datetime.date.today()).count():
-            return True
+    def get_subscription_status(self):
+        try:
+            return SubscriptionStatus.objects.get(owner=self.user_id)
+        except SubscriptionStatus.DoesNotExist:
+            return None
 
-        return False
+    def is_allowed(self):
+        status = self.get_subscription_status()
+        return status is not None and status.is_allowed()
 
     def unread_message_count(self):
         return Issue.objects.unread_messages(self.user)
 
     def get_next_expiration_date(self):
-        last_valid_expiration_date = Subscription.objects.filter(owner=self.user,
-                                                                 state__in=[SUBSCRIPTION_STATE_PAID,
-                                                                            SUBSCRIPTION_STATE_TRIAL]).aggregate(last_date=Max('expiration_date'))
+        status = self.get_subscription_status()
         today = datetime.date.today()
-        ref_date = last_valid_expiration_date['last_date']
+        ref_date = status and status.expiration_date
         if not ref_date or ref_date < today:
             ref_date = today
 
@@ -586,4 +652,6 @@ def log_registration(sender, user, request, **kwargs):
     logger.info('%s <%s> has registered' % (user.username, user.email))
 
 post_save.connect(user_post_save, sender=User)
+post_save.connect(subscription_post_save, sender=Subscription)
+post_delete.connect(subscription_post_delete, sender=Subscription)
 user_registered.connect(log_registration)
@@ -1,6 +1,6 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
-from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_NOT_PAID, \
+from autoentrepreneur.models import Subscription, SubscriptionStatus, SUBSCRIPTION_STATE_NOT_PAID, \
     SUBSCRIPTION_STATE_TRIAL, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, \
     UserProfile, AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_TRADER, \
     AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_CRAFTSMAN, \
@@ -18,6 +18,7 @@ from django.core import mail
 from django.contrib.sites.models import Site
 from django.utils.translation import ugettext
 from django.conf import settings
+from django.db import connection
 from django.core.management import call_command
 import datetime
 from autoentrepreneur.models import AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY, \
@@ -30,6 +31,8 @@ import autoentrepreneur
 from django.contrib.auth import authenticate
 from registration.models import RegistrationProfile
 from backup.models import mkdir_p
+from forum.models import Topic, Message as ForumMessage
+from core.purge import purge_users
 import os
 
 class SubscriptionTest(TestCase):
@@ -579,6 +582,50 @@ L'\xe9quipe %(site_name)s""" % {'site': Site.objects.get_current(),
                                 'days': 1,
                                 'subscribe_url': reverse('subscribe')})
 
+    def testExpirationAlertTargetsInOneQuery(self):
+        # renewed trial (no alert)
+        user2 = User.objects.create_user('user2', 'user2@example.com', 'test')
+        sub = Subscription.objects.get(owner=user2)
+        sub.expiration_date = datetime.date.today() + datetime.timedelta(7)
+        sub.save()
+        Subscription.objects.create(owner=user2,
+                                    state=SUBSCRIPTION_STATE_PAID,
+                                    expiration_date=datetime.date.today() + datetime.timedelta(40),
+                                    transaction_id='XX2')
+
+        # trial with 7 days remaining (alert)
+        user3 = User.objects.create_user('user3', 'user3@example.com', 'test')
+        sub = Subscription.objects.get(owner=user3)
+        sub.expiration_date = datetime.date.today() + datetime.timedelta(7)
+        sub.save()
+
+        # paid with 1 day remaining after a paid history (one alert)
+        user4 = User.objects.create_user('user4', 'user4@example.com', 'test')
+        sub = Subscription.objects.get(owner=user4)
+        sub.expiration_date = datetime.date.today() - datetime.timedelta(400)
+        sub.save()
+        for i in range(12):
+            Subscription.objects.create(owner=user4,
+                                        state=SUBSCRIPTION_STATE_PAID,
+                                        expiration_date=datetime.date.today() - datetime.timedelta(30 * i),
+                                        transaction_id='XX4-%i' % (i))
+        Subscription.objects.create(owner=user4,
+                                    state=SUBSCRIPTION_STATE_PAID,
+                                    expiration_date=datetime.date.today() + datetime.timedelta(1),
+                                    transaction_id='XX4')
+
+        settings.DEBUG = True
+        try:
+            query_count = len(connection.queries)
+            recipients = list(Subscription.objects.get_users_with_subscription_expiring_in_days([7, 1]))
+            query_count = len(connection.queries) - query_count
+        finally:
+            settings.DEBUG = False
+        self.assertEquals(query_count, 1)
+        self.assertEquals([(recipient['state'], recipient['owner__email']) for recipient in recipients],
+                          [(SUBSCRIPTION_STATE_TRIAL, 'user3@example.com'),
+                           (SUBSCRIPTION_STATE_PAID, 'user4@example.com')])
+
     def testAddDays(self):
         sub1 = Subscription.objects.create(owner_id=1,
                                            state=SUBSCRIPTION_STATE_TRIAL,
@@ -588,6 +635,8 @@ L'\xe9quipe %(site_name)s""" % {'site': Site.objects.get_current(),
                                            state=SUBSCRIPTION_STATE_PAID,
                                            expiration_date=datetime.date.today() + datetime.timedelta(8),
                                            transaction_id='XX2')
+        modification_datetime = datetime.datetime(2011, 1, 1)
+        Subscription.objects.filter(pk__in=[sub1.id, sub2.id]).update(modification_datetime=modification_datetime)
 
         call_command('add_days_to_subscriptions', 3)
 
@@ -595,6 +644,9 @@ L'\xe9quipe %(site_name)s""" % {'site': Site.objects.get_current(),
                           datetime.date.today() + datetime.timedelta(6))
         self.assertEquals(Subscription.objects.get(pk=sub2.id).expiration_date,
                           datetime.date.today() + datetime.timedelta(11))
+        # seen by incremental backups
+        self.assertTrue(Subscription.objects.get(pk=sub1.id).modification_datetime > modification_datetime)
+        self.assertTrue(Subscription.objects.get(pk=sub2.id).modification_datetime > modification_datetime)
 
     def testDoNotAddDaysToExpired(self):
         sub1 = Subscription.objects.create(owner_id=1,
@@ -845,6 +897,62 @@ class UnregisterTest(TestCase):
         self.assertEquals(User.objects.count(), 1)
         self.assertFalse(os.path.exists('%s%s' % (settings.FILE_UPLOAD_DIR, user_uuid)))
 
+    def testPurgeUsersByChunks(self):
+        users = []
+        for i in range(5):
+            user = User.objects.create_user('purged%i' % (i), 'purged%i@example.com' % (i), 'test')
+            mkdir_p('%s%s' % (settings.FILE_UPLOAD_DIR, user.get_profile().uuid))
+            address = Address.objects.create(owner=user)
+            Contact.objects.create(contact_type=CONTACT_TYPE_COMPANY,
+                                   name='Contact %i' % (i),
+                                   address=address,
+                                   owner=user)
+            users.append(user)
+        kept_user = User.objects.create_user('kept', 'kept@example.com', 'test')
+        kept_dir = '%s%s' % (settings.FILE_UPLOAD_DIR, kept_user.get_profile().uuid)
+        mkdir_p(kept_dir)
+        kept_address = Address.objects.create(owner=kept_user)
+        kept_contact = Contact.objects.create(contact_type=CONTACT_TYPE_COMPANY,
+                                              name='Kept contact',
+                                              address=kept_address,
+                                              owner=kept_user)
+        upload_dirs = ['%s%s' % (settings.FILE_UPLOAD_DIR, user.get_profile().uuid) for user in users]
+        topic = Topic.objects.create(title='Topic')
+        message = ForumMessage.objects.create(topic=topic,
+                                              author=users[0],
+                                              body='Body',
+                                              creation_date=datetime.datetime.now())
+        user_count = User.objects.count()
+        contact_count = Contact.objects.count()
+
+        result = purge_users([user.id for user in users], dry_run=True, chunk_size=2)
+        self.assertEquals(result['users'], 5)
+        self.assertEquals(result['directories'], 5)
+        self.assertTrue(result['rows'] > 0)
+        self.assertEquals(User.objects.count(), user_count)
+        self.assertEquals(Contact.objects.count(), contact_count)
+        for upload_dir in upload_dirs:
+            self.assertTrue(os.path.exists(upload_dir))
+
+        result = purge_users([user.id for user in users], chunk_size=2)
+        self.assertEquals(result['users'], 5)
+        self.assertEquals(User.objects.count(), user_count - 5)
+        self.assertEquals(UserProfile.objects.filter(user__in=users).count(), 0)
+        self.assertEquals(Contact.objects.count(), contact_count - 5)
+        self.assertEquals(Address.objects.filter(owner__in=users).count(), 0)
+        self.assertEquals(Subscription.objects.filter(owner__in=users).count(), 0)
+        self.assertEquals(SubscriptionStatus.objects.filter(owner__in=users).count(), 0)
+        # forum messages are kept without their author
+        self.assertEquals(ForumMessage.objects.get(pk=message.id).author, None)
+        for upload_dir in upload_dirs:
+            self.assertFalse(os.path.exists(upload_dir))
+        # other users are left untouched
+        self.assertEquals(User.objects.filter(pk=kept_user.id).count(), 1)
+        self.assertEquals(UserProfile.objects.filter(user=kept_user).count(), 1)
+        self.assertEquals(Contact.objects.get(pk=kept_contact.id).address, kept_address)
+        self.assertEquals(Subscription.objects.filter(owner=kept_user).count(), 1)
+        self.assertTrue(os.path.exists(kept_dir))
+
 class SubscriptionUserSelectTest(TestCase):
 
     def setUp(self):
@@ -994,6 +1102,34 @@ class SubscriptionUserSelectTest(TestCase):
         self.assertTrue(intended_user1 in users)
         self.assertTrue(intended_user2 in users)
 
+    def testStatusFollowsSubscriptions(self):
+        today = datetime.date.today()
+        status = SubscriptionStatus.objects.get(owner=self.user3)
+        self.assertEquals(status.state, SUBSCRIPTION_STATE_PAID)
+        self.assertEquals(status.expiration_date, today + datetime.timedelta(10))
+        self.assertEquals(status.last_paid_date, today + datetime.timedelta(10))
+        self.assertEquals(SubscriptionStatus.objects.get(owner=self.user4).state, SUBSCRIPTION_STATE_TRIAL)
+        self.assertEquals(SubscriptionStatus.objects.get(owner=self.user7).state, SUBSCRIPTION_STATE_FREE)
+
+        Subscription.objects.get(transaction_id='paiduser3').delete()
+        status = SubscriptionStatus.objects.get(owner=self.user3)
+        self.assertEquals(status.state, SUBSCRIPTION_STATE_TRIAL)
+        self.assertEquals(status.expiration_date, today - datetime.timedelta(10))
+        self.assertEquals(status.last_paid_date, None)
+
+        profile = self.user3.get_profile()
+        settings.DEBUG = True
+        try:
+            query_count = len(connection.queries)
+            self.assertFalse(profile.is_allowed())
+            query_count = len(connection.queries) - query_count
+        finally:
+            settings.DEBUG = False
+        self.assertEquals(query_count, 1)
+
+        self.user3.delete()
+        self.assertEquals(SubscriptionStatus.objects.filter(owner=self.user3.id).count(), 0)
+
     def test137(self):
         """
         Test users list when a user has only one free subscription
@@ -7,14 +7,16 @@ class BackupForm(forms.ModelForm):
 
     class Meta:
         model = BackupRequest
-        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'error_message']
+        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'heartbeat_datetime', 'error_message', 'since_datetime', 'last_backup_datetime',
+                   'started_datetime', 'progress_datetime', 'progress_objects', 'progress_bytes', 'progress_model']
 
 class RestoreForm(forms.ModelForm):
     backup_or_restore = forms.CharField(initial='restore', widget=forms.HiddenInput())
 
     class Meta:
         model = RestoreRequest
-        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'error_message']
+        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'heartbeat_datetime', 'error_message',
+                   'started_datetime', 'progress_datetime', 'progress_objects', 'progress_bytes', 'progress_model']
 
 class CSVForm(forms.Form):
     begin_date = forms.DateField(label=_('From date'), required=False, help_text=_('Optional. If not set, export from the first invoice'))
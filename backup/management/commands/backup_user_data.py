@@ -2,7 +2,6 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, \
     BACKUP_RESTORE_STATE_PENDING
-import datetime
 
 class Command(BaseCommand):
     help = 'Execute pending backup request'
@@ -22,7 +21,10 @@ class Command(BaseCommand):
 
         self.stdout.write("Can treat up to %i requests.\n" % (request_to_treat))
 
-        pending_requests = BackupRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime')[:request_to_treat]
-        self.stdout.write("%i requests will be treated.\n" % (len(pending_requests)))
-        for request in pending_requests:
+        for i in range(request_to_treat):
+            # claiming is atomic, overlapping runs never process the same request,
+            # progress of the request is its heartbeat for backup_worker
+            request = BackupRequest.objects.claim_next()
+            if request is None:
+                break
             request.backup()
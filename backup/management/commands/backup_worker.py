@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections, transaction
+from backup.models import BackupRequest, RestoreRequest, get_progress
+from multiprocessing import Pool
+import signal
+import time
+import logging
+
+# seconds between two looks at the queues
+POLL_INTERVAL = 2
+# seconds between two heartbeats of running requests
+HEARTBEAT_INTERVAL = 30
+# requests in progress without heartbeat for this long are queued again
+STALE_TIMEOUT = 30 * 60
+
+REQUEST_MODELS = {'backup': BackupRequest,
+                  'restore': RestoreRequest}
+
+logger = logging.getLogger('backup.worker')
+
+def init_worker():
+    # the database connection of the parent must not be used by children,
+    # forget it without closing it
+    for connection in connections.all():
+        connection.connection = None
+    # interruption is handled by the parent which waits for running requests
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def process_request(kind, request_id):
+    request = REQUEST_MODELS[kind].objects.get(pk=request_id)
+    if kind == 'backup':
+        request.backup()
+    else:
+        request.restore()
+    progress = get_progress(request)
+    logger.info('%s request %i of %s %s in %.2fs (%s): %i objects (%.0f/s), %i bytes (%.0f/s)' % (kind,
+                                                                                                  request_id,
+                                                                                                  request.user,
+                                                                                                  request.get_state_display(),
+                                                                                                  progress['elapsed'],
+                                                                                                  request.progress.get_timings(),
+                                                                                                  progress['objects'],
+                                                                                                  progress['objects_per_second'],
+                                                                                                  progress['bytes'],
+                                                                                                  progress['bytes_per_second']))
+    return request.state
+
+class Command(BaseCommand):
+    args = '[once]'
+    help = 'Execute backup and restore requests in parallel, up to CONCURRENT_BACKUP_REQUEST backups and CONCURRENT_RESTORE_REQUEST restores at a time. With "once", stops when queues are empty.'
+
+    def handle(self, *args, **options):
+        once = len(args) > 0 and args[0] == 'once'
+        if len(args) > 0 and not once:
+            raise CommandError('Usage is backup_worker %s' % (self.args))
+
+        limits = {'backup': settings.CONCURRENT_BACKUP_REQUEST,
+                  'restore': settings.CONCURRENT_RESTORE_REQUEST}
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        pool = Pool(processes=sum(limits.values()), initializer=init_worker)
+        # (kind, request id) -> AsyncResult
+        running = {}
+        last_heartbeat = 0
+        while True:
+            for (kind, request_id), result in running.items():
+                if result.ready():
+                    del running[(kind, request_id)]
+                    try:
+                        result.get()
+                    except Exception as e:
+                        logger.error('%s request %i failed: %s' % (kind, request_id, e))
+
+            if time.time() - last_heartbeat > HEARTBEAT_INTERVAL:
+                for kind, model in REQUEST_MODELS.items():
+                    model.objects.heartbeat([request_id for request_kind, request_id in running if request_kind == kind])
+                    recovered = model.objects.recover_stale(STALE_TIMEOUT)
+                    if recovered:
+                        logger.warning('%i stale %s requests queued again' % (recovered, kind))
+                last_heartbeat = time.time()
+
+            if not self.stopping:
+                for kind, model in REQUEST_MODELS.items():
+                    while len([request_kind for request_kind, request_id in running if request_kind == kind]) < limits[kind]:
+                        request = model.objects.claim_next()
+                        if request is None:
+                            break
+                        self.stdout.write("Starting %s request %i of %s.\n" % (kind, request.id, request.user))
+                        running[(kind, request.id)] = pool.apply_async(process_request, (kind, request.id))
+
+            if not running and (self.stopping or once):
+                break
+
+            # don't keep a transaction open between two polls
+            transaction.commit_unless_managed()
+            time.sleep(POLL_INTERVAL)
+
+        pool.close()
+        pool.join()
+
+    def stop(self, signum, frame):
+        self.stdout.write("Stopping once running requests are done.\n")
+        self.stopping = True
@@ -0,0 +1,150 @@
+import datetime
+import gzip
+import time
+from optparse import make_option
+from StringIO import StringIO
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from backup.models import BackupRequest, RESTORE_BATCH_SIZE, insert_owned_objects
+from backup.utils.format import BACKUP_FORMAT_XML, BACKUP_FORMAT_JSON, READERS
+from contact.models import Address, Contact, PhoneNumber, CONTACT_TYPE_COMPANY
+from project.models import Contract, Project, Proposal, ProposalRow, ROW_CATEGORY_SERVICE, \
+    PROPOSAL_STATE_ACCEPTED
+from accounts.models import Invoice, InvoiceRow, Expense, INVOICE_STATE_PAID, \
+    PAYMENT_TYPE_CHECK
+
+FORMATS = [('v1 xml', BACKUP_FORMAT_XML),
+           ('v2 json', BACKUP_FORMAT_JSON)]
+
+def insert(objects):
+    for i in range(0, len(objects), RESTORE_BATCH_SIZE):
+        insert_owned_objects(objects[i:i + RESTORE_BATCH_SIZE])
+    return objects
+
+def create_account(user, customer_count, rows_per_document):
+    """
+    Fills the account of user with a customer, a project, an accepted
+    proposal and its paid invoice per customer_count
+    """
+    today = datetime.date.today()
+    addresses = insert([Address(owner=user,
+                                street='%i rue de la Paix' % (i),
+                                zipcode='75001',
+                                city='Paris') for i in range(customer_count)])
+    customers = insert([Contact(owner=user,
+                                contact_type=CONTACT_TYPE_COMPANY,
+                                name='Customer %i' % (i),
+                                company_id='12345678912345',
+                                legal_form='SARL',
+                                representative='Jean Dupont',
+                                representative_function='Manager',
+                                email='customer%i@example.com' % (i),
+                                address=address,
+                                comment=u'Customer since %s' % (today)) for i, address in enumerate(addresses)])
+    projects = insert([Project(owner=user,
+                               name='Web site of customer %i' % (i),
+                               customer=customer) for i, customer in enumerate(customers)])
+    proposals = insert([Proposal(owner=user,
+                                 project=project,
+                                 reference='P%i' % (i),
+                                 state=PROPOSAL_STATE_ACCEPTED,
+                                 amount=100 * rows_per_document,
+                                 update_date=today,
+                                 contract_content=u'Contract of project %i' % (i)) for i, project in enumerate(projects)])
+    invoices = insert([Invoice(owner=user,
+                               customer=customer,
+                               invoice_id=i + 1,
+                               state=INVOICE_STATE_PAID,
+                               amount=100 * rows_per_document,
+                               edition_date=today,
+                               payment_date=today,
+                               paid_date=today,
+                               payment_type=PAYMENT_TYPE_CHECK) for i, customer in enumerate(customers)])
+    insert([ProposalRow(owner=user,
+                        proposal=proposal,
+                        label='Day of work %i' % (i),
+                        category=ROW_CATEGORY_SERVICE,
+                        quantity=1,
+                        unit_price=100,
+                        amount=100,
+                        detail=u'Analysis, development and tests') for proposal in proposals for i in range(rows_per_document)])
+    insert([InvoiceRow(owner=user,
+                       invoice=invoice,
+                       proposal=proposal,
+                       label='Day of work %i' % (i),
+                       category=ROW_CATEGORY_SERVICE,
+                       quantity=1,
+                       unit_price=100,
+                       amount=100,
+                       balance_payments=False) for invoice, proposal in zip(invoices, proposals) for i in range(rows_per_document)])
+    insert([Expense(owner=user,
+                    date=today,
+                    reference='E%i' % (i),
+                    supplier='Supplier %i' % (i),
+                    amount=50,
+                    payment_type=PAYMENT_TYPE_CHECK,
+                    description='Office supplies') for i in range(customer_count)])
+
+class Command(BaseCommand):
+    args = '[customers]'
+    help = 'Compare size and speed of backup formats on a generated account, nothing is kept in database'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows',
+                    type='int',
+                    dest='rows',
+                    default=5,
+                    help='Rows of each proposal and invoice'),
+        make_option('--iterations',
+                    type='int',
+                    dest='iterations',
+                    default=3,
+                    help='Best time of this many runs is reported'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            customer_count = int(args[0]) if len(args) > 0 else 2000
+        except ValueError:
+            raise CommandError('customers must be an integer')
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            user = User.objects.create_user('benchmark_backup_format', 'benchmark@example.com')
+            create_account(user, customer_count, options['rows'])
+            models = dict([(model._meta.object_name, model) for model in [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]])
+
+            self.stdout.write("%i customers, %i rows per document\n" % (customer_count, options['rows']))
+            self.stdout.write("%-8s %10s %12s %10s %10s %8s\n" % ('format', 'size', 'compressed', 'write', 'read', 'records'))
+            for name, format_version in FORMATS:
+                write_times = []
+                read_times = []
+                for i in range(options['iterations']):
+                    backup_request = BackupRequest(user=user)
+                    backup_request.stream = StringIO()
+                    start = time.time()
+                    backup_request.backup_objects(format_version)
+                    write_times.append(time.time() - start)
+                    data = backup_request.stream.getvalue()
+
+                    start = time.time()
+                    record_count = 0
+                    for record in READERS[format_version](StringIO(data), models):
+                        record_count = record_count + 1
+                    read_times.append(time.time() - start)
+
+                compressed = StringIO()
+                file = gzip.GzipFile(fileobj=compressed, mode='w')
+                file.write(data)
+                file.close()
+
+                self.stdout.write("%-8s %10i %12i %9.3fs %9.3fs %8i\n" % (name,
+                                                                          len(data),
+                                                                          len(compressed.getvalue()),
+                                                                          min(write_times),
+                                                                          min(read_times),
+                                                                          record_count))
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
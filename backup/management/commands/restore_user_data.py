@@ -2,7 +2,6 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, \
     BACKUP_RESTORE_STATE_PENDING, RestoreRequest
-import datetime
 
 class Command(BaseCommand):
     help = 'Execute pending restore request'
@@ -22,11 +21,10 @@ class Command(BaseCommand):
 
         self.stdout.write("Can treat up to %i requests.\n" % (request_to_treat))
 
-        pending_requests = RestoreRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime')[:request_to_treat]
-        self.stdout.write("%i requests will be treated.\n" % (len(pending_requests)))
-        for request in pending_requests:
-            #request.state = BACKUP_RESTORE_STATE_IN_PROGRESS
-            request.last_state_datetime = datetime.datetime.now()
-            request.save()
-
+        for i in range(request_to_treat):
+            # claiming is atomic, overlapping runs never process the same request,
+            # progress of the request is its heartbeat for backup_worker
+            request = RestoreRequest.objects.claim_next()
+            if request is None:
+                break
             request.restore()
@@ -0,0 +1,157 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'RestoreRequest.started_datetime'
+        db.add_column('backup_restorerequest', 'started_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'RestoreRequest.progress_datetime'
+        db.add_column('backup_restorerequest', 'progress_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'RestoreRequest.progress_objects'
+        db.add_column('backup_restorerequest', 'progress_objects', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'RestoreRequest.progress_bytes'
+        db.add_column('backup_restorerequest', 'progress_bytes', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Adding field 'RestoreRequest.progress_model'
+        db.add_column('backup_restorerequest', 'progress_model', self.gf('django.db.models.fields.CharField')(max_length=50, null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.started_datetime'
+        db.add_column('backup_backuprequest', 'started_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.progress_datetime'
+        db.add_column('backup_backuprequest', 'progress_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.progress_objects'
+        db.add_column('backup_backuprequest', 'progress_objects', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'BackupRequest.progress_bytes'
+        db.add_column('backup_backuprequest', 'progress_bytes', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Adding field 'BackupRequest.progress_model'
+        db.add_column('backup_backuprequest', 'progress_model', self.gf('django.db.models.fields.CharField')(max_length=50, null=True, blank=True), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'RestoreRequest.started_datetime'
+        db.delete_column('backup_restorerequest', 'started_datetime')
+
+        # Deleting field 'RestoreRequest.progress_datetime'
+        db.delete_column('backup_restorerequest', 'progress_datetime')
+
+        # Deleting field 'RestoreRequest.progress_objects'
+        db.delete_column('backup_restorerequest', 'progress_objects')
+
+        # Deleting field 'RestoreRequest.progress_bytes'
+        db.delete_column('backup_restorerequest', 'progress_bytes')
+
+        # Deleting field 'RestoreRequest.progress_model'
+        db.delete_column('backup_restorerequest', 'progress_model')
+
+        # Deleting field 'BackupRequest.started_datetime'
+        db.delete_column('backup_backuprequest', 'started_datetime')
+
+        # Deleting field 'BackupRequest.progress_datetime'
+        db.delete_column('backup_backuprequest', 'progress_datetime')
+
+        # Deleting field 'BackupRequest.progress_objects'
+        db.delete_column('backup_backuprequest', 'progress_objects')
+
+        # Deleting field 'BackupRequest.progress_bytes'
+        db.delete_column('backup_backuprequest', 'progress_bytes')
+
+        # Deleting field 'BackupRequest.progress_model'
+        db.delete_column('backup_backuprequest', 'progress_model')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'backup.backupblob': {
+            'Meta': {'unique_together': "(('user', 'hash'),)", 'object_name': 'BackupBlob'},
+            'hash': ('django.db.models.fields.CharField', [], {'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'reference_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'size': ('django.db.models.fields.IntegerField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'backup.backuprequest': {
+            'Meta': {'object_name': 'BackupRequest'},
+            'creation_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'heartbeat_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'incremental': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_backup_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'last_state_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'progress_bytes': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'progress_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'progress_model': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'progress_objects': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'since_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'started_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'backup.restorerequest': {
+            'Meta': {'object_name': 'RestoreRequest'},
+            'action': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'backup_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'creation_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'heartbeat_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_state_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'progress_bytes': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'progress_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'progress_model': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'progress_objects': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'started_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['backup']
@@ -1,28 +1,56 @@
 import uuid
 import datetime
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import shutil
 import tarfile
-import gzip
+import tempfile
+import time
+from StringIO import StringIO
 
-from xml.dom import pulldom
-from django.db import models, transaction
+from django.db import models, transaction, connection, DEFAULT_DB_ALIAS, \
+    DatabaseError
+from django.db.utils import ConnectionHandler
+from django.db.models.aggregates import Sum
+from django.db.models.query_utils import Q
+from django.db.models.expressions import F
 from django.contrib.auth.models import User
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext_lazy as _, ugettext
 from contact.models import Contact, PhoneNumber, Address, Country
-from core.models import OwnedObject
-from project.models import Contract, Project, Proposal, ProposalRow
-from accounts.models import Invoice, InvoiceRow, Expense
+from core.models import OwnedObject, purge_owned_objects
+from project.models import Contract, Project, Proposal, ProposalRow, \
+    update_row_amount
+from accounts.models import Invoice, InvoiceRow, Expense, MAX_INVOICE_ID, \
+    InvalidInvoiceIdError, InvoiceIdNotUniqueError
 import unicodedata
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.utils.encoding import smart_unicode
-from django.utils.xmlutils import SimplerXMLGenerator
 from core.context_processors import common
+from backup.utils.format import BACKUP_FORMAT_VERSION, BACKUP_FORMAT_XML, \
+    BACKUP_DATA_FILENAMES, BACKUP_MANIFEST_FILENAME, READERS, write_xml, \
+    write_json
+from backup.utils.archive import ParallelGzipFile, is_compressed, \
+    compress_member, COMPRESSION_LEVEL, STORE_LEVEL
+from backup.utils.blobs import BlobStore, BLOB_CHUNK_SIZE
+from django.db.models.fields import AutoField
 from django.db.models.fields.related import ForeignKey, OneToOneField
+from django.db.models.fields.files import FileField
 import os
 import errno
-from django.core.serializers.xml_serializer import getInnerText
 from django.core.mail import mail_admins
+from django.utils import simplejson
+import logging
+
+# size up to which data.xml is kept in memory while the archive is built
+BACKUP_SPOOL_SIZE = 8 * 1024 * 1024
+# end of a downloaded archive
+TAR_END_MEMBER = compress_member(tarfile.NUL * tarfile.BLOCKSIZE * 2, COMPRESSION_LEVEL, 0)
+# objects restored with one query per table, with two references per object
+# lookups stay below the limit of 999 variables per query of sqlite
+RESTORE_BATCH_SIZE = 300
+# seconds between two writes of the progress of a request
+PROGRESS_INTERVAL = 2
 
 BACKUP_RESTORE_STATE_PENDING = 1
 BACKUP_RESTORE_STATE_IN_PROGRESS = 2
@@ -33,6 +61,11 @@ BACKUP_RESTORE_STATE = ((BACKUP_RESTORE_STATE_PENDING, _('Pending')),
                         (BACKUP_RESTORE_STATE_DONE, _('Done')),
                         (BACKUP_RESTORE_STATE_ERROR, _('Error')))
 
+logger = logging.getLogger('backup')
+
+# connections of their own to record progress of requests
+progress_connections = ConnectionHandler(settings.DATABASES)
+
 def mkdir_p(dir):
     try:
         os.makedirs(dir)
@@ -42,75 +75,439 @@ def mkdir_p(dir):
         else:
             raise
 
+class BackupRow(object):
+    """
+    Row of a values() query seen as an object by field.value_to_string
+    """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def get_column_values(object, fields, add):
+    return [field.get_db_prep_save(field.pre_save(object, add), connection=connection) for field in fields]
+
+def insert_owned_objects(objects):
+    """
+    Inserts new objects of a model inheriting from OwnedObject with one
+    executemany per table, without sending signals. Sets pk of objects.
+    """
+    if not objects:
+        return
+    model = objects[0].__class__
+    for object in objects:
+        # ids are read back by uuid
+        object.uuid = unicode(object.uuid)
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table_model in (OwnedObject, model):
+        fields = [field for field in table_model._meta.local_fields if not isinstance(field, AutoField)]
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (qn(table_model._meta.db_table),
+                                                                ', '.join([qn(field.column) for field in fields]),
+                                                                ', '.join(['%s'] * len(fields))),
+                           [get_column_values(object, fields, True) for object in objects])
+        if table_model == OwnedObject:
+            ids = dict(OwnedObject.objects.filter(uuid__in=[object.uuid for object in objects]).values_list('uuid', 'id'))
+            for object in objects:
+                object.id = object.ownedobject_ptr_id = ids[object.uuid]
+    transaction.commit_unless_managed()
+
+def update_owned_objects(objects):
+    """
+    Updates existing objects of a model inheriting from OwnedObject with one
+    executemany per table, without sending signals.
+    """
+    if not objects:
+        return
+    model = objects[0].__class__
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table_model in (OwnedObject, model):
+        pk = table_model._meta.pk
+        fields = [field for field in table_model._meta.local_fields if not field.primary_key]
+        cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (qn(table_model._meta.db_table),
+                                                               ', '.join(['%s = %%s' % (qn(field.column)) for field in fields]),
+                                                               qn(pk.column)),
+                           [get_column_values(object, fields, False) + [object.pk] for object in objects])
+    transaction.commit_unless_managed()
+
+def replace_m2m_links(field, links):
+    """
+    Replaces related objects of a many to many field, links maps object ids
+    to related object ids
+    """
+    qn = connection.ops.quote_name
+    table = qn(field.m2m_db_table())
+    column = qn(field.m2m_column_name())
+    reverse_column = qn(field.m2m_reverse_name())
+    symmetrical = field.rel.symmetrical and field.rel.to == field.model
+    rows = set()
+    for id, related_ids in links.items():
+        for related_id in related_ids:
+            rows.add((id, related_id))
+            # mirror entries of a symmetrical relation to self
+            if symmetrical:
+                rows.add((related_id, id))
+
+    cursor = connection.cursor()
+    for ids in chunks(links.keys(), RESTORE_BATCH_SIZE):
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table, column, placeholders), ids)
+        if symmetrical:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table, reverse_column, placeholders), ids)
+    cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (table, column, reverse_column),
+                       list(rows))
+    transaction.commit_unless_managed()
+
+class BackupTarInfo(tarfile.TarInfo):
+    def setNothing(self, value):
+        pass
+
+    def getUid(self):
+        return 10000
+
+    def getGid(self):
+        return 1000
+
+    def getUname(self):
+        return 'aemanager'
+
+    def getGname(self):
+        return 'aemanager'
+
+    uid = property(getUid, setNothing)
+    gid = property(getGid, setNothing)
+    uname = property(getUname, setNothing)
+    gname = property(getGname, setNothing)
+
+class RequestProgress(object):
+    """
+    Counts objects and bytes processed by a backup or restore request and
+    records them on its row, at most every PROGRESS_INTERVAL seconds.
+    Recording progress is also the heartbeat of the request, whether it
+    runs in backup_worker or in a cron command, so it is not queued again
+    as stale while it is processed.
+    Durations of phases are kept for the logs of the worker.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        now = datetime.datetime.now()
+        request.started_datetime = now
+        request.progress_datetime = now
+        request.heartbeat_datetime = now
+        request.progress_objects = 0
+        request.progress_bytes = 0
+        request.progress_model = None
+        self.last_save = time.time()
+        # (name, seconds)
+        self.phases = []
+        self.phase_name = None
+        self.phase_start = None
+
+    def get_connection(self):
+        """
+        A restore runs in a transaction, its progress is written with
+        another connection to be seen before the end. sqlite only allows
+        one writer, progress is written with the connection of the request.
+        """
+        if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            return connection
+        return progress_connections[DEFAULT_DB_ALIAS]
+
+    def phase(self, name):
+        """
+        Ends the running phase and starts phase name
+        """
+        now = time.time()
+        if self.phase_name:
+            self.phases.append((self.phase_name, now - self.phase_start))
+        self.phase_name = name
+        self.phase_start = now
+        self.save_if_needed()
+
+    def add_objects(self, count, model_name):
+        self.request.progress_objects = self.request.progress_objects + count
+        self.request.progress_model = model_name
+        self.save_if_needed()
+
+    def add_bytes(self, count):
+        self.request.progress_bytes = self.request.progress_bytes + count
+        self.save_if_needed()
+
+    def save_if_needed(self):
+        if time.time() - self.last_save >= PROGRESS_INTERVAL:
+            self.save()
+
+    def save(self):
+        self.last_save = time.time()
+        self.request.progress_datetime = datetime.datetime.now()
+        self.request.heartbeat_datetime = self.request.progress_datetime
+        progress_connection = self.get_connection()
+        model = self.request.__class__
+        fields = [model._meta.get_field(name) for name in ['progress_datetime', 'heartbeat_datetime', 'progress_objects', 'progress_bytes', 'progress_model']]
+        qn = progress_connection.ops.quote_name
+        try:
+            cursor = progress_connection.cursor()
+            cursor.execute('UPDATE %s SET %s WHERE %s = %%s' % (qn(model._meta.db_table),
+                                                               ', '.join(['%s = %%s' % (qn(field.column)) for field in fields]),
+                                                               qn(model._meta.pk.column)),
+                           [field.get_db_prep_save(getattr(self.request, field.attname), connection=progress_connection) for field in fields] + [self.request.pk])
+            if progress_connection is connection:
+                transaction.commit_unless_managed()
+            else:
+                progress_connection._commit()
+        except DatabaseError as e:
+            # progress is only informative
+            if progress_connection is not connection:
+                progress_connection._rollback()
+            logger.debug('Progress of %s not recorded: %s' % (self.request, e))
+
+    def finish(self):
+        """
+        Ends the running phase, the request is saved by its owner
+        """
+        self.phase(None)
+        self.request.progress_datetime = datetime.datetime.now()
+        self.request.progress_model = None
+
+    def get_timings(self):
+        return ', '.join(['%s %.2fs' % (name, seconds) for name, seconds in self.phases])
+
+def total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def get_progress(request):
+    """
+    Returns progress of a backup or restore request with its throughput
+    """
+    elapsed = 0
+    if request.started_datetime:
+        if request.state == BACKUP_RESTORE_STATE_IN_PROGRESS:
+            end = datetime.datetime.now()
+        else:
+            end = request.progress_datetime or request.started_datetime
+        elapsed = max(total_seconds(end - request.started_datetime), 0)
+    progress = {'state': request.state,
+                'state_display': unicode(request.get_state_display()),
+                'objects': request.progress_objects,
+                'bytes': request.progress_bytes,
+                'model': request.progress_model,
+                'elapsed': elapsed,
+                'objects_per_second': 0,
+                'bytes_per_second': 0}
+    if elapsed:
+        progress['objects_per_second'] = request.progress_objects / elapsed
+        progress['bytes_per_second'] = request.progress_bytes / elapsed
+    return progress
+
+class BackupRestoreRequestManager(models.Manager):
+    def claim(self, request_id):
+        """
+        Switches a pending request to in progress. The state is checked
+        and changed by a single update so a request is only claimed once
+        even by concurrent workers.
+        """
+        now = datetime.datetime.now()
+        return self.filter(pk=request_id,
+                           state=BACKUP_RESTORE_STATE_PENDING).update(state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                                                      last_state_datetime=now,
+                                                                      heartbeat_datetime=now) == 1
+
+    def claim_next(self):
+        """
+        Returns the oldest pending request once claimed, None if there is
+        no pending request left
+        """
+        while True:
+            pending = list(self.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime').values_list('pk', flat=True)[:10])
+            if not pending:
+                return None
+            for request_id in pending:
+                if self.claim(request_id):
+                    return self.get(pk=request_id)
+
+    def heartbeat(self, request_ids):
+        """
+        Records that requests are still being processed
+        """
+        if not request_ids:
+            return 0
+        return self.filter(pk__in=request_ids,
+                           state=BACKUP_RESTORE_STATE_IN_PROGRESS).update(heartbeat_datetime=datetime.datetime.now())
+
+    def recover_stale(self, timeout):
+        """
+        Puts back in the queue requests in progress without heartbeat
+        for timeout seconds, their worker is considered dead.
+        Requests claimed before heartbeats existed are checked on their
+        last state change.
+        """
+        limit = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        return self.filter(Q(heartbeat_datetime__lt=limit) | Q(heartbeat_datetime__isnull=True, last_state_datetime__lt=limit),
+                           state=BACKUP_RESTORE_STATE_IN_PROGRESS).update(state=BACKUP_RESTORE_STATE_PENDING,
+                                                                          last_state_datetime=datetime.datetime.now())
+
+class BackupBlobManager(models.Manager):
+    def add_references(self, user, sizes):
+        """
+        Counts one more archive referencing blobs of user,
+        sizes maps hashes to sizes of contents
+        """
+        hashes = sizes.keys()
+        for chunk in chunks(hashes, RESTORE_BATCH_SIZE):
+            existing = set(self.filter(user=user, hash__in=chunk).values_list('hash', flat=True))
+            for hash in chunk:
+                if hash not in existing:
+                    self.create(user=user, hash=hash, size=sizes[hash])
+            self.filter(user=user, hash__in=chunk).update(reference_count=F('reference_count') + 1)
+
+    def release(self, user, hashes):
+        """
+        Counts one less archive referencing blobs of user,
+        returns hashes of blobs no longer referenced
+        """
+        unreferenced = []
+        for chunk in chunks(list(hashes), RESTORE_BATCH_SIZE):
+            self.filter(user=user, hash__in=chunk).update(reference_count=F('reference_count') - 1)
+            blobs = self.filter(user=user, hash__in=chunk, reference_count__lte=0)
+            unreferenced.extend(blobs.values_list('hash', flat=True))
+            blobs.delete()
+        return unreferenced
+
+class BackupBlob(models.Model):
+    """
+    Content of uploaded files shared by backup archives of a user
+    """
+    user = models.ForeignKey(User)
+    hash = models.CharField(max_length=40)
+    size = models.IntegerField()
+    # archives whose manifest lists the blob
+    reference_count = models.IntegerField(default=0)
+
+    objects = BackupBlobManager()
+
+    class Meta:
+        unique_together = (('user', 'hash'),)
+
 class BackupRequest(models.Model):
     user = models.OneToOneField(User)
     state = models.IntegerField(choices=BACKUP_RESTORE_STATE, default=BACKUP_RESTORE_STATE_PENDING)
     creation_datetime = models.DateTimeField()
     last_state_datetime = models.DateTimeField()
+    heartbeat_datetime = models.DateTimeField(null=True, blank=True)
     error_message = models.CharField(max_length=255, null=True, blank=True)
+    # progress, recorded while the request is in progress
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    progress_datetime = models.DateTimeField(null=True, blank=True)
+    progress_objects = models.IntegerField(default=0)
+    progress_bytes = models.BigIntegerField(default=0)
+    progress_model = models.CharField(max_length=50, null=True, blank=True)
+    incremental = models.BooleanField(default=False, verbose_name=_('Only changes since previous backup'), help_text=_('To restore it, upload your previous backups followed by this one, concatenated in a single file'))
+    # changes since this datetime are in the archive, None for a full backup
+    since_datetime = models.DateTimeField(null=True, blank=True)
+    # start of the last successful backup, base of the next incremental one
+    last_backup_datetime = models.DateTimeField(null=True, blank=True)
+
+    objects = BackupRestoreRequestManager()
 
     def is_done(self):
         return self.state == BACKUP_RESTORE_STATE_DONE
 
     def get_backup_filename(self):
+        if self.since_datetime:
+            return 'backup_%s_since_%s.tar.gz' % (self.creation_datetime.strftime('%Y%m%d%H%M'),
+                                                  self.since_datetime.strftime('%Y%m%d%H%M'))
         return 'backup_%s.tar.gz' % (self.creation_datetime.strftime('%Y%m%d%H%M'))
 
     def backup(self):
 
-        class BackupTarInfo(tarfile.TarInfo):
-            def setNothing(self, value):
-                pass
-
-            def getUid(self):
-                return 10000
-
-            def getGid(self):
-                return 1000
-
-            def getUname(self):
-                return 'aemanager'
-
-            def getGname(self):
-                return 'aemanager'
-
-            uid = property(getUid, setNothing)
-            gid = property(getGid, setNothing)
-            uname = property(getUname, setNothing)
-            gname = property(getGname, setNothing)
-
         self.state = BACKUP_RESTORE_STATE_IN_PROGRESS
         self.last_state_datetime = datetime.datetime.now()
+        # objects changed while serializing will be in the next increment
+        started = datetime.datetime.now()
+        if self.incremental:
+            self.since_datetime = self.last_backup_datetime
+        else:
+            self.since_datetime = None
+        self.progress = RequestProgress(self)
         self.save()
 
-        self.backup_dir = '%s%s/backup/backup_%s' % (settings.FILE_UPLOAD_DIR,
-                                                     self.user.get_profile().uuid,
-                                                     self.creation_datetime.strftime('%Y%m%d%H%M'))
+        backup_dir = self.get_backup_dir()
+        backup_filename = '%s/%s' % (backup_dir, self.get_backup_filename())
+        file = None
+        # the archive and blobs of uploaded files are compressed by chunks
+        # in the same threads
+        pool = ThreadPool(cpu_count())
+        # blobs written by this backup and blobs it references,
+        # released if it fails
+        self.added_blobs = set()
+        references = None
         try:
-            # delete previous export dir
-            shutil.rmtree('%s%s/backup' % (settings.FILE_UPLOAD_DIR,
-                                           self.user.get_profile().uuid),
-                                           True)
-
             # create export dir
-            mkdir_p(self.backup_dir)
+            mkdir_p(backup_dir)
+
+            # an archive of the same minute is replaced
+            if os.path.exists(backup_filename):
+                self.delete_archive(backup_filename)
+
+            # the archive is written in one pass, uploaded files
+            # are in the blob store and listed in a manifest
+            file = ParallelGzipFile(backup_filename, pool=pool)
+            tar = tarfile.TarFile(mode='w', fileobj=file, tarinfo=BackupTarInfo)
+
+            tarinfo = BackupTarInfo('backup')
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0755
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo)
 
             # backup objects
-            self.stream = open("%s/data.xml" % (self.backup_dir), 'w')
+            # tar headers hold the size of the member, so data is
+            # spooled, in memory unless it is really big
+            self.progress.phase('objects')
+            self.stream = tempfile.SpooledTemporaryFile(BACKUP_SPOOL_SIZE)
             self.backup_objects()
+            tarinfo = BackupTarInfo(BACKUP_DATA_FILENAMES[BACKUP_FORMAT_VERSION])
+            tarinfo.size = self.stream.tell()
+            self.progress.add_bytes(tarinfo.size)
+            tarinfo.mode = 0644
+            tarinfo.mtime = time.time()
+            self.stream.seek(0)
+            tar.addfile(tarinfo, self.stream)
             self.stream.close()
 
             # backup files
-            self.backup_files()
+            self.progress.phase('files')
+            manifest = self.backup_files(tar, pool)
 
-            # create the archive
-            file = gzip.GzipFile('%s.tar.gz' % (self.backup_dir), 'w')
-            tar = tarfile.TarFile(mode='w', fileobj=file, tarinfo=BackupTarInfo)
-            tar.add(self.backup_dir, 'backup')
-            tar.close()
+            # the end of archive is written by the download,
+            # after files of the manifest
+            self.progress.phase('compression')
             file.close()
 
+            references = dict([(entry['hash'], entry['size']) for entry in manifest])
+            BackupBlob.objects.add_references(self.user, references)
+            # served as is, a later backup can't remove its blobs
+            # while it is downloaded
+            self.progress.phase('download')
+            self.build_download()
+            self.progress.phase('retention')
+            self.delete_old_archives()
+
             self.state = BACKUP_RESTORE_STATE_DONE
+            self.last_backup_datetime = started
         except Exception as e:
+            if file:
+                file.abort()
+            if os.path.exists(backup_filename):
+                os.remove(backup_filename)
+            download_path = self.get_download_path()
+            if os.path.exists(download_path):
+                os.remove(download_path)
+            self.rollback_blobs(references)
             self.state = BACKUP_RESTORE_STATE_ERROR
             self.error_message = unicode(e)
             mail_subject = _('Backup failed')
@@ -118,79 +515,318 @@ class BackupRequest(models.Model):
                                                                                          'message': e}
             mail_admins(mail_subject, mail_message, fail_silently=(not settings.DEBUG))
 
-        shutil.rmtree(self.backup_dir, True)
+        pool.terminate()
+        pool.join()
+        self.progress.finish()
         self.last_state_datetime = datetime.datetime.now()
         self.save()
 
-    def indent(self, level):
-        self.xml.ignorableWhitespace('\n' + ' ' * 4 * level)
+    def get_backup_lookups(self, model):
+        """
+        Returns local fields of model with the values() lookup reading
+        their exported value, related objects are exported by uuid
+        (country code for countries)
+        """
+        lookups = []
+        for field in model._meta.local_fields:
+            if field.name not in ['ownedobject_ptr']:
+                if type(field) == ForeignKey and field.rel.to == Country:
+                    lookup = '%s__country_code2' % (field.name)
+                elif type(field) == ForeignKey or type(field) == OneToOneField:
+                    lookup = '%s__uuid' % (field.name)
+                else:
+                    lookup = field.attname
+                lookups.append((field, lookup))
+        return lookups
 
-    def backup_objects(self):
-        models = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
+    def get_backup_queryset(self, model):
+        objects = model.objects.filter(owner=self.user)
+        if model == Address:
+            # do not export address of user profile
+            objects = objects.filter(userprofile__isnull=True)
+        return objects
 
-        self.xml = SimplerXMLGenerator(self.stream, settings.DEFAULT_CHARSET)
-        self.xml.startDocument()
-        self.xml.startElement("aemanager", {"version" : common()['version']})
+    def get_backup_m2m(self, model, field):
+        """
+        Returns uuids of objects related through field, by object pk
+        """
+        related = {}
+        through = field.rel.through
+        rows = through.objects.filter(**{'%s__owner' % (field.m2m_field_name()): self.user})\
+                              .values_list(field.m2m_field_name(), '%s__uuid' % (field.m2m_reverse_field_name()))\
+                              .order_by(field.m2m_reverse_field_name())
+        for pk, uuid in rows:
+            related.setdefault(pk, []).append(uuid)
+        return related
 
+    def get_backup_records(self, models):
+        """
+        Yields records of objects of models, see backup.utils.format
+        """
         for model in models:
-            for object in model.objects.filter(owner=self.user):
-                # do not export address of user profile
-                if not(type(object) == Address and object.userprofile_set.count()):
-                    self.indent(1)
-                    self.xml.startElement(object._meta.object_name, {'uuid': object.uuid})
-                    for field in object._meta.local_fields:
-                        if field.name not in ['ownedobject_ptr']:
-                            self.indent(2)
-                            self.xml.startElement(field.name, {})
-                            if getattr(object, field.name) is not None:
-                                if type(field) == ForeignKey:
-                                    related = getattr(object, field.name)
-                                    if type(related) == Country:
-                                        self.xml.addQuickElement("object", attrs={
-                                          'country_code' : smart_unicode(related.country_code2)
-                                        })
-                                    else:
-                                        self.xml.addQuickElement("object", attrs={
-                                          'uuid' : smart_unicode(related.uuid)
-                                        })
-                                elif type(field) == OneToOneField:
-                                    related = getattr(object, field.name)
-                                    self.xml.addQuickElement("object", attrs={
-                                      'uuid' : smart_unicode(related.uuid)
-                                    })
-                                else:
-                                    self.xml.characters(field.value_to_string(object))
-                            else:
-                                self.xml.addQuickElement("None")
-                            self.xml.endElement(field.name)
-
-                    for field in object._meta.many_to_many:
-                        self.indent(2)
-                        self.xml.startElement(field.name, {})
-                        for relobj in getattr(object, field.name).iterator():
-                            self.indent(3)
-                            self.xml.addQuickElement("object", attrs={
-                              'uuid' : smart_unicode(relobj.uuid)
-                            })
-                        self.indent(2)
-                        self.xml.endElement(field.name)
-
-                    self.indent(1)
-                    self.xml.endElement(smart_unicode(object._meta.object_name))
-
-        self.indent(0)
-        self.xml.endElement("aemanager")
-        self.xml.endDocument()
-
-    def backup_files(self):
+            # one query per model, related uuids are read through joins
+            lookups = self.get_backup_lookups(model)
+            objects = self.get_backup_queryset(model)
+            if self.since_datetime:
+                objects = objects.filter(modification_datetime__gte=self.since_datetime)
+            objects = objects.values('pk', 'uuid', *[lookup for field, lookup in lookups])
+            m2m_fields = [(field, self.get_backup_m2m(model, field)) for field in model._meta.many_to_many]
+
+            for values in objects.iterator():
+                # fields read their value from attributes named after their attname
+                row = BackupRow(values)
+                fields = []
+                for field, lookup in lookups:
+                    value = values[lookup]
+                    if value is None and isinstance(field, FileField):
+                        # empty files are exported as empty strings
+                        value = ''
+                    if value is not None:
+                        if type(field) == ForeignKey and field.rel.to == Country:
+                            value = {'country_code': smart_unicode(value)}
+                        elif type(field) == ForeignKey or type(field) == OneToOneField:
+                            value = {'uuid': smart_unicode(value)}
+                        else:
+                            value = field.value_to_string(row)
+                    fields.append((field.name, value))
+
+                yield {'model': model,
+                       'uuid': values['uuid'],
+                       'fields': fields,
+                       'm2m': [(field.name, [smart_unicode(uuid) for uuid in related.get(values['pk'], [])]) for field, related in m2m_fields]}
+
+        if self.since_datetime:
+            # objects deleted since the base backup are the ones missing
+            # from these lists
+            for model in models:
+                yield {'existing': model,
+                       'uuids': self.get_backup_queryset(model).values_list('uuid', flat=True).iterator()}
+
+    def backup_objects(self, format_version=BACKUP_FORMAT_VERSION):
+        models = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
+        records = self.get_backup_records(models)
+        if getattr(self, 'progress', None):
+            records = self.count_records(records)
+        if format_version == BACKUP_FORMAT_XML:
+            write_xml(self.stream, records, common()['version'], self.since_datetime)
+        else:
+            write_json(self.stream, records, common()['version'], models, self.since_datetime)
+
+    def count_records(self, records):
+        for record in records:
+            if 'model' in record:
+                self.progress.add_objects(1, record['model']._meta.object_name)
+            yield record
+
+    def backup_files(self, tar, pool=None):
+        """
+        Stores uploaded files in the blob store, compressed by the threads
+        of pool, and adds to tar the manifest listing them, returns entries
+        of the manifest
+        """
         dirs = ['contract', 'logo', 'proposal']
+        since = None
+        if self.since_datetime:
+            since = time.mktime(self.since_datetime.timetuple())
+        blob_store = self.get_blob_store()
+        # files unchanged since a kept archive are not hashed again
+        known_entries = {}
+        current_path = '%s/%s' % (self.get_backup_dir(), self.get_backup_filename())
+        for path in self.get_archives():
+            if path == current_path:
+                continue
+            for entry in self.read_manifest(path):
+                known_entries[entry['path']] = entry
+        manifest = []
         for dir in dirs:
             from_path = '%s%s/%s' % (settings.FILE_UPLOAD_DIR,
                                       self.user.get_profile().uuid,
                                       dir)
-            to_path = '%s/%s' % (self.backup_dir, dir)
             if os.path.exists(from_path):
-                shutil.copytree(from_path, to_path)
+                if since is None:
+                    tar.add(from_path, 'backup/%s' % (dir), recursive=False)
+                for root, dirnames, filenames in os.walk(from_path):
+                    if since is None:
+                        for dirname in dirnames:
+                            path = os.path.join(root, dirname)
+                            tar.add(path, 'backup/%s%s' % (dir, path[len(from_path):]), recursive=False)
+                    for filename in filenames:
+                        path = os.path.join(root, filename)
+                        stat = os.stat(path)
+                        if since is None or stat.st_mtime >= since:
+                            entry = {'path': '%s%s' % (dir, path[len(from_path):]),
+                                     'size': stat.st_size,
+                                     'mtime': int(stat.st_mtime),
+                                     'mode': stat.st_mode & 07777}
+                            known_entry = known_entries.get(entry['path'])
+                            hash = None
+                            if known_entry and known_entry['size'] == entry['size'] \
+                            and known_entry['mtime'] == entry['mtime']:
+                                hash = known_entry['hash']
+                            # compressing pdf or images again is a waste of time
+                            if is_compressed(filename):
+                                level = STORE_LEVEL
+                            else:
+                                level = COMPRESSION_LEVEL
+                            # the file may be written while it is stored, the tar
+                            # header of the download takes the size of the blob
+                            entry['hash'], entry['size'], added = blob_store.add(path, level, hash, entry['size'], pool)
+                            if added:
+                                self.added_blobs.add(entry['hash'])
+                            manifest.append(entry)
+                            self.progress.add_bytes(entry['size'])
+
+        data = simplejson.dumps({'files': manifest})
+        tarinfo = BackupTarInfo(BACKUP_MANIFEST_FILENAME)
+        tarinfo.size = len(data)
+        tarinfo.mode = 0644
+        tarinfo.mtime = time.time()
+        tar.addfile(tarinfo, StringIO(data))
+        return manifest
+
+    def get_backup_dir(self):
+        return '%s%s/backup' % (settings.FILE_UPLOAD_DIR,
+                                self.user.get_profile().uuid)
+
+    def get_blob_store(self):
+        return BlobStore('%s%s/blobs' % (settings.FILE_UPLOAD_DIR,
+                                         self.user.get_profile().uuid))
+
+    def get_archives(self):
+        """
+        Returns paths of kept archives, oldest first
+        """
+        backup_dir = self.get_backup_dir()
+        if not os.path.exists(backup_dir):
+            return []
+        return ['%s/%s' % (backup_dir, filename) for filename in sorted(os.listdir(backup_dir)) \
+                if filename.startswith('backup_') and filename.endswith('.tar.gz')]
+
+    def get_archive_filenames(self):
+        """
+        Returns filenames of kept archives, newest first
+        """
+        return [os.path.basename(path) for path in reversed(self.get_archives())]
+
+    def get_download_dir(self):
+        return '%s/download' % (self.get_backup_dir())
+
+    def get_download_path(self, filename=None):
+        return '%s/%s' % (self.get_download_dir(), filename or self.get_backup_filename())
+
+    def read_manifest(self, path):
+        """
+        Returns entries of the manifest of the archive at path, archives
+        made before blobs hold their files and have no manifest
+        """
+        tar = tarfile.open(path, 'r:gz')
+        try:
+            try:
+                member = tar.getmember(BACKUP_MANIFEST_FILENAME)
+            except KeyError:
+                return []
+            return simplejson.loads(tar.extractfile(member).read())['files']
+        finally:
+            tar.close()
+
+    def delete_archive(self, path):
+        blob_store = self.get_blob_store()
+        hashes = set([entry['hash'] for entry in self.read_manifest(path)])
+        for hash in BackupBlob.objects.release(self.user, hashes):
+            blob_store.remove(hash)
+        download_path = self.get_download_path(os.path.basename(path))
+        if os.path.exists(download_path):
+            os.remove(download_path)
+        os.remove(path)
+
+    def delete_old_archives(self):
+        """
+        Keeps the last BACKUP_RETENTION_COUNT archives, blobs are
+        shared so old archives only cost files changed since
+        """
+        archives = self.get_archives()
+        for path in archives[:-settings.BACKUP_RETENTION_COUNT]:
+            self.delete_archive(path)
+
+    def rollback_blobs(self, references=None):
+        """
+        Releases references recorded by a failed backup and removes blobs
+        it wrote which no archive references
+        """
+        blob_store = self.get_blob_store()
+        unreferenced = set()
+        if references:
+            unreferenced.update(BackupBlob.objects.release(self.user, references.keys()))
+        added_blobs = list(getattr(self, 'added_blobs', []))
+        for chunk in chunks(added_blobs, RESTORE_BATCH_SIZE):
+            referenced = set(BackupBlob.objects.filter(user=self.user, hash__in=chunk).values_list('hash', flat=True))
+            unreferenced.update([hash for hash in chunk if hash not in referenced])
+        for hash in unreferenced:
+            blob_store.remove(hash)
+
+    def get_download_parts(self, filename=None):
+        """
+        Returns the downloadable archive as a list of parts to concatenate,
+        (True, path) for files and (False, data) for strings: the archive,
+        then a tar header and the blob of each file in the manifest and
+        the end of archive
+        """
+        path = '%s/%s' % (self.get_backup_dir(), filename or self.get_backup_filename())
+        blob_store = self.get_blob_store()
+        parts = [(True, path)]
+        for entry in self.read_manifest(path):
+            tarinfo = BackupTarInfo('backup/%s' % (entry['path']))
+            tarinfo.size = entry['size']
+            tarinfo.mode = entry['mode']
+            tarinfo.mtime = entry['mtime']
+            parts.append((False, compress_member(tarinfo.tobuf(), COMPRESSION_LEVEL, entry['mtime'])))
+            parts.append((True, blob_store.get_path(entry['hash'])))
+        parts.append((False, TAR_END_MEMBER))
+        return parts
+
+    def build_download(self, filename=None):
+        """
+        Writes the downloadable archive once, returns its path. Only the
+        downloads of the current archive and of filename are kept, older
+        archives are concatenated again when asked
+        """
+        filename = filename or self.get_backup_filename()
+        path = self.get_download_path(filename)
+        if os.path.exists(path):
+            return path
+        download_dir = self.get_download_dir()
+        mkdir_p(download_dir)
+        # downloads asked at the same time write files of their own
+        fd, temp_path = tempfile.mkstemp('.tmp', dir=download_dir)
+        file = os.fdopen(fd, 'wb')
+        try:
+            try:
+                for is_file, part in self.get_download_parts(filename):
+                    if is_file:
+                        part_file = open(part, 'rb')
+                        try:
+                            shutil.copyfileobj(part_file, file, BLOB_CHUNK_SIZE)
+                        finally:
+                            part_file.close()
+                    else:
+                        file.write(part)
+            finally:
+                file.close()
+        except:
+            os.remove(temp_path)
+            raise
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+        # a download served by X-Sendfile is still read if it is removed
+        kept = [filename, self.get_backup_filename()]
+        for other in os.listdir(download_dir):
+            if other not in kept and not other.endswith('.tmp'):
+                try:
+                    os.remove('%s/%s' % (download_dir, other))
+                except OSError as exc:
+                    if exc.errno != errno.ENOENT:
+                        raise
+        return path
 
 RESTORE_ACTION_ADD_MISSING = 1
 RESTORE_ACTION_ADD_AND_UPDATE = 2
@@ -210,7 +846,14 @@ class RestoreRequest(models.Model):
     action = models.IntegerField(choices=RESTORE_ACTION, verbose_name=_('Action'), default=RESTORE_ACTION_ADD_MISSING)
     creation_datetime = models.DateTimeField()
     last_state_datetime = models.DateTimeField()
+    heartbeat_datetime = models.DateTimeField(null=True, blank=True)
     error_message = models.CharField(max_length=255, null=True, blank=True)
+    # progress, recorded while the request is in progress
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    progress_datetime = models.DateTimeField(null=True, blank=True)
+    progress_objects = models.IntegerField(default=0)
+    progress_bytes = models.BigIntegerField(default=0)
+    progress_model = models.CharField(max_length=50, null=True, blank=True)
     backup_file = models.FileField(upload_to=restore_upload_to_handler,
                                    null=True,
                                    blank=True,
@@ -218,6 +861,8 @@ class RestoreRequest(models.Model):
                                    verbose_name=_('Backup file'),
                                    help_text=_('max. %(FILE_MAX_SIZE)s') % {'FILE_MAX_SIZE': settings.FILE_MAX_SIZE})
 
+    objects = BackupRestoreRequestManager()
+
     def __unicode__(self):
         return "%s %s %s" % (self.get_action_display(), self.get_state_display(), self.user)
 
@@ -237,18 +882,27 @@ class RestoreRequest(models.Model):
 
     def restore(self):
         self.state = BACKUP_RESTORE_STATE_IN_PROGRESS
+        self.progress = RequestProgress(self)
         self.save()
 
         transaction.commit_unless_managed()
         transaction.enter_transaction_management()
         transaction.managed(True)
         try:
-            self.tar = tarfile.open(self.backup_file.path, 'r:gz')
+            # a base backup followed by its increments can be concatenated
+            # in a single file, each archive ends with zero blocks
+            self.progress.phase('reading')
+            self.tar = tarfile.open(self.backup_file.path, 'r:gz', ignore_zeros=True)
 
-            # extract data.xml for parsing
-            self.stream = self.tar.extractfile('backup/data.xml')
+            # extract data of each archive for parsing
+            data_formats = dict([(filename, format_version) for format_version, filename in BACKUP_DATA_FILENAMES.items()])
+            self.streams = [(data_formats[member.name], self.tar.extractfile(member)) for member in self.tar.getmembers() if member.name in data_formats]
+            if not self.streams:
+                raise Exception('No data in backup file')
+            self.progress.phase('objects')
             self.restore_objects()
 
+            self.progress.phase('files')
             self.restore_files()
 
             transaction.commit()
@@ -264,6 +918,7 @@ class RestoreRequest(models.Model):
                                                                                          'message': e}
             mail_admins(mail_subject, mail_message, fail_silently=(not settings.DEBUG))
 
+        self.progress.finish()
         self.save()
 
         # close and delete archive
@@ -272,34 +927,25 @@ class RestoreRequest(models.Model):
         self.backup_file = None
 
     def restore_objects(self):
-        def get_clean_value(node, model_name, field):
-            value = field.to_python(get_inner_text(node))
-            clean_method_name = 'clean_%s_%s' % (model_name.lower(), node.nodeName)
+        def get_clean_value(value, model_name, field):
+            if not isinstance(value, basestring):
+                raise Exception('Invalid value for %s' % (field.name))
+            value = field.to_python(value)
+            clean_method_name = 'clean_%s_%s' % (model_name.lower(), field.name)
             if hasattr(self, clean_method_name):
                 clean_method = getattr(self, clean_method_name)
                 value = clean_method(value)
             return value
 
-        def get_inner_text(node):
-            """
-            Get all the inner text of a DOM node (recursively).
-            """
-            # inspired by http://mail.python.org/pipermail/xml-sig/2005-March/011022.html
-            inner_text = []
-            for child in node.childNodes:
-                if child.nodeType == child.TEXT_NODE:
-                    inner_text.append(child.data)
-                elif child.nodeType == child.ELEMENT_NODE:
-                    inner_text.extend(getInnerText(child))
-                else:
-                    pass
-            return u"".join(inner_text)
-
-        def check_object_exists(node, klass):
-            uuid = node.getAttribute('uuid')
-            try:
-                object = klass.objects.get(uuid=uuid)
-                if object.owner <> self.user:
+        def check_object_exists(record, klass, existing_objects):
+            uuid = record['uuid']
+            self.stream_uuids.add(uuid)
+            if uuid in self.restored_uuids:
+                # restored from a previous archive of the chain, update it
+                return existing_objects[self.substitution_map[uuid]]
+            object = existing_objects.get(uuid)
+            if object:
+                if object.owner_id <> self.user.id:
                     # import from another account, regenerate uuid to clone object
                     object = klass()
                     object.owner = self.user
@@ -307,100 +953,232 @@ class RestoreRequest(models.Model):
                     if self.action == RESTORE_ACTION_ADD_MISSING:
                         self.substitution_map[uuid] = object.uuid
                         object = None
-            except:
+            else:
                 # object not in database, can save it
                 object = klass()
                 object.uuid = uuid
                 object.owner = self.user
 
             if object:
+                object.uuid = unicode(object.uuid)
                 self.substitution_map[uuid] = object.uuid
 
             return object
 
-        def populate(object, node):
+        def get_references(record, object):
+            """
+            Returns uuids and country codes referenced by record
+            """
+            uuids = []
+            country_codes = []
+            for field_name, value in record['fields']:
+                if field_name in self.foreign_keys[object.__class__] and isinstance(value, dict):
+                    if self.foreign_keys[object.__class__][field_name].related.parent_model == Country:
+                        country_codes.append(value.get('country_code'))
+                    else:
+                        # objects unchanged since the base backup
+                        # are not in an incremental one
+                        uuid = value.get('uuid')
+                        uuids.append(self.substitution_map.get(uuid, uuid))
+            return uuids, country_codes
+
+        def populate(object, record, related_ids, country_ids):
             field_name_list = ['%s' % (field.name) for field in object._meta.local_fields if field.name <> 'ownedobject_ptr']
 
-            for child in node.childNodes:
-                field_name = child.nodeName
+            for field_name, value in record['fields']:
                 if field_name in field_name_list:
-                    if child.getElementsByTagName('None'):
-                        value = None
-                    else:
+                    if value is not None:
                         field = object._meta.get_field(field_name)
-                        value = get_clean_value(child, object._meta.object_name, field)
                         if type(field) == ForeignKey or type(field) == OneToOneField:
-                            objects = child.getElementsByTagName('object')
-                            if objects:
-                                if field.related.parent_model == Country:
-                                    country_code = objects[0].getAttribute('country_code')
-                                    related_object = Country.objects.get(country_code2=country_code)
-                                else:
-                                    uuid = objects[0].getAttribute('uuid')
-                                    try:
-                                        real_uuid = self.substitution_map[uuid]
-                                    except:
-                                        raise Exception('Reference to a missing object')
-                                    related_object = OwnedObject.objects.get(owner=self.user,
-                                                                             uuid=real_uuid)
-                                field_name = "%s_id" % (field_name)
-                                value = related_object.pk
+                            if not isinstance(value, dict):
+                                raise Exception('Reference to a missing object')
+                            if field.related.parent_model == Country:
+                                country_code = value.get('country_code')
+                                if country_code not in country_ids:
+                                    raise Country.DoesNotExist('Country matching query does not exist.')
+                                value = country_ids[country_code]
+                            else:
+                                uuid = value.get('uuid')
+                                real_uuid = self.substitution_map.get(uuid, uuid)
+                                if real_uuid not in related_ids:
+                                    raise Exception('Reference to a missing object')
+                                value = related_ids[real_uuid]
+                            field_name = "%s_id" % (field_name)
+                        else:
+                            value = get_clean_value(value, object._meta.object_name, field)
 
                     setattr(object, field_name, value)
 
-        def populate_m2m(object, node):
+            if isinstance(object, (ProposalRow, InvoiceRow)):
+                # done by a pre_save signal when saving rows one by one
+                update_row_amount(object.__class__, object)
+
+        def populate_m2m(object, record):
             m2m_field_list = ['%s' % (field.name) for field in object._meta.many_to_many]
             m2m_data = []
 
-            for child in node.childNodes:
-                field_name = child.nodeName
+            for field_name, uuids in record['m2m']:
                 if field_name in m2m_field_list:
                     field = object._meta.get_field(field_name)
-                    related_model = field.related.model
-                    objects = child.getElementsByTagName('object')
-                    uuids = []
-                    for related_obj in objects:
-                        uuids.append(related_obj.getAttribute('uuid'))
                     m2m_data.append({'object': object,
-                                     'field_name': field_name,
-                                     'related_model': related_model,
+                                     'field': field,
+                                     'related_model': field.related.model,
                                      'uuids': uuids})
 
             return m2m_data
 
-        def do_restore():
-            m2m_data = []
-            for event, node in self.event_stream:
-                if event == "START_ELEMENT" and node.nodeName in self.model_name_dict:
-                    self.event_stream.expandNode(node)
-                    object = check_object_exists(node, self.model_name_dict[node.nodeName])
-                    if object:
-                        populate(object, node)
-                        object.save(user=self.user)
-                        m2m_data = m2m_data + populate_m2m(object, node)
-
-            for m2m in m2m_data:
-                uuids = ['%s' % (self.substitution_map[uid]) for uid in m2m['uuids']]
-                related_objects = m2m['related_model'].objects.filter(owner=self.user,
-                                                                      uuid__in=uuids)
-
-                setattr(m2m['object'], m2m['field_name'], related_objects)
+        def check_invoice_ids(invoices):
+            taken_ids = dict(Invoice.objects.filter(owner=self.user,
+                                                    invoice_id__in=[invoice.invoice_id for invoice in invoices]).values_list('invoice_id', 'id'))
+            batch_ids = set()
+            for invoice in invoices:
+                if not invoice.isInvoiceIdValid():
+                    raise InvalidInvoiceIdError(ugettext('Invoice id must be less than or equal to %d') % (MAX_INVOICE_ID))
+                if invoice.invoice_id in batch_ids or taken_ids.get(invoice.invoice_id, invoice.id) <> invoice.id:
+                    raise InvoiceIdNotUniqueError(ugettext("Invoice id must be unique"))
+                batch_ids.add(invoice.invoice_id)
+
+        def restore_batch(klass, records):
+            uuids = [record['uuid'] for record in records]
+            uuids = uuids + [self.substitution_map[uuid] for uuid in uuids if uuid in self.restored_uuids]
+            existing_objects = dict([(object.uuid, object) for object in klass.objects.filter(uuid__in=uuids)])
+
+            objects = []
+            references = set()
+            country_codes = set()
+            for record in records:
+                object = check_object_exists(record, klass, existing_objects)
+                if object:
+                    objects.append((object, record))
+                    object_references, object_country_codes = get_references(record, object)
+                    references.update(object_references)
+                    country_codes.update(object_country_codes)
+
+            related_ids = {}
+            if references:
+                related_ids = dict(OwnedObject.objects.filter(owner=self.user,
+                                                              uuid__in=list(references)).values_list('uuid', 'id'))
+            country_ids = {}
+            if country_codes:
+                country_ids = dict(Country.objects.filter(country_code2__in=list(country_codes)).values_list('country_code2', 'id'))
+
+            for object, record in objects:
+                populate(object, record, related_ids, country_ids)
+                self.restored_uuids[record['uuid']] = klass
+                self.m2m_data = self.m2m_data + populate_m2m(object, record)
+            if klass == Invoice:
+                check_invoice_ids([object for object, record in objects])
+
+            insert_owned_objects([object for object, record in objects if not object.pk])
+            update_owned_objects([object for object, record in objects if object.pk])
+
+            for object, record in objects:
+                if klass == ProposalRow:
+                    self.updated_amounts[Proposal].add(object.proposal_id)
+                elif klass == InvoiceRow:
+                    self.updated_amounts[Invoice].add(object.invoice_id)
+
+        def restore_m2m():
+            related_uuids = {}
+            for m2m in self.m2m_data:
+                related_uuids.setdefault(m2m['related_model'], set()).update([self.substitution_map.get(uid, uid) for uid in m2m['uuids']])
+            related_ids = {}
+            for related_model, uuids in related_uuids.items():
+                related_ids[related_model] = {}
+                for uuids in chunks(list(uuids), RESTORE_BATCH_SIZE):
+                    related_ids[related_model].update(related_model.objects.filter(owner=self.user,
+                                                                                   uuid__in=uuids).values_list('uuid', 'id'))
+
+            fields = {}
+            for m2m in self.m2m_data:
+                ids = related_ids[m2m['related_model']]
+                uuids = [self.substitution_map.get(uid, uid) for uid in m2m['uuids']]
+                links = fields.setdefault(m2m['field'], {})
+                links[m2m['object'].pk] = [ids[uuid] for uuid in uuids if uuid in ids]
+
+            for field, links in fields.items():
+                replace_m2m_links(field, links)
+
+        def update_amounts():
+            # amounts of rows parents are computed once, not after each row
+            for model, row_model, field_name in ((Proposal, ProposalRow, 'proposal'),
+                                                 (Invoice, InvoiceRow, 'invoice')):
+                for ids in chunks(list(self.updated_amounts[model]), RESTORE_BATCH_SIZE):
+                    amounts = dict([(id, 0) for id in ids])
+                    for row in row_model.objects.filter(**{'%s__in' % (field_name): ids}).values(field_name).annotate(sum=Sum('amount')).order_by():
+                        amounts[row[field_name]] = row['sum'] or 0
+                    for id, amount in amounts.items():
+                        model.objects.filter(pk=id).update(amount=amount,
+                                                           modification_datetime=datetime.datetime.now())
 
         self.models = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
         self.model_name_dict = {}
+        self.foreign_keys = {}
         for model in self.models:
             self.model_name_dict[model._meta.object_name] = model
+            self.foreign_keys[model] = dict([(field.name, field) for field in model._meta.local_fields
+                                             if (type(field) == ForeignKey or type(field) == OneToOneField) and field.name <> 'ownedobject_ptr'])
 
-        self.event_stream = pulldom.parse(self.stream)
         self.substitution_map = {}
+        # uuid in backup -> model, for objects saved by this restore
+        self.restored_uuids = {}
+        self.m2m_data = []
+        # ids of proposals and invoices whose rows have been restored
+        self.updated_amounts = {Proposal: set(), Invoice: set()}
 
         if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE:
-            for model in self.models:
-                for object in model.objects.filter(owner=self.user):
-                    # do not export address of user profile
-                    if not(type(object) == Address and object.userprofile_set.count()):
-                        object.delete()
-        do_restore()
+            # address of user profile is kept
+            purge_owned_objects([self.user.id], self.models)
+
+        # uuids of objects present when the last archive was made
+        live_uuids = set()
+        for format_version, stream in self.streams:
+            existing_uuids = None
+            self.stream_uuids = set()
+            batch_model = None
+            batch = []
+            batch_uuids = set()
+            for record in READERS[format_version](stream, self.model_name_dict):
+                if 'existing' in record:
+                    # only in incremental backups
+                    if existing_uuids is None:
+                        existing_uuids = set()
+                    existing_uuids.update(record['uuids'])
+                    continue
+
+                klass = record['model']
+                self.progress.add_objects(1, klass._meta.object_name)
+                # a batch holds objects of one model, objects they reference
+                # are restored by previous batches since backups are ordered by model
+                if batch and (klass <> batch_model or len(batch) >= RESTORE_BATCH_SIZE or record['uuid'] in batch_uuids):
+                    restore_batch(batch_model, batch)
+                    batch = []
+                    batch_uuids = set()
+                batch_model = klass
+                batch.append(record)
+                batch_uuids.add(record['uuid'])
+            if batch:
+                restore_batch(batch_model, batch)
+            self.progress.add_bytes(stream.size)
+
+            if existing_uuids is None:
+                # full backup, every object is in it
+                live_uuids = self.stream_uuids
+            else:
+                live_uuids = existing_uuids
+
+        restore_m2m()
+        update_amounts()
+
+        # objects deleted after an archive of the chain was made
+        deleted_uuids = {}
+        for uuid, model in self.restored_uuids.items():
+            if uuid not in live_uuids:
+                deleted_uuids.setdefault(model, []).append(self.substitution_map[uuid])
+        for model in reversed(self.models):
+            if model in deleted_uuids:
+                for object in model.objects.filter(owner=self.user, uuid__in=deleted_uuids[model]):
+                    object.delete()
 
     def restore_files(self):
         paths = ['proposal', 'contract', 'logo']
@@ -412,6 +1190,7 @@ class RestoreRequest(models.Model):
                                           dir_path)
                 shutil.rmtree(target_dir, True)
 
+        written = set()
         for member in self.tar:
             dir_path = os.path.dirname(member.name).replace('backup/', '')
             if dir_path in paths:
@@ -423,8 +1202,11 @@ class RestoreRequest(models.Model):
                 target_filename = '%s/%s' % (target_dir,
                                               filename)
 
-                if not(self.action == RESTORE_ACTION_ADD_MISSING and os.path.exists(target_filename)):
+                # a file of an increment replaces the one of a previous archive
+                if target_filename in written or not(self.action == RESTORE_ACTION_ADD_MISSING and os.path.exists(target_filename)):
+                    written.add(target_filename)
                     target_file = open(target_filename, 'w')
                     file = self.tar.extractfile(member)
                     target_file.write(file.read())
                     target_file.close()
+                    self.progress.add_bytes(member.size)
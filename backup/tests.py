@@ -1,7 +1,9 @@
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_PENDING, \
     BACKUP_RESTORE_STATE_DONE, RESTORE_ACTION_ADD_MISSING, \
     RestoreRequest, RESTORE_ACTION_ADD_AND_UPDATE, \
-    RESTORE_ACTION_DELETE_ALL_AND_RESTORE, BACKUP_RESTORE_STATE_ERROR
+    RESTORE_ACTION_DELETE_ALL_AND_RESTORE, BACKUP_RESTORE_STATE_ERROR, \
+    BACKUP_RESTORE_STATE_IN_PROGRESS, BackupBlob, RequestProgress, \
+    PROGRESS_INTERVAL
 from django.contrib.auth.models import User
 import hashlib
 import tarfile
@@ -11,10 +13,10 @@ import os
 from django.conf import settings
 from django.core.management import call_command
 from project.models import Proposal, Project, PROPOSAL_STATE_ACCEPTED, \
-    ROW_CATEGORY_SERVICE, VAT_RATES_19_6
+    ROW_CATEGORY_SERVICE, VAT_RATES_19_6, ProposalRow, Contract
 from accounts.models import Invoice, INVOICE_STATE_PAID, PAYMENT_TYPE_CHECK, \
-    PAYMENT_TYPE_BANK_CARD, INVOICE_STATE_EDITED, InvoiceRow
-from contact.models import Contact, CONTACT_TYPE_COMPANY, Address
+    PAYMENT_TYPE_BANK_CARD, INVOICE_STATE_EDITED, InvoiceRow, Expense
+from contact.models import Contact, CONTACT_TYPE_COMPANY, Address, PhoneNumber
 from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_TRIAL
 from django.test.testcases import TransactionTestCase, TestCase
 from core.models import OwnedObject
@@ -22,6 +24,17 @@ from django.core.exceptions import SuspiciousOperation
 from django.core import mail
 from django.utils.translation import ugettext
 import datetime
+from StringIO import StringIO
+from django.db import connection
+from django.utils import simplejson
+from core.context_processors import common
+from backup.utils.format import BACKUP_FORMAT_XML, BACKUP_FORMAT_JSON, \
+    read_xml, read_json
+from backup.utils.archive import ParallelGzipFile, COMPRESSION_LEVEL
+import gzip
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 class BackupTest(TransactionTestCase):
     fixtures = ['backup_data']
@@ -62,6 +75,188 @@ class BackupTest(TransactionTestCase):
         self.assertTrue(os.path.exists(filename))
         self.assertNotEquals(os.path.getsize(filename), 0)
 
+    def testBackupArchiveContent(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        contract_file = open('%s/contract.pdf' % (contract_dir), 'w')
+        contract_file.write('contract content')
+        contract_file.close()
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        call_command('backup_user_data')
+
+        self.assertEquals(BackupRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+        backup_dir = '%s%s/backup' % (settings.FILE_UPLOAD_DIR,
+                                      self.user1.get_profile().uuid)
+        # no temporary copy is left next to the archive
+        filename = self.user1.backuprequest.get_backup_filename()
+        self.assertEquals(sorted(os.listdir(backup_dir)), [filename, 'download'])
+        self.assertEquals(os.listdir('%s/download' % (backup_dir)), [filename])
+
+        # files are written after the stored archive, once
+        # the backup is done, and served by the web server
+        response = self.client.get(reverse('backup_download'))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['X-Sendfile'], '%s/download/%s' % (backup_dir, filename))
+        tar = tarfile.open(response['X-Sendfile'], mode='r:gz')
+        self.assertEquals(set(tar.getnames()), set(['backup', 'backup/data.ndjson', 'backup/files.json', 'backup/contract', 'backup/contract/contract.pdf']))
+        self.assertEquals(tar.extractfile('backup/contract/contract.pdf').read(), 'contract content')
+        data = tar.extractfile('backup/data.ndjson').read()
+        header = simplejson.loads(data.splitlines()[0])
+        self.assertEquals(header['format_version'], BACKUP_FORMAT_JSON)
+        self.assertEquals(header['version'], common()['version'])
+        self.assertTrue(data.endswith('\n'))
+        self.assertEquals(tar.getmember('backup/data.ndjson').uname, 'aemanager')
+        tar.close()
+
+    def backup_at(self, creation_datetime):
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        BackupRequest.objects.filter(user=self.user1).update(creation_datetime=creation_datetime)
+        call_command('backup_user_data')
+        self.assertEquals(BackupRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+
+    def testArchivesShareFiles(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        for filename in ['contract.pdf', 'copy.pdf']:
+            contract_file = open('%s/%s' % (contract_dir, filename), 'w')
+            contract_file.write('contract content')
+            contract_file.close()
+        backup_dir = '%s%s/backup' % (settings.FILE_UPLOAD_DIR,
+                                      self.user1.get_profile().uuid)
+
+        retention_count = settings.BACKUP_RETENTION_COUNT
+        settings.BACKUP_RETENTION_COUNT = 2
+        try:
+            self.backup_at(datetime.datetime(2011, 1, 1))
+            self.backup_at(datetime.datetime(2011, 1, 2))
+            backup_request = BackupRequest.objects.get(user=self.user1)
+            blob_store = backup_request.get_blob_store()
+            # same content is stored once for both files and archives
+            blob = BackupBlob.objects.get(user=self.user1)
+            self.assertEquals(blob.hash, hashlib.sha1('contract content').hexdigest())
+            self.assertEquals(blob.reference_count, 2)
+            self.assertTrue(blob_store.exists(blob.hash))
+            self.assertEquals(backup_request.get_archive_filenames(), ['backup_201101020000.tar.gz',
+                                                                       'backup_201101010000.tar.gz'])
+
+            # older archives can be downloaded too
+            response = self.client.get(reverse('backup_download'), {'archive': 'backup_201101010000.tar.gz'})
+            self.assertEquals(response.status_code, 200)
+            tar = tarfile.open(response['X-Sendfile'], mode='r:gz')
+            self.assertEquals(tar.extractfile('backup/contract/copy.pdf').read(), 'contract content')
+            tar.close()
+            response = self.client.get(reverse('backup_download'), {'archive': '../../contract/contract.pdf'})
+            self.assertEquals(response.status_code, 404)
+
+            os.remove('%s/contract.pdf' % (contract_dir))
+            os.remove('%s/copy.pdf' % (contract_dir))
+            self.backup_at(datetime.datetime(2011, 1, 3))
+            self.assertEquals(len(backup_request.get_archive_filenames()), 2)
+            self.assertEquals(BackupBlob.objects.get(user=self.user1).reference_count, 1)
+            # only the download of the current archive is kept
+            self.assertEquals(sorted(os.listdir('%s/download' % (backup_dir))), ['backup_201101030000.tar.gz'])
+
+            # the blob is deleted with the last archive referencing it
+            self.backup_at(datetime.datetime(2011, 1, 4))
+            self.assertEquals(BackupBlob.objects.filter(user=self.user1).count(), 0)
+            self.assertFalse(blob_store.exists(blob.hash))
+        finally:
+            settings.BACKUP_RETENTION_COUNT = retention_count
+
+    def testBlobSizeIsSizeOfStoredContent(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        path = '%s/contract.pdf' % (contract_dir)
+        contract_file = open(path, 'w')
+        contract_file.write('contract content')
+        contract_file.close()
+        blob_store = BackupRequest(user=self.user1).get_blob_store()
+
+        # written after the backup looked at it
+        contract_file = open(path, 'a')
+        contract_file.write(' and more')
+        contract_file.close()
+        hash, size, added = blob_store.add(path, COMPRESSION_LEVEL, None, len('contract content'))
+        self.assertEquals(hash, hashlib.sha1('contract content and more').hexdigest())
+        self.assertEquals(size, len('contract content and more'))
+        self.assertTrue(added)
+
+        # a known content is not read again
+        self.assertEquals(blob_store.add(path, COMPRESSION_LEVEL, hash, size), (hash, size, False))
+
+    def testBlobIsCompressedByChunks(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        path = '%s/contract.txt' % (contract_dir)
+        content = ''.join([hashlib.md5(str(i)).hexdigest() for i in range(100000)])
+        contract_file = open(path, 'w')
+        contract_file.write(content)
+        contract_file.close()
+        blob_store = BackupRequest(user=self.user1).get_blob_store()
+
+        pool = ThreadPool(2)
+        try:
+            hash, size, added = blob_store.add(path, COMPRESSION_LEVEL, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        blob = blob_store.open(hash).read()
+        # one gzip member per chunk, read as one padded stream
+        self.assertTrue(blob.count('\037\213\010') > 1)
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(blob)).read(), content + tarfile.NUL * (-len(content) % tarfile.BLOCKSIZE))
+
+    def testFailedBackupRemovesItsBlobs(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        contract_file = open('%s/contract.pdf' % (contract_dir), 'w')
+        contract_file.write('contract content')
+        contract_file.close()
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        backup_request = BackupRequest.objects.get(user=self.user1)
+        # fails once files are stored and referenced
+        def build_download(filename=None):
+            raise IOError('disk full')
+        backup_request.build_download = build_download
+        backup_request.backup()
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_ERROR)
+        self.assertEquals(backup_request.error_message, 'disk full')
+        self.assertEquals(backup_request.get_archives(), [])
+        blob_store = backup_request.get_blob_store()
+        self.assertFalse(blob_store.exists(hashlib.sha1('contract content').hexdigest()))
+        self.assertEquals(BackupBlob.objects.filter(user=self.user1).count(), 0)
+
+    def testRestoreDownloadedFiles(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        contract_file = open('%s/contract.pdf' % (contract_dir), 'w')
+        contract_file.write('contract content')
+        contract_file.close()
+        self.backup_at(datetime.datetime(2011, 1, 1))
+        backup_file = StringIO(open(self.client.get(reverse('backup_download'))['X-Sendfile'], 'rb').read())
+        backup_file.name = 'backup.tar.gz'
+        shutil.rmtree(contract_dir)
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'restore',
+                                     'action': RESTORE_ACTION_ADD_MISSING,
+                                     'backup_file': backup_file})
+        self.assertEquals(response.status_code, 302)
+        call_command('restore_user_data')
+
+        self.assertEquals(RestoreRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(open('%s/contract.pdf' % (contract_dir)).read(), 'contract content')
+
     def testRestoreAddMissing(self):
         response = self.client.post(reverse('backup'),
                                     {'backup_or_restore': 'backup'})
@@ -251,6 +446,150 @@ class BackupTest(TransactionTestCase):
 
         self.assertEquals(Contact.objects.filter(pk=c.id).count(), 0)
 
+    def testIncrementalBackup(self):
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        call_command('backup_user_data')
+        self.assertEquals(BackupRequest.objects.get(user=self.user1).since_datetime, None)
+
+        p = Proposal.objects.get(owner=self.user1)
+        p.reference = 'modified'
+        p.save()
+        i = Invoice.objects.get(owner=self.user1)
+        i.delete()
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup',
+                                     'incremental': 'on'})
+        self.assertEquals(response.status_code, 302)
+        call_command('backup_user_data')
+
+        backup_request = BackupRequest.objects.get(user=self.user1)
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_DONE)
+        self.assertNotEquals(backup_request.since_datetime, None)
+        self.assertTrue('_since_' in backup_request.get_backup_filename())
+
+        tar = tarfile.open('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                               self.user1.get_profile().uuid,
+                                               backup_request.get_backup_filename()), 'r:gz')
+        data = tar.extractfile('backup/data.ndjson').read()
+        tar.close()
+        lines = [simplejson.loads(line) for line in data.splitlines()]
+        self.assertEquals(lines[0]['since'], backup_request.since_datetime.isoformat())
+        # only the modified proposal (and its project, saved with it) is dumped
+        objects = [line[:2] for line in lines[1:] if isinstance(line, list)]
+        self.assertTrue(['Proposal', p.uuid] in objects)
+        self.assertEquals([model for model, uuid in objects if model not in ['Proposal', 'Project']], [])
+        existing = dict([(line['existing'], line['uuids']) for line in lines[1:] if isinstance(line, dict)])
+        self.assertEquals(sorted(existing['Contact']), sorted([str(uuid) for uuid in Contact.objects.filter(owner=self.user1).values_list('uuid', flat=True)]))
+        # the deleted invoice is missing from existing objects
+        self.assertFalse(str(i.uuid) in data)
+
+    def testRestoreIncrementalChain(self):
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        call_command('backup_user_data')
+        base_file = '%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                        self.user1.get_profile().uuid,
+                                        BackupRequest.objects.get(user=self.user1).get_backup_filename())
+        base_data = open(base_file, 'rb').read()
+
+        p = Proposal.objects.get(owner=self.user1)
+        p.reference = 'modified'
+        p.save()
+        i = Invoice.objects.get(owner=self.user1)
+        i.delete()
+        a = Address.objects.create(street='2 rue de la paix',
+                                   zipcode='75002',
+                                   city='Paris',
+                                   owner=self.user1)
+        c = Contact.objects.create(contact_type=CONTACT_TYPE_COMPANY,
+                                   name='New contact',
+                                   company_id='456',
+                                   legal_form='SA',
+                                   representative='Roger',
+                                   representative_function='President',
+                                   address=a,
+                                   comment='new comment',
+                                   owner=self.user1)
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup',
+                                     'incremental': 'on'})
+        call_command('backup_user_data')
+        increment_file = '%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                             self.user1.get_profile().uuid,
+                                             BackupRequest.objects.get(user=self.user1).get_backup_filename())
+
+        # base backup followed by its increment
+        chain_file = '%s%s/backup/chain.tar.gz' % (settings.FILE_UPLOAD_DIR,
+                                                   self.user1.get_profile().uuid)
+        chain = open(chain_file, 'wb')
+        chain.write(base_data)
+        chain.write(open(increment_file, 'rb').read())
+        chain.close()
+
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'restore',
+                                     'action': RESTORE_ACTION_DELETE_ALL_AND_RESTORE,
+                                     'backup_file': open(chain_file, 'rb')})
+        self.assertEquals(response.status_code, 302)
+        shutil.copyfile(chain_file, '%s%s/restore/chain.tar.gz' % (settings.FILE_UPLOAD_DIR,
+                                                                   self.user1.get_profile().uuid))
+
+        call_command('restore_user_data')
+
+        self.assertEquals(RestoreRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(OwnedObject.objects.filter(owner=self.user2).count(), 12)
+        self.assertEquals(Proposal.objects.get(uuid=p.uuid).reference, 'modified')
+        self.assertEquals(Invoice.objects.filter(owner=self.user1).count(), 0)
+        self.assertEquals(Contact.objects.filter(owner=self.user1, uuid=c.uuid).count(), 1)
+        self.assertEquals(Contact.objects.get(uuid=c.uuid).address.uuid, str(a.uuid))
+
+    def restore_counting_queries(self, action):
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'backup'})
+        call_command('backup_user_data')
+        backup_file = '%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid,
+                                          BackupRequest.objects.get(user=self.user1).get_backup_filename())
+        response = self.client.post(reverse('backup'),
+                                    {'backup_or_restore': 'restore',
+                                     'action': action,
+                                     'backup_file': open(backup_file, 'rb')})
+        shutil.copyfile(backup_file, '%s%s/restore/%s' % (settings.FILE_UPLOAD_DIR,
+                                                          self.user1.get_profile().uuid,
+                                                          os.path.basename(backup_file)))
+        settings.DEBUG = True
+        try:
+            query_count = len(connection.queries)
+            call_command('restore_user_data')
+            query_count = len(connection.queries) - query_count
+        finally:
+            settings.DEBUG = False
+        self.assertEquals(RestoreRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+        return query_count
+
+    def testRestoreQueriesDoNotDependOnRowCount(self):
+        query_count = self.restore_counting_queries(RESTORE_ACTION_ADD_AND_UPDATE)
+
+        invoice = Invoice.objects.get(owner=self.user1)
+        for i in range(20):
+            InvoiceRow.objects.create(owner_id=self.user1.id,
+                                      invoice_id=invoice.id,
+                                      proposal=None,
+                                      label='Day of work',
+                                      category=ROW_CATEGORY_SERVICE,
+                                      quantity=1,
+                                      unit_price=100,
+                                      balance_payments=False)
+        amount = Invoice.objects.get(pk=invoice.id).amount
+        Invoice.objects.filter(pk=invoice.id).update(amount=0)
+
+        self.assertEquals(self.restore_counting_queries(RESTORE_ACTION_ADD_AND_UPDATE), query_count)
+        # amounts are computed again once rows are restored
+        self.assertEquals(Invoice.objects.get(pk=invoice.id).amount, amount)
+
     def testCannotAddUser(self):
         backup_file = '%s/backup/fixtures/backup_injected_user.tar.gz' % (settings.BASE_PATH)
         restore_file = '%s%s/restore/backup_injected_user.tar.gz' % (settings.FILE_UPLOAD_DIR,
@@ -767,3 +1106,179 @@ class CsvExportTest(TestCase):
                                    {'end_date': datetime.date(2010, 2, 1)})
         expected_response = "Reference,Customer,Address,State,Amount,Edition date,Payment date,Payment type,Paid date,Execution begin date,Execution end date,Penalty date,Penalty rate,Discount conditions\r\n2,Contact 1,\",  , None\",Paid,200.00,2010-01-31,2010-02-28,Check,None,2010-01-01,2010-01-07,2010-03-08,1.50,Nothing\r\n"
         self.assertEquals(response.content, expected_response)
+
+class BackupSerializerTest(TestCase):
+    fixtures = ['backup_data']
+
+    def setUp(self):
+        self.user1 = User.objects.get(username='test1')
+
+    def serialize(self, format_version=BACKUP_FORMAT_XML):
+        backup_request = BackupRequest(user=self.user1)
+        backup_request.stream = StringIO()
+        settings.DEBUG = True
+        try:
+            query_count = len(connection.queries)
+            backup_request.backup_objects(format_version)
+            query_count = len(connection.queries) - query_count
+        finally:
+            settings.DEBUG = False
+        return backup_request.stream.getvalue(), query_count
+
+    def testOneQueryPerModel(self):
+        data, query_count = self.serialize()
+        invoice = Invoice.objects.get(owner=self.user1)
+        for i in range(20):
+            InvoiceRow.objects.create(owner_id=self.user1.id,
+                                      invoice_id=invoice.id,
+                                      proposal=None,
+                                      label='Day of work',
+                                      category=ROW_CATEGORY_SERVICE,
+                                      quantity=1,
+                                      unit_price=100,
+                                      balance_payments=False)
+
+        data, new_query_count = self.serialize()
+        self.assertEquals(new_query_count, query_count)
+        self.assertEquals(data.count('<InvoiceRow '), InvoiceRow.objects.filter(owner=self.user1).count())
+        self.assertTrue('<invoice><object uuid="%s"></object></invoice>' % (str(invoice.uuid)) in data)
+
+    def testProfileAddressIsNotExported(self):
+        data, query_count = self.serialize()
+        self.assertFalse('uuid="%s"' % (str(self.user1.get_profile().address.uuid)) in data)
+
+    def testFormatsHoldSameRecords(self):
+        models = dict([(model._meta.object_name, model) for model in [Address, Contact, Proposal, ProposalRow, Invoice, InvoiceRow]])
+        xml_data, query_count = self.serialize(BACKUP_FORMAT_XML)
+        json_data, json_query_count = self.serialize(BACKUP_FORMAT_JSON)
+        self.assertEquals(json_query_count, query_count)
+        self.assertTrue(len(json_data) < len(xml_data))
+
+        xml_records = list(read_xml(StringIO(xml_data), models))
+        json_records = list(read_json(StringIO(json_data), models))
+        self.assertTrue(xml_records)
+        self.assertEquals(json_records, xml_records)
+
+class BackupQueueTest(TestCase):
+    fixtures = ['backup_data']
+
+    def setUp(self):
+        self.user1 = User.objects.get(username='test1')
+        self.user2 = User.objects.get(username='test2')
+        now = datetime.datetime.now()
+        self.request1 = BackupRequest.objects.create(user=self.user1,
+                                                     creation_datetime=now - datetime.timedelta(minutes=1),
+                                                     last_state_datetime=now)
+        self.request2 = BackupRequest.objects.create(user=self.user2,
+                                                     creation_datetime=now,
+                                                     last_state_datetime=now)
+
+    def testRequestIsClaimedOnce(self):
+        self.assertTrue(BackupRequest.objects.claim(self.request1.id))
+        self.assertFalse(BackupRequest.objects.claim(self.request1.id))
+        self.assertEquals(BackupRequest.objects.get(pk=self.request1.id).state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+
+    def testClaimNextTakesOldestPending(self):
+        self.assertEquals(BackupRequest.objects.claim_next(), self.request1)
+        self.assertEquals(BackupRequest.objects.claim_next(), self.request2)
+        self.assertEquals(BackupRequest.objects.claim_next(), None)
+
+    def testStaleRequestIsQueuedAgain(self):
+        BackupRequest.objects.claim(self.request1.id)
+        BackupRequest.objects.claim(self.request2.id)
+        BackupRequest.objects.filter(pk=self.request1.id).update(heartbeat_datetime=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.assertEquals(BackupRequest.objects.heartbeat([self.request2.id]), 1)
+
+        self.assertEquals(BackupRequest.objects.recover_stale(600), 1)
+        self.assertEquals(BackupRequest.objects.get(pk=self.request1.id).state, BACKUP_RESTORE_STATE_PENDING)
+        self.assertEquals(BackupRequest.objects.get(pk=self.request2.id).state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+
+    def testProgressIsWrittenAtIntervals(self):
+        progress = RequestProgress(self.request1)
+        progress.add_objects(10, 'Contact')
+        # not written yet
+        self.assertEquals(BackupRequest.objects.get(pk=self.request1.id).progress_objects, 0)
+
+        progress.last_save = time.time() - PROGRESS_INTERVAL
+        progress.add_bytes(1000)
+        request = BackupRequest.objects.get(pk=self.request1.id)
+        self.assertEquals(request.progress_objects, 10)
+        self.assertEquals(request.progress_bytes, 1000)
+        self.assertEquals(request.progress_model, 'Contact')
+
+    def testProgressIsHeartbeat(self):
+        # a request processed outside backup_worker, by a cron command,
+        # is not queued again while it makes progress
+        BackupRequest.objects.claim(self.request1.id)
+        BackupRequest.objects.filter(pk=self.request1.id).update(heartbeat_datetime=datetime.datetime.now() - datetime.timedelta(hours=1))
+        progress = RequestProgress(BackupRequest.objects.get(pk=self.request1.id))
+        progress.last_save = time.time() - PROGRESS_INTERVAL
+        progress.add_objects(1, 'Contact')
+
+        self.assertEquals(BackupRequest.objects.recover_stale(600), 0)
+        self.assertEquals(BackupRequest.objects.get(pk=self.request1.id).state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+
+    def testProgressOfQueuedRequest(self):
+        self.client.login(username='test2', password='test')
+        response = self.client.get(reverse('backup_progress'))
+        self.assertEquals(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEquals(data['restore'], None)
+        self.assertTrue(data['backup']['running'])
+        self.assertEquals(data['backup']['position'], 1)
+
+        BackupRequest.objects.claim(self.request2.id)
+        self.request2 = BackupRequest.objects.get(pk=self.request2.id)
+        self.request2.backup()
+        data = simplejson.loads(self.client.get(reverse('backup_progress')).content)
+        self.assertFalse(data['backup']['running'])
+        self.assertEquals(data['backup']['state'], BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(data['backup']['objects'], sum([self.request2.get_backup_queryset(model).count() for model in [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]]))
+        self.assertTrue(data['backup']['bytes'] > 0)
+        self.assertEquals(data['backup']['model'], None)
+        self.assertEquals([name for name, seconds in self.request2.progress.phases], ['objects', 'files', 'compression', 'download', 'retention'])
+
+class ParallelGzipFileTest(TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp('.gz')
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def testMembersAreReadAsOneStream(self):
+        data = ''.join([hashlib.md5(str(i)).hexdigest() for i in range(1000)])
+        file = ParallelGzipFile(self.filename, threads=3, chunk_size=1000)
+        file.write(data[:20000])
+        for i in range(20000, len(data), 300):
+            file.write(data[i:i + 300])
+        file.close()
+
+        self.assertEquals(gzip.open(self.filename).read(), data)
+        self.assertTrue(open(self.filename, 'rb').read().count('\037\213\010') >= len(data) / 1000)
+
+    def testSharedPool(self):
+        pool = ThreadPool(2)
+        try:
+            for content in ['first file', 'second file']:
+                file = ParallelGzipFile(self.filename, chunk_size=4, mtime=0, pool=pool)
+                file.write(content)
+                file.close()
+                self.assertEquals(gzip.open(self.filename).read(), content)
+            # the pool is left open for other files
+            self.assertEquals(pool.apply(len, ('data',)), 4)
+        finally:
+            pool.close()
+            pool.join()
+
+    def testEmptyFile(self):
+        file = ParallelGzipFile(self.filename)
+        file.close()
+        self.assertEquals(gzip.open(self.filename).read(), '')
+
+    def testAbort(self):
+        file = ParallelGzipFile(self.filename, chunk_size=10)
+        file.write('data to drop')
+        file.abort()
+        file.close()
+        self.assertTrue(file.closed)
@@ -7,6 +7,9 @@ urlpatterns = patterns('backup.views',
     url(regex=r'^download/$',
         view='backup_download',
         name='backup_download'),
+    url(regex=r'^progress/$',
+        view='backup_progress',
+        name='backup_progress'),
     url(regex=r'^csv/$',
         view='csv_export',
         name='csv_export'),
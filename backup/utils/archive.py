@@ -0,0 +1,118 @@
+import os
+import struct
+import time
+import zlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# size of data compressed by a thread into its own gzip member
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+# same as gzip.GzipFile
+COMPRESSION_LEVEL = 9
+# level of data which is already compressed, it is only stored
+STORE_LEVEL = 0
+
+ALREADY_COMPRESSED_EXTENSIONS = ['.pdf', '.png', '.jpg', '.jpeg', '.gif',
+                                 '.gz', '.tgz', '.bz2', '.zip', '.7z', '.rar',
+                                 '.odt', '.ods', '.docx', '.xlsx', '.pptx']
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1].lower() in ALREADY_COMPRESSED_EXTENSIONS
+
+def compress_member(data, level, mtime):
+    """
+    Returns data as a complete gzip member
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # no flag, extra flag, unix os
+    header = '\037\213\010\000' + struct.pack('<L', long(mtime)) + '\002\377'
+    return header \
+           + compressor.compress(data) \
+           + compressor.flush() \
+           + struct.pack('<LL', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL)
+
+class ParallelGzipFile(object):
+    """
+    Write only gzip file compressing chunks of data in threads, like pigz.
+    The file is made of one gzip member per chunk, which gzip readers handle
+    like a single stream. zlib releases the GIL while compressing.
+    Files written one after the other can share the threads of pool, which
+    is then left open.
+    """
+
+    def __init__(self, filename, threads=None, level=COMPRESSION_LEVEL, chunk_size=COMPRESSION_CHUNK_SIZE,
+                 mtime=None, pool=None):
+        self.file = open(filename, 'wb')
+        self.level = level
+        self.chunk_size = chunk_size
+        self.threads = threads or cpu_count()
+        self.own_pool = pool is None
+        self.pool = pool or ThreadPool(self.threads)
+        if mtime is None:
+            mtime = time.time()
+        self.mtime = mtime
+        self.buffer = []
+        self.buffer_size = 0
+        # uncompressed size written
+        self.offset = 0
+        # members being compressed, in file order
+        self.pending = []
+        self.closed = False
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.offset = self.offset + len(data)
+        self.buffer.append(data)
+        self.buffer_size = self.buffer_size + len(data)
+        if self.buffer_size >= self.chunk_size:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.buffer_size = 0
+            for i in range(0, len(data) - self.chunk_size + 1, self.chunk_size):
+                self.compress(data[i:i + self.chunk_size])
+            remaining = len(data) % self.chunk_size
+            if remaining:
+                self.buffer.append(data[-remaining:])
+                self.buffer_size = remaining
+
+    def flush_buffer(self):
+        if self.buffer_size:
+            self.compress(''.join(self.buffer))
+            self.buffer = []
+            self.buffer_size = 0
+
+    def compress(self, data):
+        self.pending.append(self.pool.apply_async(compress_member, (data, self.level, self.mtime)))
+        # keep threads busy without holding the whole file in memory
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.pop(0).get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush_buffer()
+        if not self.pending:
+            # an empty gzip file still has a member
+            self.compress('')
+        while self.pending:
+            self.file.write(self.pending.pop(0).get())
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+        self.file.close()
+        self.closed = True
+
+    def abort(self):
+        """
+        Stops compression, the file is left incomplete
+        """
+        if self.closed:
+            return
+        if self.own_pool:
+            self.pool.terminate()
+        # chunks compressed by a shared pool are dropped
+        self.pending = []
+        self.file.close()
+        self.closed = True
@@ -0,0 +1,114 @@
+"""
+Content addressed storage of uploaded files for backups.
+
+Each distinct content is stored once per user in a blob named by its sha1,
+whatever the number of archives referencing it. A blob holds the content
+padded to tar blocks and gzipped by chunks in threads, so a downloadable
+archive is made by concatenating gzipped tar headers and blobs.
+"""
+import errno
+import hashlib
+import os
+import tarfile
+from backup.utils.archive import ParallelGzipFile
+
+# size of data read at once while hashing or copying a file
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path):
+    """
+    Returns the hash and the size of the content of the file at path
+    """
+    digest = hashlib.sha1()
+    size = 0
+    file = open(path, 'rb')
+    try:
+        while True:
+            data = file.read(BLOB_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            size = size + len(data)
+    finally:
+        file.close()
+    return digest.hexdigest(), size
+
+class BlobStore(object):
+    """
+    Blobs of a user, stored in root/<first two chars of hash>/<hash>
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, hash):
+        return os.path.join(self.root, hash[:2], hash)
+
+    def exists(self, hash):
+        return os.path.exists(self.get_path(hash))
+
+    def open(self, hash):
+        return open(self.get_path(hash), 'rb')
+
+    def get_size(self, hash):
+        return os.path.getsize(self.get_path(hash))
+
+    def add(self, path, level, hash=None, size=None, pool=None):
+        """
+        Stores the content of the file at path and returns its hash, its
+        size and whether a new blob was written. hash and size are those of
+        the content when already known. The content is only copied when no
+        blob holds it yet, returned hash and size are always those of the
+        stored content even if the file is written meanwhile. Chunks are
+        compressed by the threads of pool when given.
+        """
+        if hash is None:
+            hash, size = hash_file(path)
+        if self.exists(hash):
+            return hash, size, False
+
+        dir = os.path.dirname(self.get_path(hash))
+        try:
+            os.makedirs(dir)
+        except OSError as exc:
+            if exc.errno <> errno.EEXIST:
+                raise
+        temp_path = '%s.tmp' % (self.get_path(hash))
+        digest = hashlib.sha1()
+        size = 0
+        source = open(path, 'rb')
+        try:
+            blob = ParallelGzipFile(temp_path, level=level, mtime=0, pool=pool)
+            try:
+                while True:
+                    data = source.read(BLOB_CHUNK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    size = size + len(data)
+                    blob.write(data)
+                remainder = size % tarfile.BLOCKSIZE
+                if remainder:
+                    blob.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blob.close()
+            except:
+                blob.abort()
+                os.remove(temp_path)
+                raise
+        finally:
+            source.close()
+
+        # the file may have been written since it was hashed
+        hash = digest.hexdigest()
+        dir = os.path.dirname(self.get_path(hash))
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        if self.exists(hash):
+            os.remove(temp_path)
+            return hash, size, False
+        os.rename(temp_path, self.get_path(hash))
+        return hash, size, True
+
+    def remove(self, hash):
+        if self.exists(hash):
+            os.remove(self.get_path(hash))
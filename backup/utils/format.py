@@ -0,0 +1,199 @@
+"""
+Backup data formats.
+
+Objects are exchanged as records, dicts holding the model, the uuid of the
+object, its fields and its many to many fields as lists of (name, value)
+pairs. A value is None, a string made by field.value_to_string, a dict
+holding the uuid (country_code for countries) of the related object for
+foreign keys, or a list of uuids for many to many fields.
+
+Records listing uuids of existing objects, used by incremental backups to
+replay deletions, hold the model and the uuids.
+
+Version 1 is indented xml, version 2 is one json document per line, with a
+header describing fields of each model so that objects are plain arrays.
+"""
+from xml.dom import pulldom
+from django.conf import settings
+from django.core.serializers.xml_serializer import getInnerText
+from django.db.models.fields.related import ForeignKey, OneToOneField
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+from django.utils.xmlutils import SimplerXMLGenerator
+
+BACKUP_FORMAT_XML = 1
+BACKUP_FORMAT_JSON = 2
+BACKUP_FORMAT_VERSION = BACKUP_FORMAT_JSON
+
+BACKUP_DATA_FILENAMES = {BACKUP_FORMAT_XML: 'backup/data.xml',
+                         BACKUP_FORMAT_JSON: 'backup/data.ndjson'}
+# uploaded files of the archive, stored in the blob store
+BACKUP_MANIFEST_FILENAME = 'backup/files.json'
+
+def get_schema_fields(model):
+    """
+    Returns names of fields and many to many fields of model in backups
+    """
+    return ([field.name for field in model._meta.local_fields if field.name <> 'ownedobject_ptr'],
+            [field.name for field in model._meta.many_to_many])
+
+def is_foreign_key(field):
+    return type(field) == ForeignKey or type(field) == OneToOneField
+
+def write_xml(stream, records, version, since=None):
+    xml = SimplerXMLGenerator(stream, settings.DEFAULT_CHARSET)
+
+    def indent(level):
+        xml.ignorableWhitespace('\n' + ' ' * 4 * level)
+
+    xml.startDocument()
+    attrs = {"version" : version}
+    if since:
+        attrs['since'] = since.isoformat()
+    xml.startElement("aemanager", attrs)
+
+    for record in records:
+        if 'existing' in record:
+            indent(1)
+            xml.startElement("existing", {'model': record['existing']._meta.object_name})
+            for uuid in record['uuids']:
+                indent(2)
+                xml.addQuickElement("object", attrs={
+                  'uuid' : smart_unicode(uuid)
+                })
+            indent(1)
+            xml.endElement("existing")
+            continue
+
+        model_name = record['model']._meta.object_name
+        indent(1)
+        xml.startElement(model_name, {'uuid': record['uuid']})
+        for name, value in record['fields']:
+            indent(2)
+            xml.startElement(name, {})
+            if value is None:
+                xml.addQuickElement("None")
+            elif isinstance(value, dict):
+                xml.addQuickElement("object", attrs=dict([(key, smart_unicode(related)) for key, related in value.items()]))
+            else:
+                xml.characters(value)
+            xml.endElement(name)
+
+        for name, uuids in record['m2m']:
+            indent(2)
+            xml.startElement(name, {})
+            for uuid in uuids:
+                indent(3)
+                xml.addQuickElement("object", attrs={
+                  'uuid' : smart_unicode(uuid)
+                })
+            indent(2)
+            xml.endElement(name)
+
+        indent(1)
+        xml.endElement(smart_unicode(model_name))
+
+    indent(0)
+    xml.endElement("aemanager")
+    xml.endDocument()
+
+def write_json_line(stream, data):
+    stream.write(simplejson.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    stream.write('\n')
+
+def write_json(stream, records, version, models, since=None):
+    header = {'format': 'aemanager',
+              'format_version': BACKUP_FORMAT_JSON,
+              'version': version,
+              'schema': dict([(model._meta.object_name, get_schema_fields(model)) for model in models])}
+    if since:
+        header['since'] = since.isoformat()
+    write_json_line(stream, header)
+
+    for record in records:
+        if 'existing' in record:
+            write_json_line(stream, {'existing': record['existing']._meta.object_name,
+                                     'uuids': [smart_unicode(uuid) for uuid in record['uuids']]})
+        else:
+            write_json_line(stream, [record['model']._meta.object_name,
+                                     record['uuid'],
+                                     [value for name, value in record['fields']],
+                                     [uuids for name, uuids in record['m2m']]])
+
+def read_xml(stream, models):
+    """
+    Yields records of objects of models (a dict by model name) found in stream
+    """
+    def get_inner_text(node):
+        """
+        Get all the inner text of a DOM node (recursively).
+        """
+        # inspired by http://mail.python.org/pipermail/xml-sig/2005-March/011022.html
+        inner_text = []
+        for child in node.childNodes:
+            if child.nodeType == child.TEXT_NODE:
+                inner_text.append(child.data)
+            elif child.nodeType == child.ELEMENT_NODE:
+                inner_text.extend(getInnerText(child))
+            else:
+                pass
+        return u"".join(inner_text)
+
+    event_stream = pulldom.parse(stream)
+    for event, node in event_stream:
+        if event == "START_ELEMENT" and node.nodeName in models:
+            event_stream.expandNode(node)
+            model = models[node.nodeName]
+            m2m_names = [field.name for field in model._meta.many_to_many]
+            foreign_key_names = [field.name for field in model._meta.local_fields if is_foreign_key(field)]
+            fields = []
+            m2m = []
+            for child in node.childNodes:
+                if child.nodeType <> child.ELEMENT_NODE:
+                    continue
+                objects = child.getElementsByTagName('object')
+                if child.nodeName in m2m_names:
+                    m2m.append((child.nodeName, [related.getAttribute('uuid') for related in objects]))
+                elif child.getElementsByTagName('None'):
+                    fields.append((child.nodeName, None))
+                elif child.nodeName in foreign_key_names and objects:
+                    fields.append((child.nodeName, dict([(str(key), value) for key, value in objects[0].attributes.items()])))
+                else:
+                    fields.append((child.nodeName, get_inner_text(child)))
+            yield {'model': model,
+                   'uuid': node.getAttribute('uuid'),
+                   'fields': fields,
+                   'm2m': m2m}
+        elif event == "START_ELEMENT" and node.nodeName == 'existing':
+            # only in incremental backups
+            event_stream.expandNode(node)
+            if node.getAttribute('model') in models:
+                yield {'existing': models[node.getAttribute('model')],
+                       'uuids': [related.getAttribute('uuid') for related in node.getElementsByTagName('object')]}
+
+def read_json(stream, models):
+    """
+    Yields records of objects of models (a dict by model name) found in stream
+    """
+    header = simplejson.loads(stream.readline() or 'null')
+    if not isinstance(header, dict) or header.get('format') <> 'aemanager':
+        raise Exception('Unknown backup format')
+    if header.get('format_version') > BACKUP_FORMAT_VERSION:
+        raise Exception('Backup format version %s is not supported' % (header.get('format_version')))
+    schema = header['schema']
+
+    for line in stream:
+        data = simplejson.loads(line)
+        if isinstance(data, dict):
+            if data.get('existing') in models:
+                yield {'existing': models[data['existing']],
+                       'uuids': data['uuids']}
+        elif data[0] in models and data[0] in schema:
+            field_names, m2m_names = schema[data[0]]
+            yield {'model': models[data[0]],
+                   'uuid': data[1],
+                   'fields': zip(field_names, data[2]),
+                   'm2m': zip(m2m_names, data[3])}
+
+READERS = {BACKUP_FORMAT_XML: read_xml,
+           BACKUP_FORMAT_JSON: read_json}
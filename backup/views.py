@@ -5,7 +5,8 @@ from django.template.context import RequestContext
 from django.utils.translation import ugettext_lazy as _, ugettext
 from backup.forms import BackupForm, RestoreForm, CSVForm
 from backup.models import BACKUP_RESTORE_STATE_PENDING, \
-    BACKUP_RESTORE_STATE_IN_PROGRESS, BackupRequest, RestoreRequest
+    BACKUP_RESTORE_STATE_IN_PROGRESS, BackupRequest, RestoreRequest, \
+    get_progress
 import datetime
 from django.core.urlresolvers import reverse
 from django.db.transaction import commit_on_success
@@ -13,8 +14,8 @@ from django.contrib import messages
 import os
 from django.http import HttpResponseNotFound, HttpResponse
 from django.utils.encoding import smart_str
-from django.conf import settings
 import unicodecsv
+from django.utils import simplejson
 from accounts.models import Invoice
 from autoentrepreneur.models import SUBSCRIPTION_STATE_TRIAL
 
@@ -91,9 +92,14 @@ def backup(request):
         else:
             messages.error(request, _("Form data have been tempered"))
 
+    archives = []
+    if backup_request:
+        archives = backup_request.get_archive_filenames()
+
     context = {
                'title': _('Backup'),
                'backup_request': backup_request,
+               'archives': archives,
                'restore_request': restore_request,
                'backup_form': backup_form,
                'restore_form': restore_form,
@@ -105,6 +111,25 @@ def backup(request):
                               context,
                               context_instance=RequestContext(request))
 
+def get_request_progress(request):
+    progress = get_progress(request)
+    progress['running'] = request.state <= BACKUP_RESTORE_STATE_IN_PROGRESS
+    if request.state == BACKUP_RESTORE_STATE_PENDING:
+        # requests are processed oldest first
+        progress['position'] = request.__class__.objects.filter(state=BACKUP_RESTORE_STATE_PENDING,
+                                                                creation_datetime__lt=request.creation_datetime).count()
+    return progress
+
+@settings_required
+def backup_progress(request):
+    data = {}
+    for name, model in (('backup', BackupRequest), ('restore', RestoreRequest)):
+        try:
+            data[name] = get_request_progress(model.objects.get(user=request.user))
+        except model.DoesNotExist:
+            data[name] = None
+    return HttpResponse(simplejson.dumps(data), mimetype='application/javascript')
+
 @settings_required
 def backup_download(request):
     try:
@@ -112,11 +137,22 @@ def backup_download(request):
     except:
         return HttpResponseNotFound()
 
+    filename = request.GET.get('archive') or backup_request.get_backup_filename()
+    if filename not in backup_request.get_archive_filenames():
+        return HttpResponseNotFound()
+
+    # downloads of older archives are written when asked,
+    # the archive may be deleted meanwhile by a new backup
+    try:
+        path = backup_request.build_download(filename)
+    except (IOError, OSError):
+        return HttpResponseNotFound()
+
     response = HttpResponse(mimetype='application/force-download')
     response['Content-Disposition'] = 'attachment;filename="%s"'\
-                                    % smart_str(backup_request.get_backup_filename())
+                                    % smart_str(filename)
 
-    response["X-Sendfile"] = "%s%s/%s/%s" % (settings.FILE_UPLOAD_DIR, request.user.get_profile().uuid, 'backup', backup_request.get_backup_filename())
+    response["X-Sendfile"] = path
     return response
 
 @settings_required
@@ -0,0 +1,229 @@
+"""
+Mail spool. Messages are saved before being sent so that none is lost when
+the smtp server fails, then sent in batches over a few smtp connections
+kept open, with retries and a rate limit.
+
+Mails to many recipients are rendered by a MailRenderer while they are
+spooled.
+"""
+import datetime
+import logging
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
+from django.template import loader
+from django.template.context import Context
+from django.db.models.expressions import F
+from core.models import SpooledMail, MAIL_STATE_PENDING, MAIL_STATE_SENT, \
+    MAIL_STATE_FAILED
+
+# messages sent over a connection before another connection takes the
+# next ones, small spools are sent in order over one connection
+MAIL_BATCH_SIZE = 50
+# seconds before the first retry of a message, doubled for each attempt
+MAIL_RETRY_DELAY = 60
+# longest wait between two attempts
+MAIL_MAX_RETRY_DELAY = 60 * 60
+# a message is failed after this many attempts, about 6 hours after the
+# first one, long enough to outlast an smtp outage
+MAIL_MAX_ATTEMPTS = 12
+
+logger = logging.getLogger('core.mail')
+
+def format_recipient(first_name, last_name, email):
+    return '%s %s <%s>' % (first_name, last_name, email)
+
+def render_signature(site=None):
+    """
+    Returns the signature added to mails sent to users
+    """
+    return loader.get_template('newsletter/signature.html').render(Context({'site': site or Site.objects.get_current()}))
+
+class MailRenderer(object):
+    """
+    Renders mails of many recipients. Templates are compiled once and
+    invariant variables, the site and the given ones, are set once in a
+    context each recipient only adds its own variables to. The signature is
+    rendered once and appended to bodies. Mails rendered with the same key
+    are rendered once and shared.
+    """
+
+    def __init__(self, subject_template_name, body_template_name, signature=True, **variables):
+        self.subject_template = loader.get_template(subject_template_name)
+        self.body_template = loader.get_template(body_template_name)
+        invariants = {'site': Site.objects.get_current()}
+        invariants.update(variables)
+        self.context = Context(invariants)
+        self.signature = ''
+        if signature:
+            self.signature = render_signature(invariants['site'])
+        self.mails = {}
+
+    def render(self, variables=None, key=None):
+        """
+        Returns subject and body rendered with variables of a recipient
+        """
+        if key is not None and key in self.mails:
+            return self.mails[key]
+        self.context.update(variables or {})
+        try:
+            mail = (self.subject_template.render(self.context),
+                    self.body_template.render(self.context) + self.signature)
+        finally:
+            self.context.pop()
+        if key is not None:
+            self.mails[key] = mail
+        return mail
+
+    def render_mass_mail(self, recipients, from_email=None):
+        """
+        Yields mails like send_mass_mail expects them, for recipients given
+        as an iterable of (recipient_list, variables, key). key is None for
+        mails which are not shared.
+        """
+        from_email = from_email or settings.DEFAULT_FROM_EMAIL
+        for recipient_list, variables, key in recipients:
+            subject, body = self.render(variables, key)
+            yield (subject, body, from_email, recipient_list)
+
+def enqueue_mass_mail(datatuple, reference=None):
+    """
+    Spools messages given like send_mass_mail, returns their number
+    """
+    return SpooledMail.objects.enqueue(datatuple, reference)
+
+class RateLimiter(object):
+    """
+    Spaces calls of wait, from any thread, to rate per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        self.lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        finally:
+            self.lock.release()
+        if start > now:
+            time.sleep(start - now)
+
+def send_batch(connection, mails, rate_limiter):
+    """
+    Sends mails over connection, reconnecting after a failure. Returns
+    (mail, error) pairs, error is None for sent mails. Runs in a thread
+    of the sender, so it doesn't use the database.
+    """
+    results = []
+    opened = False
+    for mail in mails:
+        message = EmailMessage(mail.subject,
+                               mail.body,
+                               mail.from_email,
+                               mail.get_recipient_list(),
+                               connection=connection)
+        rate_limiter.wait()
+        try:
+            if not opened:
+                # an open connection is kept between messages
+                connection.open()
+                opened = True
+            if not connection.send_messages([message]):
+                raise Exception('No recipient')
+            results.append((mail, None))
+        except Exception as e:
+            results.append((mail, e))
+            try:
+                connection.close()
+            except Exception:
+                pass
+            opened = False
+    return results
+
+def get_retry_delay(attempts):
+    """
+    Returns seconds to wait before the next attempt to send a message
+    after attempts failed ones
+    """
+    return min(MAIL_RETRY_DELAY * 2 ** (attempts - 1), MAIL_MAX_RETRY_DELAY)
+
+def record_results(results):
+    """
+    Marks sent mails, mails which failed are spooled again later
+    or failed after MAIL_MAX_ATTEMPTS
+    """
+    now = datetime.datetime.now()
+    sent_ids = [mail.id for mail, error in results if error is None]
+    if sent_ids:
+        SpooledMail.objects.filter(pk__in=sent_ids).update(state=MAIL_STATE_SENT,
+                                                           attempts=F('attempts') + 1,
+                                                           sent_datetime=now,
+                                                           error_message=None,
+                                                           claim=None)
+    retry_count = 0
+    failed_count = 0
+    for mail, error in results:
+        if error is None:
+            continue
+        attempts = mail.attempts + 1
+        if attempts >= MAIL_MAX_ATTEMPTS:
+            state = MAIL_STATE_FAILED
+            failed_count = failed_count + 1
+        else:
+            state = MAIL_STATE_PENDING
+            retry_count = retry_count + 1
+        logger.warning('Sending mail %i to %s failed: %s' % (mail.id, mail.to, error))
+        SpooledMail.objects.filter(pk=mail.id).update(state=state,
+                                                      attempts=attempts,
+                                                      error_message=unicode(error)[:255],
+                                                      next_attempt_datetime=now + datetime.timedelta(seconds=get_retry_delay(attempts)),
+                                                      claim=None)
+    return len(sent_ids), retry_count, failed_count
+
+def send_spooled_mail(connection_count=None, rate=None):
+    """
+    Sends messages of the spool which are due, MAIL_SPOOL_CONNECTIONS
+    batches at a time, at most MAIL_SPOOL_RATE messages per second.
+    Returns counts of sent messages, of messages spooled again for a
+    retry and of failed messages.
+    """
+    if connection_count is None:
+        connection_count = settings.MAIL_SPOOL_CONNECTIONS
+    if rate is None:
+        rate = settings.MAIL_SPOOL_RATE
+    token = uuid.uuid4().hex
+    connections = [get_connection(fail_silently=False) for i in range(connection_count)]
+    rate_limiter = RateLimiter(rate)
+    pool = ThreadPool(connection_count)
+    counts = [0, 0, 0]
+    try:
+        while True:
+            mails = SpooledMail.objects.claim(token, connection_count * MAIL_BATCH_SIZE)
+            if not mails:
+                break
+            batches = [mails[i:i + MAIL_BATCH_SIZE] for i in range(0, len(mails), MAIL_BATCH_SIZE)]
+            batch_results = pool.map(lambda args: send_batch(args[0], args[1], rate_limiter),
+                                     zip(connections, batches))
+            for results in batch_results:
+                for i, count in enumerate(record_results(results)):
+                    counts[i] = counts[i] + count
+    finally:
+        pool.close()
+        pool.join()
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+    return tuple(counts)
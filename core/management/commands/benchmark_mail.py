@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.template import loader
+from django.template.context import Context
+from accounts.models import Invoice
+from contact.models import Contact, CONTACT_TYPE_COMPANY
+from core.mail import MailRenderer, format_recipient
+
+# distinct users built, recipients cycle through them
+USER_POOL_SIZE = 100
+
+def get_users_to_notify(count, invoice_count):
+    """
+    Yields (user, late invoices, invoices to send) like notify_users does,
+    with unsaved objects built once so that neither database access nor
+    object creation is measured
+    """
+    today = datetime.date.today()
+    customer = Contact(contact_type=CONTACT_TYPE_COMPANY,
+                       name='Customer')
+    pool = []
+    for i in range(USER_POOL_SIZE):
+        user = User(username='user%i' % (i),
+                    first_name='Jean',
+                    last_name='Dupont %i' % (i),
+                    email='user%i@example.com' % (i))
+        invoices = [Invoice(invoice_id=j + 1,
+                            customer=customer,
+                            edition_date=today - datetime.timedelta(i + j + 40),
+                            payment_date=today - datetime.timedelta(i + j + 10))
+                    for j in range(invoice_count)]
+        pool.append((user, invoices[:invoice_count / 2], invoices[invoice_count / 2:]))
+    for i in range(count):
+        yield pool[i % USER_POOL_SIZE]
+
+def render_previous(count, invoice_count):
+    """
+    The loop of notify_users before MailRenderer: templates, subject and
+    signature are rendered once, each recipient gets a new context
+    """
+    site = Site.objects.get_current()
+    signature = loader.get_template('newsletter/signature.html').render(Context({'site': site}))
+    subject = loader.get_template('notification/email_subject.html').render(Context({}))
+    body_template = loader.get_template('notification/email.html')
+    for user, late_invoices, invoices_to_send in get_users_to_notify(count, invoice_count):
+        body = body_template.render(Context({'site': site,
+                                             'late_invoices': late_invoices,
+                                             'invoices_to_send': invoices_to_send}))
+        yield (subject, body + signature, format_recipient(user.first_name, user.last_name, user.email))
+
+def render_with_renderer(count, invoice_count):
+    renderer = MailRenderer('notification/email_subject.html', 'notification/email.html')
+
+    def get_recipients():
+        for user, late_invoices, invoices_to_send in get_users_to_notify(count, invoice_count):
+            yield ([format_recipient(user.first_name, user.last_name, user.email)],
+                   {'late_invoices': late_invoices,
+                    'invoices_to_send': invoices_to_send},
+                   None)
+
+    return renderer.render_mass_mail(get_recipients())
+
+def render_shared(count, invoice_count):
+    """
+    Trial expiry alerts, the same for every user expiring the same day
+    """
+    renderer = MailRenderer('core/trial_expire_email_subject.html',
+                            'core/trial_expire_email.html',
+                            signature=False)
+    for i in range(count):
+        days = (7, 1)[i % 2]
+        subject, body = renderer.render({'days': days}, days)
+        yield (subject, body, format_recipient('Jean', 'Dupont %i' % (i), 'user%i@example.com' % (i)))
+
+CASES = [('notification-previous', render_previous),
+         ('notification-renderer', render_with_renderer),
+         ('trial-alert-shared', render_shared)]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', dest='count', default=100000,
+                    help='Emails rendered per case'),
+        make_option('--invoices', type='int', dest='invoice_count', default=4,
+                    help='Invoices listed in each notification email'),
+        make_option('--filter', dest='filter', default='',
+                    help='Only run cases whose name contains this text (e.g. renderer)'),
+    )
+    help = 'Measure the rendering of notification emails to many users'
+
+    def handle(self, *args, **options):
+        count = options['count']
+        # site is cached before measures
+        Site.objects.get_current()
+        self.stdout.write("%-28s %9s %12s %10s\n" % ('case', 'time (s)', 'emails/s', 'size (MB)'))
+        for name, render in CASES:
+            if options['filter'] not in name:
+                continue
+            start = time.time()
+            size = 0
+            for mail in render(count, options['invoice_count']):
+                size = size + len(mail[1])
+            seconds = max(time.time() - start, 0.001)
+            self.stdout.write("%-28s %9.2f %12.0f %10.1f\n" % (name,
+                                                              seconds,
+                                                              count / seconds,
+                                                              size / 1024.0 / 1024.0))
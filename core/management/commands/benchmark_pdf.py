@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+import cPickle
+import datetime
+import os
+import resource
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from optparse import make_option
+from StringIO import StringIO
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.contrib.webdesign import lorem_ipsum
+from django.utils.formats import localize
+from django.utils.translation import ugettext
+from autoentrepreneur.models import UserProfile
+from contact.models import Contact, Address, CONTACT_TYPE_COMPANY
+from project.models import ProposalRow, ROW_CATEGORY_SERVICE
+from accounts.models import Expense, InvoiceRow, PAYMENT_TYPE
+from project.utils import pdf
+from project.utils.pdf import ProposalTemplate
+from accounts.utils.pdf import InvoiceTemplate, book_to_pdf, \
+    PURCHASE_BOOK_COL_WIDTHS, PURCHASE_BOOK_ALIGNMENTS, \
+    INVOICE_BOOK_COL_WIDTHS, INVOICE_BOOK_ALIGNMENTS
+
+ROW_COUNTS = [1, 20, 100, 500]
+BOOK_ENTRY_COUNTS = [100, 1000, 10000]
+VARIANTS = [('plain', ()),
+            ('vat', ('vat',)),
+            ('logo', ('logo',)),
+            ('detail', ('detail',)),
+            ('full', ('vat', 'logo', 'detail'))]
+# variants also rendered without the line breaking cache
+LINE_CACHE_VARIANTS = ['plain', 'detail']
+
+CATALOG_LABELS = [u'Day of work',
+                  u'Half day of work',
+                  u'Web site hosting - yearly subscription including domain name and mailboxes',
+                  u'Maintenance & support',
+                  u'Training session for the customer team on the new back office',
+                  u'Travel expenses']
+
+CATALOG_DETAILS = [u'',
+                   u'Includes analysis, development and tests',
+                   u'Deliverables:\nspecifications\nsource code\ndeployment guide',
+                   u'']
+
+LONG_DETAIL = u"\n".join(lorem_ipsum.paragraphs(4, common=True))
+
+def get_user(vat=False, logo=False):
+    """
+    Returns an unsaved user and profile, no database access is needed
+    to render documents for it
+    """
+    user = User(username='benchmark',
+                first_name='Jean',
+                last_name='Dupont')
+    address = Address(street='1 rue de la Paix',
+                      zipcode='75001',
+                      city='Paris')
+    user._profile_cache = UserProfile(user=user,
+                                      address=address,
+                                      company_id='12345678912345',
+                                      phonenumber='0102030405',
+                                      professional_email='demo@example.com',
+                                      uuid='benchmark')
+    if vat:
+        user._profile_cache.vat_number = 'FR12345678912'
+    if logo:
+        user._profile_cache.logo_file = 'benchmark/logo/logo.png'
+    return user
+
+def create_logo():
+    """
+    Writes an uploaded logo bigger than the header box for the benchmark user
+    """
+    from PIL import Image
+    logo_dir = '%sbenchmark/logo' % (settings.FILE_UPLOAD_DIR)
+    os.makedirs(logo_dir)
+    Image.new('RGBA', (800, 400), (30, 60, 120, 200)).save('%s/logo.png' % (logo_dir))
+
+def get_customer():
+    address = Address(street='714 rue de Sydney',
+                      zipcode='92800',
+                      city='Puteaux')
+    return Contact(contact_type=CONTACT_TYPE_COMPANY,
+                   name='Bross & Clackwell',
+                   address=address)
+
+def get_rows(row_count, row_class=ProposalRow, vat=False, detail=False):
+    rows = []
+    for i in range(row_count):
+        row = row_class(label=CATALOG_LABELS[i % len(CATALOG_LABELS)],
+                        category=ROW_CATEGORY_SERVICE,
+                        quantity=Decimal(i % 5 + 1),
+                        unit_price=Decimal('350.00'),
+                        amount=Decimal((i % 5 + 1) * 350),
+                        detail=LONG_DETAIL if detail else CATALOG_DETAILS[i % len(CATALOG_DETAILS)])
+        if vat:
+            row.vat_rate = Decimal(['19.6', '7', '5.5'][i % 3])
+        rows.append(row)
+    return rows
+
+def render_proposal(user, customer, rows, template_class=ProposalTemplate):
+    """
+    Follows Proposal.to_pdf and Invoice.to_pdf, without their
+    database accesses
+    """
+    output = StringIO()
+    proposal_template = template_class(output, user)
+    proposal_template.init_doc('Proposal BENCHMARK')
+    proposal_template.add_headers(None, customer, datetime.date.today())
+    proposal_template.add_title('PROPOSAL BENCHMARK')
+    proposal_template.add_rows(rows)
+    for flowable in proposal_template.get_total_amount(sum([row.amount for row in rows]), rows):
+        proposal_template.append_to_story(flowable)
+    proposal_template.build()
+    return output.getvalue()
+
+def render_invoice(user, customer, rows):
+    return render_proposal(user, customer, rows, InvoiceTemplate)
+
+def render_purchase_book(user, entry_count):
+    """
+    Follows accounts.views.expense_list_export
+    """
+    output = StringIO()
+    data = [[ugettext('Date'), ugettext('Ref.'), ugettext('Supplier'), ugettext('Nature'), ugettext('Amount'), ugettext('Payment type')]]
+    day = datetime.date(2011, 1, 1)
+    for i in range(entry_count):
+        expense = Expense(date=day + datetime.timedelta(days=i * 365 / entry_count),
+                          reference='F%05d' % (i),
+                          supplier=CATALOG_LABELS[i % len(CATALOG_LABELS)][:30],
+                          description=CATALOG_LABELS[(i + 1) % len(CATALOG_LABELS)][:30],
+                          amount=Decimal('%d.%02d' % (i % 1000, i % 100)),
+                          payment_type=PAYMENT_TYPE[i % len(PAYMENT_TYPE)][0])
+        data.append([localize(expense.date), expense.reference, expense.supplier, expense.description, localize(expense.amount), expense.get_payment_type_display()])
+    book_to_pdf(output,
+                user,
+                ugettext('Purchase book %(year)d') % {'year': 2011},
+                data,
+                PURCHASE_BOOK_COL_WIDTHS,
+                PURCHASE_BOOK_ALIGNMENTS)
+    return output.getvalue()
+
+def render_invoice_book(user, entry_count):
+    """
+    Follows accounts.views.invoice_list_export
+    """
+    output = StringIO()
+    customer = get_customer()
+    data = [[ugettext('Date'), ugettext('Ref.'), ugettext('Customer'), ugettext('Nature'), ugettext('Amount'), ugettext('Payment type')]]
+    day = datetime.date(2011, 1, 1)
+    for i in range(entry_count):
+        data.append([localize(day + datetime.timedelta(days=i * 365 / entry_count)),
+                     i + 1,
+                     customer,
+                     ugettext('Service'),
+                     localize(Decimal((i % 5 + 1) * 350)),
+                     dict(PAYMENT_TYPE)[PAYMENT_TYPE[i % len(PAYMENT_TYPE)][0]]])
+    book_to_pdf(output,
+                user,
+                ugettext('Invoice book %(year)d') % {'year': 2011},
+                data,
+                INVOICE_BOOK_COL_WIDTHS,
+                INVOICE_BOOK_ALIGNMENTS)
+    return output.getvalue()
+
+def without_line_cache(render):
+    """
+    Returns render running with the line breaking cache cleared and
+    disabled, to compare with the cached rendering
+    """
+    def render_without_line_cache(*args):
+        max_size = pdf.line_cache.max_size
+        pdf.line_cache.clear()
+        pdf.line_cache.max_size = 0
+        try:
+            return render(*args)
+        finally:
+            pdf.line_cache.max_size = max_size
+    return render_without_line_cache
+
+def get_cases():
+    """
+    Returns (name, function, arguments) of every benchmarked document
+    """
+    cases = []
+    customer = get_customer()
+    for document, row_class, render in (('proposal', ProposalRow, render_proposal),
+                                        ('invoice', InvoiceRow, render_invoice)):
+        for row_count in ROW_COUNTS:
+            for variant, features in VARIANTS:
+                user = get_user(vat='vat' in features, logo='logo' in features)
+                rows = get_rows(row_count, row_class, vat='vat' in features, detail='detail' in features)
+                cases.append(('%s-%i-%s' % (document, row_count, variant), render, (user, customer, rows)))
+                if variant in LINE_CACHE_VARIANTS:
+                    cases.append(('%s-%i-%s-nocache' % (document, row_count, variant), without_line_cache(render), (user, customer, rows)))
+    for book, render in (('purchase_book', render_purchase_book),
+                         ('invoice_book', render_invoice_book)):
+        for entry_count in BOOK_ENTRY_COUNTS:
+            cases.append(('%s-%i' % (book, entry_count), render, (get_user(), entry_count)))
+    return cases
+
+def run_case(name, render, args, iterations, profile_dir=None):
+    """
+    Renders the document iterations times and returns timings, peak RSS
+    and size. Meant to run in its own process so peak RSS belongs
+    to this case.
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    profiler = None
+    if profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+    for i in range(iterations):
+        start = time.time()
+        if profiler:
+            content = profiler.runcall(render, *args)
+        else:
+            content = render(*args)
+        times.append(time.time() - start)
+    if profiler:
+        profiler.dump_stats(os.path.join(profile_dir, '%s.prof' % (name)))
+    return {'first': times[0],
+            'best': min(times),
+            'mean': sum(times) / len(times),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'rss_growth': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+            'size': len(content)}
+
+def run_case_in_child(name, render, args, iterations, profile_dir=None):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 0
+        try:
+            try:
+                result = run_case(name, render, args, iterations, profile_dir)
+            except Exception as e:
+                result = {'error': repr(e)}
+                status = 1
+            os.write(write_end, cPickle.dumps(result))
+            os.close(write_end)
+        finally:
+            os._exit(status)
+
+    os.close(write_end)
+    data = ''
+    chunk = os.read(read_end, 65536)
+    while chunk:
+        data = data + chunk
+        chunk = os.read(read_end, 65536)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return cPickle.loads(data)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', dest='iterations', default=3,
+                    help='Renderings per document'),
+        make_option('--filter', dest='filter', default='',
+                    help='Only run documents whose name contains this text (e.g. invoice-500)'),
+        make_option('--profile-dir', dest='profile_dir', default=None,
+                    help='Write a cProfile dump per document in this directory'),
+        make_option('--no-line-cache', action='store_false', dest='line_cache', default=True,
+                    help='Disable the line breaking cache'),
+        make_option('--in-process', action='store_false', dest='fork', default=True,
+                    help='Do not fork a process per document, peak RSS is then the one of the whole run'),
+    )
+    help = 'Measure time, peak memory and size of proposal, invoice and book pdf generation'
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        if iterations < 1:
+            raise CommandError('iterations must be at least 1')
+        profile_dir = options['profile_dir']
+        if profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        if not options['line_cache']:
+            pdf.line_cache.max_size = 0
+
+        # logos are prepared in a scratch upload directory
+        upload_dir = settings.FILE_UPLOAD_DIR
+        settings.FILE_UPLOAD_DIR = tempfile.mkdtemp() + '/'
+        try:
+            create_logo()
+            self.stdout.write("%-28s %9s %9s %9s %10s %10s %10s\n" % ('document', 'first (s)', 'best (s)', 'mean (s)', 'peak (MB)', '+RSS (MB)', 'size (KB)'))
+            for name, render, render_args in get_cases():
+                if options['filter'] not in name:
+                    continue
+                if options['fork']:
+                    result = run_case_in_child(name, render, render_args, iterations, profile_dir)
+                else:
+                    result = run_case(name, render, render_args, iterations, profile_dir)
+                if 'error' in result:
+                    self.stdout.write("%-28s failed: %s\n" % (name, result['error']))
+                    continue
+                # ru_maxrss is in kilobytes on linux
+                self.stdout.write("%-28s %9.3f %9.3f %9.3f %10.1f %10.1f %10.1f\n" % (name,
+                                                                                     result['first'],
+                                                                                     result['best'],
+                                                                                     result['mean'],
+                                                                                     result['peak_rss'] / 1024.0,
+                                                                                     result['rss_growth'] / 1024.0,
+                                                                                     result['size'] / 1024.0))
+        finally:
+            shutil.rmtree(settings.FILE_UPLOAD_DIR, True)
+            settings.FILE_UPLOAD_DIR = upload_dir
+            pdf.line_cache.max_size = pdf.LINE_CACHE_SIZE
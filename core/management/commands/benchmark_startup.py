@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# modules only needed to render documents
+RENDERING_MODULES = ['project.utils.pdf', 'accounts.utils.pdf', 'project.utils.contract']
+RENDERING_PACKAGES = ['reportlab', 'ho', 'sx']
+
+IMPORT_SCRIPT = """
+import sys
+import time
+start = time.time()
+from django.db.models.loading import get_apps
+get_apps()
+print 'models', time.time() - start
+print 'loaded', ','.join([package for package in %(packages)r if package in sys.modules])
+start = time.time()
+for module in %(modules)r:
+    __import__(module)
+print 'rendering', time.time() - start
+"""
+
+class Command(BaseCommand):
+    args = '[runs]'
+    help = 'Measure models import time and startup time of an empty management command'
+
+    def handle(self, *args, **options):
+        if len(args) and args[0] == 'noop':
+            # the empty command, models are loaded by validation
+            return
+
+        try:
+            runs = int(args[0]) if len(args) > 0 else 5
+        except ValueError:
+            raise CommandError('runs must be an integer')
+
+        project_dir = os.path.dirname(os.path.abspath(sys.modules[settings.SETTINGS_MODULE].__file__))
+        manage = os.path.join(project_dir, 'manage.py')
+        env = os.environ.copy()
+        # manage.py only keeps the parent of the project on the path while importing settings
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(project_dir)] + sys.path)
+        env['DJANGO_SETTINGS_MODULE'] = settings.SETTINGS_MODULE
+        script = IMPORT_SCRIPT % {'packages': RENDERING_PACKAGES,
+                                  'modules': RENDERING_MODULES}
+
+        models_times = []
+        rendering_times = []
+        command_times = []
+        loaded = ''
+        for i in range(runs):
+            # each run is a fresh interpreter, nothing is imported yet
+            output = subprocess.Popen([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE).communicate()[0]
+            for line in output.splitlines():
+                name, value = (line.split(' ', 1) + [''])[:2]
+                if name == 'models':
+                    models_times.append(float(value))
+                elif name == 'rendering':
+                    rendering_times.append(float(value))
+                elif name == 'loaded':
+                    loaded = value
+
+            start = time.time()
+            subprocess.Popen([sys.executable, manage, 'benchmark_startup', 'noop'], env=env).wait()
+            command_times.append(time.time() - start)
+
+        if not models_times or not rendering_times:
+            raise CommandError('models could not be imported')
+
+        self.stdout.write("models import: %.3fs (best %.3fs)\n" % (sum(models_times) / len(models_times), min(models_times)))
+        self.stdout.write("rendering stack loaded by models: %s\n" % (loaded or 'none'))
+        self.stdout.write("rendering stack import on first document: %.3fs (best %.3fs)\n" % (sum(rendering_times) / len(rendering_times), min(rendering_times)))
+        self.stdout.write("empty management command: %.3fs (best %.3fs)\n" % (sum(command_times) / len(command_times), min(command_times)))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from core.models import PaypalIpn
+from core.paypal import process_paypal_ipns
+import signal
+import time
+import logging
+
+# seconds between two looks at the queue
+POLL_INTERVAL = 10
+# notifications claimed by a worker for this long are queued again
+STALE_TIMEOUT = 30 * 60
+
+logger = logging.getLogger('core.paypal')
+
+class Command(BaseCommand):
+    args = '[once]'
+    help = 'Verify and process paypal notifications, retrying failed ones later. With "once", stops when no notification is due.'
+
+    def handle(self, *args, **options):
+        once = len(args) > 0 and args[0] == 'once'
+        if len(args) > 0 and not once:
+            raise CommandError('Usage is process_paypal_ipn %s' % (self.args))
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            recovered = PaypalIpn.objects.recover_stale(STALE_TIMEOUT)
+            if recovered:
+                logger.warning('%i stale notifications queued again' % (recovered))
+
+            done, failed = process_paypal_ipns()
+            if done or failed:
+                self.stdout.write("%i notifications processed, %i failed.\n" % (done, failed))
+
+            if once:
+                break
+
+            # don't keep a transaction open between two polls
+            transaction.commit_unless_managed()
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self, signum, frame):
+        self.stdout.write("Stopping once notifications being processed are done.\n")
+        self.stopping = True
@@ -1,6 +1,7 @@
 # coding=utf-8
 
-import shutil
+import time
+from optparse import make_option
 from django.core.management.base import BaseCommand
 from autoentrepreneur.models import UserProfile, \
     AUTOENTREPRENEUR_ACTIVITY_LIBERAL_BNC, \
@@ -21,19 +22,26 @@ from accounts.models import InvoiceRow, Invoice, INVOICE_STATE_PAID, \
     INVOICE_STATE_EDITED
 from django.db import connection, transaction, models
 from django.core.management.color import no_style
+from core.purge import purge_users
+from core.snapshot import capture_users, restore_snapshot, save_snapshot, \
+    load_snapshot
+
+# name of the snapshot of demo data in FILE_UPLOAD_DIR
+DEMO_SNAPSHOT_FILE = 'demo_snapshot'
 
 class Command(BaseCommand):
     help = "Reset data for demo account"
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='Create the demo data again instead of restoring its snapshot'),
+    )
 
     def handle(self, *args, **options):
         if not settings.DEMO:
             self.stderr.write("Demo is set to False\n")
 
-        for profile in UserProfile.objects.all():
-            shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR,
-                                    profile.uuid),
-                                    True)
-            profile.user.delete()
+        start = time.time()
+        purge_users(UserProfile.objects.values_list('user', flat=True))
 
         # reset sql sequence
         cursor = connection.cursor()
@@ -45,6 +53,26 @@ class Command(BaseCommand):
             cursor.execute(query.encode('utf-8'))
         transaction.commit_unless_managed()
 
+        # demo data is created once in a while then restored from a
+        # snapshot, its dates moved by the days elapsed since
+        path = '%s%s' % (settings.FILE_UPLOAD_DIR, DEMO_SNAPSHOT_FILE)
+        today = datetime.date.today()
+        saved = None
+        if not options.get('rebuild'):
+            saved = load_snapshot(path)
+        if saved and saved[0].year == today.year and (today - saved[0]).days <= settings.DEMO_SNAPSHOT_MAX_AGE:
+            date, snapshot = saved
+            count = restore_snapshot(snapshot, today - date)
+            self.stdout.write("Demo data restored from snapshot of %s, %i rows in %.2f s\n" % (date,
+                                                                                             count,
+                                                                                             time.time() - start))
+        else:
+            user = self.create_demo_data()
+            transaction.commit_unless_managed()
+            save_snapshot(capture_users([user.id]), path, today)
+            self.stdout.write("Demo data created in %.2f s\n" % (time.time() - start))
+
+    def create_demo_data(self):
         now = datetime.datetime.now()
 
         user = User.objects.create_user('demo', 'demo@mapetiteautoentreprise.fr', 'demo')
@@ -404,3 +432,5 @@ class Command(BaseCommand):
                                          amount=700,
                                          payment_type=PAYMENT_TYPE_BANK_CARD,
                                          description='Achat pc')
+
+        return user
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from core.models import SpooledMail
+from core.mail import send_spooled_mail
+import signal
+import time
+import logging
+
+# seconds between two looks at the spool
+POLL_INTERVAL = 10
+# messages claimed by a sender for this long are spooled again
+STALE_TIMEOUT = 30 * 60
+
+logger = logging.getLogger('core.mail')
+
+class Command(BaseCommand):
+    args = '[once]'
+    help = 'Send spooled messages, retrying failed ones later. With "once", stops when no message is due.'
+
+    def handle(self, *args, **options):
+        once = len(args) > 0 and args[0] == 'once'
+        if len(args) > 0 and not once:
+            raise CommandError('Usage is send_mail_spool %s' % (self.args))
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self.stopping:
+            recovered = SpooledMail.objects.recover_stale(STALE_TIMEOUT)
+            if recovered:
+                logger.warning('%i stale messages spooled again' % (recovered))
+
+            sent, retried, failed = send_spooled_mail()
+            if sent or retried or failed:
+                self.stdout.write("%i messages sent, %i to retry, %i failed.\n" % (sent, retried, failed))
+
+            if once:
+                break
+
+            # don't keep a transaction open between two polls
+            transaction.commit_unless_managed()
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self, signum, frame):
+        self.stdout.write("Stopping once sending messages are sent.\n")
+        self.stopping = True
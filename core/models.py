@@ -1,11 +1,42 @@
 # -*- coding: utf-8 -*-
 import uuid
-from django.db import models
+import datetime
+from django.db import models, connection, transaction
+from django.db.models.loading import get_models
+from django.db.models.fields import AutoField
+from django.db.models.aggregates import Count
 from django.contrib.auth.models import User
+from django.utils.translation import ugettext_lazy as _
+
+# owners purged by one statement, below the limit of 999 variables per query of sqlite
+PURGE_CHUNK_SIZE = 500
+# spooled messages inserted by one statement
+MAIL_ENQUEUE_CHUNK_SIZE = 500
+
+MAIL_STATE_PENDING = 1
+MAIL_STATE_SENDING = 2
+MAIL_STATE_SENT = 3
+MAIL_STATE_FAILED = 4
+MAIL_STATE = ((MAIL_STATE_PENDING, _('Pending')),
+              (MAIL_STATE_SENDING, _('Sending')),
+              (MAIL_STATE_SENT, _('Sent')),
+              (MAIL_STATE_FAILED, _('Failed')))
+
+IPN_STATE_PENDING = 1
+IPN_STATE_PROCESSING = 2
+IPN_STATE_DONE = 3
+IPN_STATE_FAILED = 4
+IPN_STATE = ((IPN_STATE_PENDING, _('Pending')),
+             (IPN_STATE_PROCESSING, _('Processing')),
+             (IPN_STATE_DONE, _('Done')),
+             (IPN_STATE_FAILED, _('Failed')))
 
 class OwnedObject(models.Model):
     owner = models.ForeignKey(User)
     uuid = models.CharField(max_length=36, unique=True, default=uuid.uuid4)
+    # used by incremental backups, default is for fixtures. auto_now is
+    # not applied by QuerySet.update(), updates of owned objects set it
+    modification_datetime = models.DateTimeField(auto_now=True, default=datetime.datetime.now, db_index=True)
 
     def save(self, force_insert=False, force_update=False, using=None, user=None):
         if user:
@@ -22,3 +53,245 @@ class OwnedObject(models.Model):
             self.uuid = uuid.uuid4()
 
         super(OwnedObject, self).save(force_insert, force_update, using)
+
+def get_owned_models():
+    return [model for model in get_models() if issubclass(model, OwnedObject) and model is not OwnedObject]
+
+def get_purge_order(models):
+    """
+    Returns models ordered so that a model comes once no remaining model
+    references it
+    """
+    ordered = []
+    remaining = list(models)
+    while remaining:
+        for model in remaining:
+            referencing_models = [related.model for related in model._meta.get_all_related_objects()
+                                  if related.model in remaining and related.model is not model]
+            if not referencing_models:
+                break
+        else:
+            raise Exception('Circular references between %s' % (', '.join([model.__name__ for model in remaining])))
+        remaining.remove(model)
+        ordered.append(model)
+    return ordered
+
+def purge_owned_objects(owner_ids, models=None):
+    """
+    Deletes objects owned by owner_ids with one DELETE per table, without
+    loading them. Models referencing others are purged first. Objects
+    referenced by a model which is not purged, like the address of user
+    profile, are kept. Signals are not sent. Returns the number of deleted
+    rows.
+    """
+    if not owner_ids:
+        return 0
+    if len(owner_ids) > PURGE_CHUNK_SIZE:
+        count = 0
+        for i in range(0, len(owner_ids), PURGE_CHUNK_SIZE):
+            count = count + purge_owned_objects(owner_ids[i:i + PURGE_CHUNK_SIZE], models)
+        return count
+    if models is None:
+        models = get_owned_models()
+    qn = connection.ops.quote_name
+    owned_ids = 'SELECT %s FROM %s WHERE %s IN (%s)' % (qn(OwnedObject._meta.pk.column),
+                                                        qn(OwnedObject._meta.db_table),
+                                                        qn(OwnedObject._meta.get_field('owner').column),
+                                                        ', '.join(['%s'] * len(owner_ids)))
+    cursor = connection.cursor()
+    count = 0
+
+    for model in models:
+        for field in model._meta.local_many_to_many:
+            columns = [field.m2m_column_name()]
+            if field.rel.to in models:
+                columns.append(field.m2m_reverse_name())
+            for column in columns:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(field.m2m_db_table()), qn(column), owned_ids),
+                               owner_ids)
+                count = count + cursor.rowcount
+
+    for model in get_purge_order(models):
+        pk_column = qn(model._meta.pk.column)
+        sql = 'DELETE FROM %s WHERE %s IN (%s)' % (qn(model._meta.db_table), pk_column, owned_ids)
+        for related in model._meta.get_all_related_objects():
+            if related.model not in models:
+                column = qn(related.field.column)
+                sql = sql + ' AND %s NOT IN (SELECT %s FROM %s WHERE %s IS NOT NULL)' % (pk_column,
+                                                                                         column,
+                                                                                         qn(related.model._meta.db_table),
+                                                                                         column)
+        cursor.execute(sql, owner_ids)
+        count = count + cursor.rowcount
+
+    # parents of deleted objects
+    sql = 'DELETE FROM %s WHERE %s IN (%s)' % (qn(OwnedObject._meta.db_table),
+                                               qn(OwnedObject._meta.get_field('owner').column),
+                                               ', '.join(['%s'] * len(owner_ids)))
+    for model in get_owned_models():
+        sql = sql + ' AND %s NOT IN (SELECT %s FROM %s)' % (qn(OwnedObject._meta.pk.column),
+                                                            qn(model._meta.pk.column),
+                                                            qn(model._meta.db_table))
+    cursor.execute(sql, owner_ids)
+    count = count + cursor.rowcount
+    transaction.commit_unless_managed()
+    return count
+
+class SpooledMailManager(models.Manager):
+    def enqueue(self, datatuple, reference=None):
+        """
+        Spools messages given like send_mass_mail, as an iterable of
+        (subject, message, from_email, recipient_list), with one insert
+        per MAIL_ENQUEUE_CHUNK_SIZE messages. Returns the number of messages.
+        Messages spooled with a reference can be counted by state later.
+        """
+        now = datetime.datetime.now()
+        fields = [field for field in self.model._meta.local_fields if not isinstance(field, AutoField)]
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(self.model._meta.db_table),
+                                                   ', '.join([qn(field.column) for field in fields]),
+                                                   ', '.join(['%s'] * len(fields)))
+        cursor = connection.cursor()
+        count = 0
+        rows = []
+        for subject, message, from_email, recipient_list in datatuple:
+            mail = self.model(subject=subject,
+                              body=message,
+                              from_email=from_email,
+                              to='\n'.join(recipient_list),
+                              reference=reference,
+                              creation_datetime=now,
+                              next_attempt_datetime=now)
+            rows.append([field.get_db_prep_save(field.pre_save(mail, True), connection=connection) for field in fields])
+            if len(rows) == MAIL_ENQUEUE_CHUNK_SIZE:
+                cursor.executemany(sql, rows)
+                count = count + len(rows)
+                rows = []
+        if rows:
+            cursor.executemany(sql, rows)
+            count = count + len(rows)
+        transaction.commit_unless_managed()
+        return count
+
+    def claim(self, token, limit):
+        """
+        Switches up to limit messages due to sending, returns them.
+        Messages are claimed by a single update, a message is only
+        claimed once even by concurrent senders.
+        """
+        now = datetime.datetime.now()
+        ids = list(self.filter(state=MAIL_STATE_PENDING,
+                               next_attempt_datetime__lte=now).order_by('id').values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        self.filter(pk__in=ids,
+                    state=MAIL_STATE_PENDING).update(state=MAIL_STATE_SENDING,
+                                                     claim=token,
+                                                     claim_datetime=now)
+        return list(self.filter(state=MAIL_STATE_SENDING, claim=token).order_by('id'))
+
+    def count_by_reference(self, references):
+        """
+        Returns for each of references a dict of message counts by state
+        """
+        counts = dict([(reference, {}) for reference in references])
+        for row in self.filter(reference__in=references).values('reference', 'state').annotate(count=Count('id')).order_by():
+            counts[row['reference']][row['state']] = row['count']
+        return counts
+
+    def recover_stale(self, timeout):
+        """
+        Spools again messages claimed by a sender which stopped for timeout seconds
+        """
+        return self.filter(state=MAIL_STATE_SENDING,
+                           claim_datetime__lt=datetime.datetime.now() - datetime.timedelta(seconds=timeout)).update(state=MAIL_STATE_PENDING,
+                                                                                                                    claim=None)
+
+class SpooledMail(models.Model):
+    """
+    Message waiting to be sent, or sent
+    """
+    subject = models.TextField()
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    # one recipient by line
+    to = models.TextField()
+    state = models.IntegerField(choices=MAIL_STATE, default=MAIL_STATE_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    creation_datetime = models.DateTimeField()
+    next_attempt_datetime = models.DateTimeField(db_index=True)
+    sent_datetime = models.DateTimeField(null=True, blank=True)
+    error_message = models.CharField(max_length=255, null=True, blank=True)
+    # sender which claimed the message
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claim_datetime = models.DateTimeField(null=True, blank=True)
+    # what the message is sent for, like a newsletter
+    reference = models.CharField(max_length=50, null=True, blank=True, db_index=True)
+
+    objects = SpooledMailManager()
+
+    def __unicode__(self):
+        return u"%s %s %s" % (self.get_state_display(), self.to, self.subject)
+
+    def get_recipient_list(self):
+        return self.to.split('\n')
+
+class PaypalIpnManager(models.Manager):
+    def enqueue(self, payload, transaction_id):
+        """
+        Stores a notification as received, to be verified and processed later
+        """
+        now = datetime.datetime.now()
+        return self.create(payload=payload,
+                           transaction_id=transaction_id,
+                           creation_datetime=now,
+                           next_attempt_datetime=now)
+
+    def claim(self, token, limit):
+        """
+        Switches up to limit notifications due to processing, returns them.
+        Notifications of a transaction being processed are left for later,
+        workers rarely wait for each other. This is not a guarantee,
+        fulfill_ipn pays a transaction once in the database.
+        """
+        now = datetime.datetime.now()
+        processing = self.filter(state=IPN_STATE_PROCESSING).values('transaction_id')
+        ids = list(self.filter(state=IPN_STATE_PENDING,
+                               next_attempt_datetime__lte=now).exclude(transaction_id__in=processing).order_by('id').values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        self.filter(pk__in=ids,
+                    state=IPN_STATE_PENDING).update(state=IPN_STATE_PROCESSING,
+                                                    claim=token,
+                                                    claim_datetime=now)
+        return list(self.filter(state=IPN_STATE_PROCESSING, claim=token).order_by('id'))
+
+    def recover_stale(self, timeout):
+        """
+        Queues again notifications claimed by a worker which stopped for timeout seconds
+        """
+        return self.filter(state=IPN_STATE_PROCESSING,
+                           claim_datetime__lt=datetime.datetime.now() - datetime.timedelta(seconds=timeout)).update(state=IPN_STATE_PENDING,
+                                                                                                                    claim=None)
+
+class PaypalIpn(models.Model):
+    """
+    Instant payment notification sent by paypal, processed in background
+    """
+    # urlencoded as posted by paypal
+    payload = models.TextField()
+    transaction_id = models.CharField(max_length=255, db_index=True)
+    state = models.IntegerField(choices=IPN_STATE, default=IPN_STATE_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    creation_datetime = models.DateTimeField()
+    next_attempt_datetime = models.DateTimeField(db_index=True)
+    processed_datetime = models.DateTimeField(null=True, blank=True)
+    error_message = models.CharField(max_length=255, null=True, blank=True)
+    # worker which claimed the notification
+    claim = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    claim_datetime = models.DateTimeField(null=True, blank=True)
+
+    objects = PaypalIpnManager()
+
+    def __unicode__(self):
+        return u"%s %s" % (self.get_state_display(), self.transaction_id)
@@ -0,0 +1,282 @@
+"""
+Paypal instant payment notifications. Notifications are stored as received
+so that paypal gets its answer at once, then verified against
+PAYPAL_IPN_VERIFY_URL and processed by a worker, with retries. A
+transaction is fulfilled once whatever the number of its notifications and
+of workers: its subscription is switched to paid by a single conditional
+update, the database lets only one of them do it.
+"""
+import datetime
+import logging
+import urllib2
+import uuid
+from decimal import Decimal
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.mail.message import EmailMessage
+from django.db import transaction
+from django.db.models.expressions import F
+from django.http import HttpResponse, QueryDict
+from django.template import loader
+from django.template.context import Context
+from django.utils.encoding import smart_str
+from django.utils.translation import ugettext
+from accounts.models import Expense, Invoice, INVOICE_STATE_PAID, \
+    PAYMENT_TYPE_BANK_CARD, InvoiceRow
+from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_NOT_PAID, \
+    SUBSCRIPTION_STATE_PAID
+from contact.models import Contact, CONTACT_TYPE_COMPANY, Address
+from core.models import PaypalIpn, IPN_STATE_PENDING, IPN_STATE_DONE, \
+    IPN_STATE_FAILED
+from project.models import Proposal, Project, PROJECT_STATE_FINISHED, \
+    PROPOSAL_STATE_BALANCED, ROW_CATEGORY_SERVICE, ProposalRow, VAT_RATES_19_6
+
+# notifications claimed by a worker at once
+IPN_BATCH_SIZE = 20
+# seconds before the first retry of a notification, doubled for each attempt
+IPN_RETRY_DELAY = 60
+# a notification is failed after this many attempts
+IPN_MAX_ATTEMPTS = 8
+# seconds to wait for paypal to verify a notification
+IPN_VERIFY_TIMEOUT = 30
+
+logger = logging.getLogger('core.paypal')
+
+def verify_ipn(payload):
+    """
+    Sends back the notification to paypal, returns its answer,
+    VERIFIED or INVALID
+    """
+    return urllib2.urlopen(settings.PAYPAL_IPN_VERIFY_URL,
+                           'cmd=_notify-validate&%s' % (payload),
+                           IPN_VERIFY_TIMEOUT).read().strip()
+
+@transaction.commit_on_success
+def fulfill_ipn(data, paypal_response):
+    """
+    Records the payment notified by data, with paypal_response to its
+    verification. When the payment is verified, the subscription is paid
+    and the provider gets the invoice and the paypal fee. Returns the
+    subscription of the transaction and the email confirming the payment,
+    None when the payment is not fulfilled now. The email is sent once
+    the transaction is committed.
+    """
+    receiver_id = data['receiver_id']
+    transaction_id = data['txn_id']
+    payment_status = data['payment_status']
+    payment_amount = data['mc_gross']
+    payment_currency = data['mc_currency']
+    fee = data['mc_fee']
+    item_name = data['item_name']
+    user_id = data['custom']
+    user = User.objects.get(pk=user_id)
+    profile = user.get_profile()
+    last_subscription = profile.get_last_subscription()
+
+    subscription, created = Subscription.objects.get_or_create(transaction_id=transaction_id,
+                                                               defaults={'owner': user,
+                                                                         'state': SUBSCRIPTION_STATE_NOT_PAID,
+                                                                         'expiration_date': profile.get_next_expiration_date(),
+                                                                         'transaction_id': transaction_id,
+                                                                         'error_message': ugettext('Not verified')})
+
+    if subscription.state == SUBSCRIPTION_STATE_PAID:
+        # notified again
+        return subscription, None
+
+    email = None
+    if paypal_response == 'VERIFIED':
+        if receiver_id <> settings.PAYPAL_RECEIVER_ID:
+            subscription.error_message = ugettext('Receiver is not as defined in settings. Spoofing ?')
+        elif payment_status <> 'Completed':
+            subscription.error_message = ugettext('Payment not completed')
+        elif payment_amount <> settings.PAYPAL_APP_SUBSCRIPTION_AMOUNT:
+            subscription.error_message = ugettext('Amount altered. Bad guy ?')
+        elif payment_currency <> settings.PAYPAL_APP_SUBSCRIPTION_CURRENCY:
+            subscription.error_message = ugettext('Amount altered. Bad guy ?')
+        else:
+            subscription.error_message = ugettext('Paid')
+            subscription.state = SUBSCRIPTION_STATE_PAID
+            # another notification of the transaction processed at the same
+            # time waits for this update, then finds nothing to update. Only
+            # fields of the subscription table are updated, fields of owned
+            # objects would turn it into a select followed by updates.
+            # modification_datetime is set by save() below.
+            if not Subscription.objects.filter(pk=subscription.pk)\
+                                       .exclude(state=SUBSCRIPTION_STATE_PAID)\
+                                       .update(state=SUBSCRIPTION_STATE_PAID,
+                                               error_message=subscription.error_message):
+                return Subscription.objects.get(pk=subscription.pk), None
+
+            # create an invoice for this payment
+            # first, get the provider user
+            provider = User.objects.get(email=settings.SERVICE_PROVIDER_EMAIL)
+            if provider.get_profile().vat_number:
+                payment_amount = Decimal(payment_amount) / Decimal('1.196')
+
+            # look for a customer corresponding to user
+            address, created = Address.objects.get_or_create(contact__email=user.email,
+                                                             owner=provider,
+                                                             defaults={'street': profile.address.street,
+                                                                       'zipcode': profile.address.zipcode,
+                                                                       'city': profile.address.city,
+                                                                       'country': profile.address.country,
+                                                                       'owner': provider})
+            customer, created = Contact.objects.get_or_create(email=user.email,
+                                                              defaults={'contact_type': CONTACT_TYPE_COMPANY,
+                                                                        'name': '%s %s' % (user.first_name, user.last_name),
+                                                                        'company_id': profile.company_id,
+                                                                        'legal_form': 'Auto-entrepreneur',
+                                                                        'email': user.email,
+                                                                        'address': address,
+                                                                        'owner': provider})
+            # create a related project if needed
+            # set it to finished to clear daily business
+            project, created = Project.objects.get_or_create(state=PROJECT_STATE_FINISHED,
+                                                             customer=customer,
+                                                             name='Subscription %s - %s %s' % (Site.objects.get_current().name, user.first_name, user.last_name),
+                                                             defaults={'state': PROJECT_STATE_FINISHED,
+                                                                       'customer': customer,
+                                                                       'name': 'Subscription %s - %s %s' % (Site.objects.get_current().name, user.first_name, user.last_name),
+                                                                       'owner': provider})
+
+            # create proposal for this subscription
+            begin_date = datetime.date.today()
+            if begin_date < last_subscription.expiration_date:
+                begin_date = last_subscription.expiration_date
+
+            proposal = Proposal.objects.create(project=project,
+                                               reference='subscription%i%i%i' % (subscription.expiration_date.year,
+                                                                                  subscription.expiration_date.month,
+                                                                                  subscription.expiration_date.day),
+                                               state=PROPOSAL_STATE_BALANCED,
+                                               begin_date=begin_date,
+                                               end_date=subscription.expiration_date,
+                                               contract_content='',
+                                               update_date=datetime.date.today(),
+                                               expiration_date=None,
+                                               owner=provider)
+
+            unit_price = Decimal(settings.PAYPAL_APP_SUBSCRIPTION_AMOUNT)
+            if provider.get_profile().vat_number:
+                unit_price = Decimal(unit_price) / Decimal('1.196')
+
+            proposal_row = ProposalRow.objects.create(proposal=proposal,
+                                                      label=item_name,
+                                                      category=ROW_CATEGORY_SERVICE,
+                                                      quantity=1,
+                                                      unit_price='%s' % unit_price,
+                                                      owner=provider)
+
+            # finally create invoice
+            invoice = Invoice.objects.create(customer=customer,
+                                             invoice_id=Invoice.objects.get_next_invoice_id(provider),
+                                             state=INVOICE_STATE_PAID,
+                                             amount=payment_amount,
+                                             edition_date=datetime.date.today(),
+                                             payment_date=datetime.date.today(),
+                                             paid_date=datetime.date.today(),
+                                             payment_type=PAYMENT_TYPE_BANK_CARD,
+                                             execution_begin_date=begin_date,
+                                             execution_end_date=subscription.expiration_date,
+                                             penalty_date=None,
+                                             penalty_rate=None,
+                                             discount_conditions=None,
+                                             owner=provider)
+
+            invoice_row = InvoiceRow.objects.create(proposal=proposal,
+                                                    invoice=invoice,
+                                                    label=item_name,
+                                                    category=ROW_CATEGORY_SERVICE,
+                                                    quantity=1,
+                                                    unit_price=payment_amount,
+                                                    balance_payments=True,
+                                                    vat_rate=VAT_RATES_19_6,
+                                                    owner=provider)
+            # create expense for paypal fee
+            expense = Expense.objects.create(date=datetime.date.today(),
+                                             reference=transaction_id,
+                                             supplier='Paypal',
+                                             amount=fee,
+                                             payment_type=PAYMENT_TYPE_BANK_CARD,
+                                             description='Commission paypal',
+                                             owner=provider)
+
+            # generate invoice in pdf
+            response = HttpResponse(mimetype='application/pdf')
+            invoice.to_pdf(provider, response)
+
+            subject_template = loader.get_template('core/subscription_paid_email_subject.html')
+            subject_context = {'site_name': Site.objects.get_current().name}
+            subject = subject_template.render(Context(subject_context))
+            body_template = loader.get_template('core/subscription_paid_email.html')
+            body_context = {'site_name': Site.objects.get_current().name,
+                            'expiration_date': subscription.expiration_date}
+            body = body_template.render(Context(body_context))
+            email = EmailMessage(subject=subject,
+                                 body=body,
+                                 to=[user.email])
+            email.attach('facture_%i.pdf' % (invoice.invoice_id), response.content, 'application/pdf')
+
+        subscription.save()
+
+    return subscription, email
+
+def process_ipn(ipn):
+    """
+    Verifies and fulfills ipn, records the result. Returns True when it
+    is done, False when it fails.
+    """
+    now = datetime.datetime.now()
+    try:
+        paypal_response = verify_ipn(smart_str(ipn.payload))
+        subscription, email = fulfill_ipn(dict(QueryDict(smart_str(ipn.payload)).items()), paypal_response)
+    except Exception as e:
+        attempts = ipn.attempts + 1
+        if attempts >= IPN_MAX_ATTEMPTS:
+            state = IPN_STATE_FAILED
+        else:
+            state = IPN_STATE_PENDING
+        logger.warning('Processing paypal notification %i of transaction %s failed: %s' % (ipn.id, ipn.transaction_id, e))
+        PaypalIpn.objects.filter(pk=ipn.id).update(state=state,
+                                                   attempts=attempts,
+                                                   error_message=unicode(e)[:255],
+                                                   next_attempt_datetime=now + datetime.timedelta(seconds=IPN_RETRY_DELAY * 2 ** (attempts - 1)),
+                                                   claim=None)
+        transaction.commit_unless_managed()
+        return False
+
+    error_message = None
+    if paypal_response <> 'VERIFIED':
+        error_message = paypal_response[:255]
+    PaypalIpn.objects.filter(pk=ipn.id).update(state=IPN_STATE_DONE,
+                                               attempts=F('attempts') + 1,
+                                               processed_datetime=now,
+                                               error_message=error_message,
+                                               claim=None)
+    transaction.commit_unless_managed()
+    # the payment is committed, a failure from now on is not retried
+    if email:
+        email.send(fail_silently=(not settings.DEBUG))
+    return True
+
+def process_paypal_ipns():
+    """
+    Processes notifications which are due, returns counts of processed
+    notifications and of failed ones, retried later or given up
+    """
+    token = uuid.uuid4().hex
+    done = 0
+    failed = 0
+    while True:
+        ipns = PaypalIpn.objects.claim(token, IPN_BATCH_SIZE)
+        transaction.commit_unless_managed()
+        if not ipns:
+            break
+        for ipn in ipns:
+            if process_ipn(ipn):
+                done = done + 1
+            else:
+                failed = failed + 1
+    return done, failed
@@ -0,0 +1,184 @@
+"""
+Purge of users and everything they own, by chunks of users.
+
+Each chunk is deleted in one transaction with one statement per table,
+tables referencing others first, without loading objects or sending
+signals. Rows of other users pointing to purged ones through a nullable
+foreign key, like bug reports or forum messages, are kept and detached.
+Upload directories are removed in threads once their chunk is committed.
+"""
+import logging
+import os
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from core.models import OwnedObject, PURGE_CHUNK_SIZE, get_owned_models, \
+    purge_owned_objects
+
+# threads removing upload directories
+PURGE_FILE_THREADS = 4
+
+logger = logging.getLogger('core.purge')
+
+def get_user_steps():
+    """
+    Returns statements purging rows related to users, except owned objects,
+    as (action, table, column, condition) where action is 'delete' or
+    'detach', in execution order. Conditions select rows from the ids of
+    the purged users, given as the only parameters.
+    """
+    qn = connection.ops.quote_name
+    user_ids = '%s IN (%%(ids)s)' % (qn(User._meta.pk.column))
+    steps = []
+
+    def collect(model, condition, path):
+        for related in model._meta.get_all_related_objects():
+            related_model = related.model
+            if issubclass(related_model, OwnedObject):
+                continue
+            column = qn(related.field.column)
+            related_condition = '%s IN (SELECT %s FROM %s WHERE %s)' % (column,
+                                                                       qn(related.field.rel.get_related_field().column),
+                                                                       qn(model._meta.db_table),
+                                                                       condition)
+            if related.field.null:
+                steps.append(('detach', qn(related_model._meta.db_table), column, related_condition))
+                continue
+            if related_model in path:
+                raise Exception('Circular references between %s' % (', '.join([model.__name__ for model in path])))
+            collect(related_model, related_condition, path + [related_model])
+
+        for field in model._meta.local_many_to_many:
+            steps.append(('delete', qn(field.m2m_db_table()), None,
+                          '%s IN (SELECT %s FROM %s WHERE %s)' % (qn(field.m2m_column_name()),
+                                                                  qn(model._meta.pk.column),
+                                                                  qn(model._meta.db_table),
+                                                                  condition)))
+        for related in model._meta.get_all_related_many_to_many_objects():
+            steps.append(('delete', qn(related.field.m2m_db_table()), None,
+                          '%s IN (SELECT %s FROM %s WHERE %s)' % (qn(related.field.m2m_reverse_name()),
+                                                                  qn(model._meta.pk.column),
+                                                                  qn(model._meta.db_table),
+                                                                  condition)))
+        if model is not User:
+            steps.append(('delete', qn(model._meta.db_table), None, condition))
+
+    collect(User, user_ids, [User])
+    return steps, 'DELETE FROM %s WHERE %s' % (qn(User._meta.db_table), user_ids)
+
+def get_upload_dirs(user_ids):
+    from autoentrepreneur.models import UserProfile
+    return ['%s%s' % (settings.FILE_UPLOAD_DIR, uuid)
+            for uuid in UserProfile.objects.filter(user__in=user_ids).values_list('uuid', flat=True)]
+
+def count_rows(user_ids):
+    """
+    Returns the number of rows purge_users would delete or detach for
+    user_ids, by table
+    """
+    steps, user_sql = get_user_steps()
+    params = {'ids': ', '.join(['%s'] * len(user_ids))}
+    cursor = connection.cursor()
+    counts = {}
+    for action, table, column, condition in steps:
+        cursor.execute('SELECT COUNT(*) FROM %s WHERE %s' % (table, condition % params), user_ids)
+        counts[table] = counts.get(table, 0) + cursor.fetchone()[0]
+    for model in get_owned_models() + [OwnedObject]:
+        counts[model._meta.db_table] = model.objects.filter(owner__in=user_ids).count()
+    counts[User._meta.db_table] = User.objects.filter(pk__in=user_ids).count()
+    return counts
+
+@transaction.commit_on_success
+def purge_chunk(user_ids):
+    """
+    Deletes user_ids and their rows in one transaction, returns the
+    number of deleted or detached rows
+    """
+    steps, user_sql = get_user_steps()
+    params = {'ids': ', '.join(['%s'] * len(user_ids))}
+    cursor = connection.cursor()
+    count = 0
+    for action, table, column, condition in steps:
+        if action == 'detach':
+            sql = 'UPDATE %s SET %s = NULL WHERE %s' % (table, column, condition % params)
+        else:
+            sql = 'DELETE FROM %s WHERE %s' % (table, condition % params)
+        cursor.execute(sql, user_ids)
+        count = count + cursor.rowcount
+    # user profiles are deleted, so are their addresses
+    count = count + purge_owned_objects(user_ids)
+    cursor.execute(user_sql % params, user_ids)
+    return count + cursor.rowcount
+
+def purge_users(user_ids, dry_run=False, chunk_size=PURGE_CHUNK_SIZE, threads=PURGE_FILE_THREADS):
+    """
+    Purges user_ids with their data and upload directories, chunk_size
+    users per transaction. With dry_run nothing is deleted and rows are
+    only counted. Returns a dict with users, rows, directories and seconds.
+    """
+    start = time.time()
+    user_ids = list(user_ids)
+    result = {'users': 0,
+              'rows': 0,
+              'directories': 0,
+              'seconds': 0}
+    pool = None
+    if not dry_run:
+        pool = ThreadPool(threads)
+    try:
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            directories = [directory for directory in get_upload_dirs(chunk) if os.path.exists(directory)]
+            if dry_run:
+                rows = sum(count_rows(chunk).values())
+            else:
+                rows = purge_chunk(chunk)
+                # files go once their owners are gone for good
+                for directory in directories:
+                    pool.apply_async(shutil.rmtree, (directory, True))
+            result['users'] = result['users'] + len(chunk)
+            result['rows'] = result['rows'] + rows
+            result['directories'] = result['directories'] + len(directories)
+            logger.info('%i/%i users purged%s, %.1f users per second' % (result['users'],
+                                                                        len(user_ids),
+                                                                        dry_run and ' (dry run)' or '',
+                                                                        result['users'] / max(time.time() - start, 0.001)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    result['seconds'] = time.time() - start
+    return result
+
+class PurgeCommand(BaseCommand):
+    """
+    Command purging the users returned by get_user_ids
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Count what would be deleted without deleting anything'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=PURGE_CHUNK_SIZE,
+                    help='Users deleted in one transaction'),
+    )
+
+    def get_user_ids(self):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+        result = purge_users(self.get_user_ids(),
+                             dry_run=dry_run,
+                             chunk_size=options.get('chunk_size') or PURGE_CHUNK_SIZE)
+        seconds = max(result['seconds'], 0.001)
+        self.stdout.write("%i user(s) %s, %i rows, %i directories in %.2f s (%.1f users/s, %.1f rows/s)\n" % (result['users'],
+                                                                                                            dry_run and 'to delete' or 'deleted',
+                                                                                                            result['rows'],
+                                                                                                            result['directories'],
+                                                                                                            result['seconds'],
+                                                                                                            result['users'] / seconds,
+                                                                                                            result['rows'] / seconds))
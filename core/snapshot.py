@@ -0,0 +1,112 @@
+"""
+Snapshots of the rows of users.
+
+A snapshot holds every row purge_users would delete for some users, by
+table, in an order where referenced rows come first. Restoring it inserts
+the rows back with one statement per table, without creating objects or
+sending signals, dates moved by a given delta.
+"""
+import cPickle
+import datetime
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction, models
+from core.models import OwnedObject, get_owned_models, get_purge_order
+from core.purge import get_user_steps
+
+def get_user_tables():
+    """
+    Returns (table, condition) of tables holding rows of users, referenced
+    tables first. Conditions select rows from the ids of the users, given
+    as the only parameters.
+    """
+    qn = connection.ops.quote_name
+    user_ids = '%s IN (%%(ids)s)' % (qn(User._meta.pk.column))
+    owned_ids = '%s IN (%%(ids)s)' % (qn(OwnedObject._meta.get_field('owner').column))
+    owned_pks = 'IN (SELECT %s FROM %s WHERE %s)' % (qn(OwnedObject._meta.pk.column),
+                                                     qn(OwnedObject._meta.db_table),
+                                                     owned_ids)
+    owned_models = get_owned_models()
+    tables = [(qn(User._meta.db_table), user_ids),
+              (qn(OwnedObject._meta.db_table), owned_ids)]
+
+    for model in reversed(get_purge_order(owned_models)):
+        tables.append((qn(model._meta.db_table), '%s %s' % (qn(model._meta.pk.column), owned_pks)))
+    for model in owned_models:
+        for field in model._meta.local_many_to_many:
+            tables.append((qn(field.m2m_db_table()), '%s %s' % (qn(field.m2m_column_name()), owned_pks)))
+
+    steps, user_sql = get_user_steps()
+    for action, table, column, condition in reversed(steps):
+        if action == 'delete':
+            tables.append((table, condition))
+    return tables
+
+def capture_users(user_ids):
+    """
+    Returns a snapshot of the rows of user_ids, as a list of
+    (table, columns, rows)
+    """
+    params = {'ids': ', '.join(['%s'] * len(user_ids))}
+    cursor = connection.cursor()
+    snapshot = []
+    for table, condition in get_user_tables():
+        cursor.execute('SELECT * FROM %s WHERE %s' % (table, condition % params), user_ids)
+        rows = cursor.fetchall()
+        if rows:
+            columns = [column[0] for column in cursor.description]
+            snapshot.append((table, columns, [tuple(row) for row in rows]))
+    return snapshot
+
+@transaction.commit_on_success
+def restore_snapshot(snapshot, delta=datetime.timedelta(0)):
+    """
+    Inserts the rows of snapshot, dates and datetimes moved by delta, then
+    sets sequences after them. Returns the number of inserted rows.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    count = 0
+    for table, columns, rows in snapshot:
+        if delta:
+            rows = [tuple([isinstance(value, datetime.date) and value + delta or value for value in row])
+                    for row in rows]
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table,
+                                                                ', '.join([qn(column) for column in columns]),
+                                                                ', '.join(['%s'] * len(columns))),
+                           rows)
+        count = count + len(rows)
+
+    tables = set([table for table, columns, rows in snapshot])
+    model_list = [model for model in models.get_models(include_auto_created=True)
+                  if qn(model._meta.db_table) in tables]
+    for query in connection.ops.sequence_reset_sql(no_style(), model_list):
+        cursor.execute(query.encode('utf-8'))
+    return count
+
+def save_snapshot(snapshot, path, date=None):
+    """
+    Writes snapshot to path with the date of its rows, today by default
+    """
+    file = open(path, 'wb')
+    try:
+        cPickle.dump({'date': date or datetime.date.today(),
+                      'tables': snapshot},
+                     file,
+                     cPickle.HIGHEST_PROTOCOL)
+    finally:
+        file.close()
+
+def load_snapshot(path):
+    """
+    Returns (date, snapshot) saved at path, None when there is none
+    """
+    try:
+        file = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        data = cPickle.load(file)
+    finally:
+        file.close()
+    return data['date'], data['tables']
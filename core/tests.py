@@ -6,16 +6,38 @@ import autoentrepreneur
 import accounts
 import core.views
 from autoentrepreneur.models import AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_LIBERAL, \
-    Subscription, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, UserProfile
+    Subscription, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, UserProfile, \
+    SUBSCRIPTION_STATE_NOT_PAID
 import datetime
 from registration.models import RegistrationProfile
 from django.test import TestCase
-from core.models import OwnedObject
+from core.models import OwnedObject, purge_owned_objects
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from django.core.urlresolvers import reverse
 from accounts.models import Invoice, INVOICE_STATE_EDITED, \
     PAYMENT_TYPE_CHECK, INVOICE_STATE_PAID, InvoiceRow, INVOICE_STATE_SENT
+from core.models import PaypalIpn, IPN_STATE_PENDING, IPN_STATE_DONE
+from core.paypal import process_paypal_ipns
+from core.models import SpooledMail, MAIL_STATE_PENDING, MAIL_STATE_SENT, \
+    MAIL_STATE_FAILED
+from core.mail import MailRenderer, render_signature
+from core.mail import enqueue_mass_mail, send_spooled_mail, record_results, \
+    MAIL_MAX_ATTEMPTS, MAIL_MAX_RETRY_DELAY, get_retry_delay
+from django.core import mail
+from django.conf import settings
+import asyncore
+import smtpd
+import threading
+import BaseHTTPServer
+import urllib
+import tempfile
+import shutil
+from django.core.management import call_command
+from contact.models import Contact
+from project.models import ProposalRow
+from core.snapshot import load_snapshot, save_snapshot
+from core.management.commands.reset_demo_account import DEMO_SNAPSHOT_FILE
 
 class PermissionTest(TestCase):
     def test_save_owned_object(self):
@@ -1305,3 +1327,321 @@ class AdminDashboardTest(TestCase):
         self.assertEquals(users[3]['value'], 3) # expired users
         self.assertEquals(users[4]['value'], 4) # active users
         self.assertEquals(users[5]['value'], 1) # subscribed users
+
+class PurgeTest(TestCase):
+    fixtures = ['test_dashboard']
+
+    def testPurgeKeepsProfileAddress(self):
+        user = User.objects.get(pk=1)
+        other_count = OwnedObject.objects.exclude(owner=user).count()
+        self.assertTrue(Invoice.objects.filter(owner=user).count())
+
+        purge_owned_objects([user.id])
+
+        self.assertEquals(list(OwnedObject.objects.filter(owner=user).values_list('id', flat=True)),
+                          [user.get_profile().address_id])
+        self.assertEquals(InvoiceRow.objects.filter(owner=user).count(), 0)
+        self.assertEquals(OwnedObject.objects.exclude(owner=user).count(), other_count)
+
+    def testPurgeOnlyGivenModels(self):
+        user = User.objects.get(pk=1)
+        subscription_count = Subscription.objects.filter(owner=user).count()
+        proposal_count = Proposal.objects.filter(owner=user).count()
+        self.assertTrue(subscription_count)
+        self.assertTrue(proposal_count)
+
+        purge_owned_objects([user.id], [InvoiceRow, Invoice])
+
+        self.assertEquals(Invoice.objects.filter(owner=user).count(), 0)
+        self.assertEquals(InvoiceRow.objects.filter(owner=user).count(), 0)
+        self.assertEquals(Subscription.objects.filter(owner=user).count(), subscription_count)
+        self.assertEquals(Proposal.objects.filter(owner=user).count(), proposal_count)
+
+class MailRendererTest(TestCase):
+    def testRecipientsShareInvariants(self):
+        renderer = MailRenderer('core/trial_expire_email_subject.html',
+                                'core/trial_expire_email.html')
+        mails = list(renderer.render_mass_mail([(['user1@example.com'], {'days': 7}, 7),
+                                                (['user2@example.com'], {'days': 1}, 1),
+                                                (['user3@example.com'], {'days': 7}, 7)]))
+        self.assertEquals([mail[3] for mail in mails], [['user1@example.com'], ['user2@example.com'], ['user3@example.com']])
+        self.assertTrue(mails[0][1].endswith(render_signature()))
+        self.assertNotEquals(mails[0][1], mails[1][1])
+        # rendered once for both users
+        self.assertTrue(mails[0][1] is mails[2][1])
+        # variables of a recipient are not seen by the next ones
+        self.assertFalse('days' in renderer.context)
+
+class DemoResetTest(TestCase):
+    def setUp(self):
+        self.upload_dir = settings.FILE_UPLOAD_DIR
+        settings.FILE_UPLOAD_DIR = '%s/' % (tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(settings.FILE_UPLOAD_DIR, True)
+        settings.FILE_UPLOAD_DIR = self.upload_dir
+
+    def get_demo_data(self):
+        user = User.objects.get(username='demo')
+        return (user.get_profile().company_name,
+                user.get_profile().get_subscription_status().state,
+                Contact.objects.filter(owner=user).count(),
+                ProposalRow.objects.filter(owner=user).count(),
+                sorted(Invoice.objects.filter(owner=user).values_list('amount', 'edition_date')))
+
+    def testResetRestoresSnapshot(self):
+        call_command('reset_demo_account')
+        path = '%s%s' % (settings.FILE_UPLOAD_DIR, DEMO_SNAPSHOT_FILE)
+        date, snapshot = load_snapshot(path)
+        self.assertEquals(date, datetime.date.today())
+        company_name, state, contact_count, row_count, invoices = self.get_demo_data()
+        self.assertTrue(contact_count)
+        self.assertTrue(row_count)
+
+        # snapshot taken two days ago
+        save_snapshot(snapshot, path, date - datetime.timedelta(2))
+        Invoice.objects.filter(owner__username='demo').update(amount=0)
+        call_command('reset_demo_account')
+
+        self.assertEquals(self.get_demo_data(), (company_name,
+                                                 state,
+                                                 contact_count,
+                                                 row_count,
+                                                 [(amount, edition_date + datetime.timedelta(2)) for amount, edition_date in invoices]))
+        self.assertEquals(User.objects.count(), 1)
+
+class SmtpStandIn(smtpd.SMTPServer):
+    """
+    Local smtp server keeping messages, refusing those whose
+    subject is in refused_subjects
+    """
+
+    def __init__(self, port):
+        smtpd.SMTPServer.__init__(self, ('localhost', port), None)
+        self.messages = []
+        self.connection_count = 0
+        self.refused_subjects = []
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def handle_accept(self):
+        self.connection_count = self.connection_count + 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        for subject in self.refused_subjects:
+            if 'Subject: %s' % (subject) in data:
+                return '451 Try again later'
+        self.messages.append((rcpttos, data))
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+        asyncore.close_all()
+
+class MailSpoolTest(TestCase):
+    def spool(self, count):
+        return enqueue_mass_mail([('Subject %i' % (i),
+                                   'Body %i' % (i),
+                                   'from@example.com',
+                                   ['user%i@example.com' % (i)]) for i in range(count)])
+
+    def testSpooledMessagesAreSent(self):
+        self.assertEquals(self.spool(3), 3)
+        self.assertEquals(len(mail.outbox), 0)
+
+        self.assertEquals(send_spooled_mail(rate=0), (3, 0, 0))
+        self.assertEquals([message.to for message in mail.outbox],
+                          [['user0@example.com'], ['user1@example.com'], ['user2@example.com']])
+        self.assertEquals(SpooledMail.objects.filter(state=MAIL_STATE_SENT).count(), 3)
+        # nothing is sent twice
+        self.assertEquals(send_spooled_mail(rate=0), (0, 0, 0))
+
+    def testClaimedMessagesAreNotClaimedAgain(self):
+        self.spool(3)
+        self.assertEquals(len(SpooledMail.objects.claim('sender1', 2)), 2)
+        self.assertEquals([mail.to for mail in SpooledMail.objects.claim('sender2', 2)], ['user2@example.com'])
+        self.assertEquals(SpooledMail.objects.recover_stale(0), 3)
+        self.assertEquals(SpooledMail.objects.filter(state=MAIL_STATE_PENDING).count(), 3)
+
+    def testSmtpFailureIsRetried(self):
+        email_backend = settings.EMAIL_BACKEND
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+        server = SmtpStandIn(settings.EMAIL_PORT)
+        try:
+            server.refused_subjects = ['Subject 1']
+            self.spool(3)
+            self.assertEquals(send_spooled_mail(connection_count=1, rate=0), (2, 1, 0))
+            self.assertEquals([rcpttos for rcpttos, data in server.messages],
+                              [['user0@example.com'], ['user2@example.com']])
+            # the connection is opened again after the failure
+            self.assertEquals(server.connection_count, 2)
+
+            refused = SpooledMail.objects.get(state=MAIL_STATE_PENDING)
+            self.assertEquals(refused.attempts, 1)
+            self.assertTrue(refused.error_message)
+            self.assertTrue(refused.next_attempt_datetime > datetime.datetime.now())
+            # not due yet
+            self.assertEquals(send_spooled_mail(connection_count=1, rate=0), (0, 0, 0))
+
+            server.refused_subjects = []
+            SpooledMail.objects.filter(pk=refused.id).update(next_attempt_datetime=datetime.datetime.now())
+            self.assertEquals(send_spooled_mail(connection_count=1, rate=0), (1, 0, 0))
+            self.assertEquals(SpooledMail.objects.get(pk=refused.id).state, MAIL_STATE_SENT)
+            self.assertEquals(SpooledMail.objects.get(pk=refused.id).attempts, 2)
+        finally:
+            server.stop()
+            settings.EMAIL_BACKEND = email_backend
+
+    def testMessageIsFailedAfterMaxAttempts(self):
+        self.spool(1)
+        SpooledMail.objects.update(attempts=MAIL_MAX_ATTEMPTS - 1)
+        self.assertEquals(record_results([(SpooledMail.objects.get(), Exception('Mailbox unavailable'))]), (0, 0, 1))
+        self.assertEquals(SpooledMail.objects.get().state, MAIL_STATE_FAILED)
+        self.assertEquals(SpooledMail.objects.get().error_message, 'Mailbox unavailable')
+
+    def testRetriesOutlastAnOutage(self):
+        delays = [get_retry_delay(attempts) for attempts in range(1, MAIL_MAX_ATTEMPTS)]
+        self.assertEquals(max(delays), MAIL_MAX_RETRY_DELAY)
+        self.assertTrue(sum(delays) >= 5 * 60 * 60)
+
+class PaypalStandIn(BaseHTTPServer.HTTPServer):
+    """
+    Local verification endpoint answering answer to every notification,
+    keeping what it is sent
+    """
+
+    def __init__(self, port):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), PaypalStandInHandler)
+        self.answer = 'VERIFIED'
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+class PaypalStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.requests.append(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(self.server.answer)
+
+    def log_message(self, format, *args):
+        pass
+
+class PaypalIpnTest(TestCase):
+    fixtures = ['test_users']
+
+    def setUp(self):
+        self.verify_url = settings.PAYPAL_IPN_VERIFY_URL
+        settings.PAYPAL_IPN_VERIFY_URL = 'http://localhost:8025/cgi-bin/webscr'
+
+    def tearDown(self):
+        settings.PAYPAL_IPN_VERIFY_URL = self.verify_url
+
+    def notify(self, transaction_id, receiver_id='somebody else'):
+        # posted urlencoded like paypal does
+        return self.client.post(reverse('paypal_ipn'), urllib.urlencode({'receiver_id': receiver_id,
+                                                                         'txn_id': transaction_id,
+                                                                         'payment_status': 'Completed',
+                                                                         'mc_gross': settings.PAYPAL_APP_SUBSCRIPTION_AMOUNT,
+                                                                         'mc_currency': settings.PAYPAL_APP_SUBSCRIPTION_CURRENCY,
+                                                                         'mc_fee': '0.10',
+                                                                         'item_name': 'Subscription',
+                                                                         'custom': '1'}),
+                                content_type='application/x-www-form-urlencoded')
+
+    def testNotificationIsProcessedLater(self):
+        response = self.notify('TXN1')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(PaypalIpn.objects.get().transaction_id, 'TXN1')
+        self.assertFalse(Subscription.objects.filter(transaction_id='TXN1').count())
+
+        server = PaypalStandIn(8025)
+        try:
+            server.answer = 'INVALID'
+            self.assertEquals(process_paypal_ipns(), (1, 0))
+            self.assertTrue(server.requests[0].startswith('cmd=_notify-validate&'))
+            self.assertTrue('txn_id=TXN1' in server.requests[0])
+        finally:
+            server.stop()
+
+        subscription = Subscription.objects.get(transaction_id='TXN1')
+        self.assertEquals(subscription.state, SUBSCRIPTION_STATE_NOT_PAID)
+        self.assertEquals(subscription.error_message, ugettext('Not verified'))
+        ipn = PaypalIpn.objects.get()
+        self.assertEquals(ipn.state, IPN_STATE_DONE)
+        self.assertEquals(ipn.error_message, 'INVALID')
+        # nothing is processed twice
+        self.assertEquals(process_paypal_ipns(), (0, 0))
+
+    def testUnverifiedNotificationIsRetried(self):
+        self.notify('TXN1')
+        # no paypal to verify it
+        self.assertEquals(process_paypal_ipns(), (0, 1))
+        ipn = PaypalIpn.objects.get()
+        self.assertEquals(ipn.state, IPN_STATE_PENDING)
+        self.assertEquals(ipn.attempts, 1)
+        self.assertTrue(ipn.next_attempt_datetime > datetime.datetime.now())
+        self.assertFalse(Subscription.objects.filter(transaction_id='TXN1').count())
+
+        ipn.next_attempt_datetime = datetime.datetime.now()
+        ipn.save()
+        server = PaypalStandIn(8025)
+        try:
+            self.assertEquals(process_paypal_ipns(), (1, 0))
+        finally:
+            server.stop()
+        subscription = Subscription.objects.get(transaction_id='TXN1')
+        self.assertEquals(subscription.error_message, ugettext('Receiver is not as defined in settings. Spoofing ?'))
+
+    def testPaidTransactionIsFulfilledOnce(self):
+        subscription = Subscription.objects.get(transaction_id='ABCD')
+        subscription.state = SUBSCRIPTION_STATE_PAID
+        subscription.error_message = 'Paid'
+        subscription.save()
+        invoice_count = Invoice.objects.count()
+
+        self.notify('ABCD')
+        server = PaypalStandIn(8025)
+        try:
+            self.assertEquals(process_paypal_ipns(), (1, 0))
+        finally:
+            server.stop()
+        subscription = Subscription.objects.get(transaction_id='ABCD')
+        self.assertEquals(subscription.state, SUBSCRIPTION_STATE_PAID)
+        self.assertEquals(subscription.error_message, 'Paid')
+        self.assertEquals(Invoice.objects.count(), invoice_count)
+
+    def testTransactionPaidMeanwhileIsNotFulfilled(self):
+        invoice_count = Invoice.objects.count()
+        get_or_create = Subscription.objects.get_or_create
+        def paid_meanwhile(**kwargs):
+            subscription, created = get_or_create(**kwargs)
+            # another worker pays the transaction once it has been read
+            Subscription.objects.filter(pk=subscription.pk).update(state=SUBSCRIPTION_STATE_PAID,
+                                                                   error_message='Paid')
+            return subscription, created
+
+        self.notify('TXN1', receiver_id=settings.PAYPAL_RECEIVER_ID)
+        Subscription.objects.get_or_create = paid_meanwhile
+        server = PaypalStandIn(8025)
+        try:
+            mail.outbox = []
+            self.assertEquals(process_paypal_ipns(), (1, 0))
+        finally:
+            server.stop()
+            del Subscription.objects.get_or_create
+        self.assertEquals(Subscription.objects.get(transaction_id='TXN1').state, SUBSCRIPTION_STATE_PAID)
+        self.assertEquals(Invoice.objects.count(), invoice_count)
+        self.assertEquals(len(mail.outbox), 0)
@@ -1,8 +1,7 @@
 import logging
-from decimal import Decimal
-from django.shortcuts import render_to_response, redirect, get_object_or_404
-from django.template.context import RequestContext, Context
-from django.utils.translation import ugettext_lazy as _, ugettext
+from django.shortcuts import render_to_response, redirect
+from django.template.context import RequestContext
+from django.utils.translation import ugettext_lazy as _
 from core.forms import UserForm, PasswordForm, ResendActivationEmailForm, \
     ContactUsForm
 from autoentrepreneur.forms import UserProfileForm
@@ -12,34 +11,32 @@ from django.core.urlresolvers import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils import simplejson
-from accounts.models import Expense, Invoice, INVOICE_STATE_PAID, \
-    PAYMENT_TYPE_BANK_CARD, InvoiceRow
+from accounts.models import Expense, Invoice
 from core.decorators import settings_required, disabled_for_demo
 from autoentrepreneur.models import AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC, \
-    Subscription, SUBSCRIPTION_STATE_NOT_PAID, SUBSCRIPTION_STATE_PAID, \
+    Subscription, SUBSCRIPTION_STATE_PAID, \
     SUBSCRIPTION_STATE_TRIAL, UserProfile
-from project.models import Proposal, Project, PROJECT_STATE_FINISHED, \
-    PROPOSAL_STATE_BALANCED, ROW_CATEGORY_SERVICE, ProposalRow, VAT_RATES_19_6
+from project.models import Proposal
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from autoentrepreneur.decorators import subscription_required
 from django.contrib.auth import logout
 from django.core.mail import mail_admins
 from announcement.models import Announcement
-from contact.models import Contact, CONTACT_TYPE_COMPANY, Address
 from django.contrib.sites.models import Site
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, \
+    HttpResponseNotAllowed
 from django.core.mail.message import EmailMessage
-from django.template import loader
 from django.contrib.admin.views.decorators import staff_member_required
 import time
 import datetime
-import urllib, urllib2
 from django.conf import settings
 from registration.models import RegistrationProfile
+from core.models import PaypalIpn
 from django.utils.encoding import smart_str
 import os
 from django.db.models.aggregates import Sum
+from project.utils.logo import prepare_logo, delete_prepared_logo
 
 @settings_required
 @subscription_required
@@ -307,6 +304,8 @@ def settings_edit(request):
                     pass
             userform.save()
             profile = profileform.save()
+            if request.FILES and profile.logo_file:
+                prepare_logo(profile)
             address = addressform.save(commit=False)
             address.save(user=user)
             messages.success(request, _('Your settings have been updated successfully'))
@@ -336,6 +335,7 @@ def logo_overview(request):
     if not file:
         return HttpResponseNotFound()
 
+    # the uploaded logo, the one prepared for pdf headers is only used there
     response = HttpResponse(mimetype='application/force-download')
     response['Content-Disposition'] = 'attachment;filename="%s"'\
                                     % smart_str(file.name)
@@ -353,6 +353,7 @@ def logo_delete(request):
             if profile.logo_file:
                 if os.path.exists(profile.logo_file.path):
                     os.remove(profile.logo_file.path)
+                delete_prepared_logo(profile)
                 profile.logo_file = ""
                 profile.save()
             response['error'] = 'ok'
@@ -421,163 +422,11 @@ def subscription_paid(request):
 @csrf_exempt
 @commit_on_success
 def paypal_ipn(request):
-    # send back the response to paypal
-    data = dict(request.POST.items())
-    args = {'cmd': '_notify-validate'}
-    args.update(data)
-    params = urllib.urlencode(dict([k, v.encode('utf-8')] for k, v in args.items()))
-    paypal_response = urllib2.urlopen(settings.PAYPAL_URL + '/cgi-bin/webscr', params).read()
-
-    # process the payment
-    receiver_id = data['receiver_id']
-    transaction_id = data['txn_id']
-    payment_status = data['payment_status']
-    payment_amount = data['mc_gross']
-    payment_currency = data['mc_currency']
-    fee = data['mc_fee']
-    item_name = data['item_name']
-    user_id = data['custom']
-    user = get_object_or_404(User, pk=user_id)
-    profile = user.get_profile()
-    last_subscription = profile.get_last_subscription()
-
-    subscription, created = Subscription.objects.get_or_create(transaction_id=transaction_id,
-                                                               defaults={'owner': user,
-                                                                         'state': SUBSCRIPTION_STATE_NOT_PAID,
-                                                                         'expiration_date': profile.get_next_expiration_date(),
-                                                                         'transaction_id': transaction_id,
-                                                                         'error_message': ugettext('Not verified')})
-
-    if paypal_response == 'VERIFIED':
-        if receiver_id <> settings.PAYPAL_RECEIVER_ID:
-            subscription.error_message = ugettext('Receiver is not as defined in settings. Spoofing ?')
-        elif payment_status <> 'Completed':
-            subscription.error_message = ugettext('Payment not completed')
-        elif payment_amount <> settings.PAYPAL_APP_SUBSCRIPTION_AMOUNT:
-            subscription.error_message = ugettext('Amount altered. Bad guy ?')
-        elif payment_currency <> settings.PAYPAL_APP_SUBSCRIPTION_CURRENCY:
-            subscription.error_message = ugettext('Amount altered. Bad guy ?')
-        else:
-            subscription.error_message = ugettext('Paid')
-            subscription.state = SUBSCRIPTION_STATE_PAID
-
-            # create an invoice for this payment
-            # first, get the provider user
-            provider = User.objects.get(email=settings.SERVICE_PROVIDER_EMAIL)
-            if provider.get_profile().vat_number:
-                payment_amount = Decimal(payment_amount) / Decimal('1.196')
-
-            # look for a customer corresponding to user
-            address, created = Address.objects.get_or_create(contact__email=user.email,
-                                                             owner=provider,
-                                                             defaults={'street': profile.address.street,
-                                                                       'zipcode': profile.address.zipcode,
-                                                                       'city': profile.address.city,
-                                                                       'country': profile.address.country,
-                                                                       'owner': provider})
-            customer, created = Contact.objects.get_or_create(email=user.email,
-                                                              defaults={'contact_type': CONTACT_TYPE_COMPANY,
-                                                                        'name': '%s %s' % (user.first_name, user.last_name),
-                                                                        'company_id': profile.company_id,
-                                                                        'legal_form': 'Auto-entrepreneur',
-                                                                        'email': user.email,
-                                                                        'address': address,
-                                                                        'owner': provider})
-            # create a related project if needed
-            # set it to finished to clear daily business
-            project, created = Project.objects.get_or_create(state=PROJECT_STATE_FINISHED,
-                                                             customer=customer,
-                                                             name='Subscription %s - %s %s' % (Site.objects.get_current().name, user.first_name, user.last_name),
-                                                             defaults={'state': PROJECT_STATE_FINISHED,
-                                                                       'customer': customer,
-                                                                       'name': 'Subscription %s - %s %s' % (Site.objects.get_current().name, user.first_name, user.last_name),
-                                                                       'owner': provider})
-
-            # create proposal for this subscription
-            begin_date = datetime.date.today()
-            if begin_date < last_subscription.expiration_date:
-                begin_date = last_subscription.expiration_date
-
-            proposal = Proposal.objects.create(project=project,
-                                               reference='subscription%i%i%i' % (subscription.expiration_date.year,
-                                                                                  subscription.expiration_date.month,
-                                                                                  subscription.expiration_date.day),
-                                               state=PROPOSAL_STATE_BALANCED,
-                                               begin_date=begin_date,
-                                               end_date=subscription.expiration_date,
-                                               contract_content='',
-                                               update_date=datetime.date.today(),
-                                               expiration_date=None,
-                                               owner=provider)
-
-            unit_price = Decimal(settings.PAYPAL_APP_SUBSCRIPTION_AMOUNT)
-            if provider.get_profile().vat_number:
-                unit_price = Decimal(unit_price) / Decimal('1.196')
-
-            proposal_row = ProposalRow.objects.create(proposal=proposal,
-                                                      label=item_name,
-                                                      category=ROW_CATEGORY_SERVICE,
-                                                      quantity=1,
-                                                      unit_price='%s' % unit_price,
-                                                      owner=provider)
-
-            # finally create invoice
-            invoice = Invoice.objects.create(customer=customer,
-                                             invoice_id=Invoice.objects.get_next_invoice_id(provider),
-                                             state=INVOICE_STATE_PAID,
-                                             amount=payment_amount,
-                                             edition_date=datetime.date.today(),
-                                             payment_date=datetime.date.today(),
-                                             paid_date=datetime.date.today(),
-                                             payment_type=PAYMENT_TYPE_BANK_CARD,
-                                             execution_begin_date=begin_date,
-                                             execution_end_date=subscription.expiration_date,
-                                             penalty_date=None,
-                                             penalty_rate=None,
-                                             discount_conditions=None,
-                                             owner=provider)
-
-            invoice_row = InvoiceRow.objects.create(proposal=proposal,
-                                                    invoice=invoice,
-                                                    label=item_name,
-                                                    category=ROW_CATEGORY_SERVICE,
-                                                    quantity=1,
-                                                    unit_price=payment_amount,
-                                                    balance_payments=True,
-                                                    vat_rate=VAT_RATES_19_6,
-                                                    owner=provider)
-            # create expense for paypal fee
-            expense = Expense.objects.create(date=datetime.date.today(),
-                                             reference=transaction_id,
-                                             supplier='Paypal',
-                                             amount=fee,
-                                             payment_type=PAYMENT_TYPE_BANK_CARD,
-                                             description='Commission paypal',
-                                             owner=provider)
-
-            # generate invoice in pdf
-            response = HttpResponse(mimetype='application/pdf')
-            invoice.to_pdf(provider, response)
-
-            subject_template = loader.get_template('core/subscription_paid_email_subject.html')
-            subject_context = {'site_name': Site.objects.get_current().name}
-            subject = subject_template.render(Context(subject_context))
-            body_template = loader.get_template('core/subscription_paid_email.html')
-            body_context = {'site_name': Site.objects.get_current().name,
-                            'expiration_date': subscription.expiration_date}
-            body = body_template.render(Context(body_context))
-            email = EmailMessage(subject=subject,
-                                 body=body,
-                                 to=[user.email])
-            email.attach('facture_%i.pdf' % (invoice.invoice_id), response.content, 'application/pdf')
-            email.send(fail_silently=(not settings.DEBUG))
-
-        subscription.save()
-
-    return render_to_response('core/paypal_ipn.html',
-                              {'active': 'account',
-                               'title': _('Subscribe')},
-                              context_instance=RequestContext(request))
+    # verified and processed later by process_paypal_ipn
+    if request.method <> 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    PaypalIpn.objects.enqueue(request.raw_post_data, request.POST.get('txn_id', ''))
+    return HttpResponse('OK')
 
 @disabled_for_demo
 @login_required
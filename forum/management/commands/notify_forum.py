@@ -1,57 +1,50 @@
 from django.core.management.base import BaseCommand
-from accounts.models import Invoice
-from django.template import loader
-from django.contrib.sites.models import Site
-from django.template.context import Context
-from django.conf import settings
-from django.core.mail import send_mass_mail
+from django.db.models.aggregates import Max
+from core.mail import enqueue_mass_mail, send_spooled_mail, MailRenderer, \
+    format_recipient
 from forum.models import MessageNotification
-from django.contrib.auth.models import User
+from itertools import groupby
 
 class Command(BaseCommand):
     help = "Send emails to user to notify them about new messages in forum"
 
     def handle(self, *args, **options):
-        notifications = MessageNotification.objects.all()
-        # for each notification get all users having forum notification enabled
-        # excluding message author
-        messages = []
-
-        for notification in notifications:
-            topic = notification.message.topic
-
-            notification_email_subject_template = loader.get_template('topic/email_subject.html')
-            notification_email_subject_context = {'topic': topic.title}
-            subject = notification_email_subject_template.render(Context(notification_email_subject_context))
-
-            notification_email_template = loader.get_template('topic/email.html')
-            notification_email_context = {'site': Site.objects.get_current(),
-                                          'message': notification.message}
-            body = notification_email_template.render(Context(notification_email_context))
-
-            signature_template = loader.get_template('newsletter/signature.html')
-            signature_context = {'site': Site.objects.get_current()}
-            signature = signature_template.render(Context(signature_context))
-
-            users = User.objects.filter(notification__notify_forum_answers=True,
-                                        forum_messages__topic=topic)\
-                                .distinct()\
-                                .exclude(pk=notification.message.author.id)\
-                                .order_by('email')
-
-            for user in users:
-                to = '%s %s <%s>' % (user.first_name,
-                                     user.last_name,
-                                     user.email)
-
-                messages.append((subject,
-                                 body + signature,
-                                 settings.DEFAULT_FROM_EMAIL,
-                                 [to]))
-
-            # delete notification in the loop to prevent deleting new notifications
-            # if it were after send_mass_mail
-            notification.delete()
-
-        send_mass_mail(messages, fail_silently=False)
-        self.stdout.write("%d forum notifications sent.\n" % (len(messages)))
+        # notifications created while this runs are left for the next run
+        last_id = MessageNotification.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+        notifications = MessageNotification.objects.filter(pk__lte=last_id)\
+                                                   .select_related('message__topic', 'message__author')
+        notifications = dict([(notification.id, notification) for notification in notifications])
+        recipients = MessageNotification.objects.get_recipients(last_id)
+
+        renderer = MailRenderer('topic/email_subject.html', 'topic/email.html')
+
+        def get_recipients():
+            for user_id, rows in groupby(recipients, lambda row: row[0]):
+                rows = list(rows)
+                notification_ids = tuple(sorted([row[4] for row in rows],
+                                                key=lambda id: (notifications[id].message.creation_date, id)))
+                forum_messages = [notifications[id].message for id in notification_ids]
+                # messages are grouped by topic, topics in order of their first answer
+                topics = []
+                topic_messages = {}
+                for message in forum_messages:
+                    if message.topic_id not in topic_messages:
+                        topic_messages[message.topic_id] = []
+                        topics.append({'topic': message.topic,
+                                       'forum_messages': topic_messages[message.topic_id]})
+                    topic_messages[message.topic_id].append(message)
+                user_id, first_name, last_name, email, notification_id = rows[0]
+                # users who posted in the same topics get the same digest
+                yield ([format_recipient(first_name, last_name, email)],
+                       {'topic': topics[0]['topic'].title,
+                        'topics': topics,
+                        'message_count': len(forum_messages)},
+                       notification_ids)
+
+        # notifications are deleted once their messages are spooled
+        message_count = enqueue_mass_mail(renderer.render_mass_mail(get_recipients()))
+        MessageNotification.objects.delete_up_to(last_id)
+
+        sent, retried, failed = send_spooled_mail()
+        self.stdout.write("%d forum notifications spooled, %d messages sent.\n" % (message_count, sent))
@@ -3,6 +3,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from core.templatetags.modeltags import display_name
 from django.db.models.signals import post_save
+from django.db import connection, transaction
 
 class Topic(models.Model):
     title = models.CharField(max_length=255, verbose_name=_('Title'))
@@ -38,9 +39,53 @@ class Message(models.Model):
     def author_message_count(self):
         return Message.objects.filter(author=self.author).count()
 
+class MessageNotificationManager(models.Manager):
+    def get_recipients(self, last_id):
+        """
+        Returns (user id, first name, last name, email, notification id)
+        for notifications up to last_id and users having forum notification
+        enabled who posted in the topic, excluding the message author.
+        Ordered by user.
+        """
+        from notification.models import Notification
+        qn = connection.ops.quote_name
+        notification_table = qn(self.model._meta.db_table)
+        message_table = qn(Message._meta.db_table)
+        user_table = qn(User._meta.db_table)
+        settings_table = qn(Notification._meta.db_table)
+        sql = 'SELECT DISTINCT u.id, u.first_name, u.last_name, u.email, n.id' \
+              ' FROM %s n' \
+              ' INNER JOIN %s notified ON notified.id = n.message_id' \
+              ' INNER JOIN %s m ON m.topic_id = notified.topic_id' \
+              ' INNER JOIN %s u ON u.id = m.author_id' \
+              ' INNER JOIN %s s ON s.user_id = u.id' \
+              ' WHERE n.id <= %%s' \
+              ' AND s.notify_forum_answers = %%s' \
+              ' AND (notified.author_id IS NULL OR notified.author_id <> u.id)' \
+              ' ORDER BY u.email, u.id, n.id' % (notification_table,
+                                                message_table,
+                                                message_table,
+                                                user_table,
+                                                settings_table)
+        cursor = connection.cursor()
+        cursor.execute(sql, [last_id, True])
+        return cursor.fetchall()
+
+    def delete_up_to(self, last_id):
+        """
+        Deletes notifications up to last_id in one statement, nothing
+        references them
+        """
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE id <= %%s' % (connection.ops.quote_name(self.model._meta.db_table)),
+                       [last_id])
+        transaction.commit_unless_managed()
+
 class MessageNotification(models.Model):
     message = models.ForeignKey(Message, verbose_name=_('Message'))
 
+    objects = MessageNotificationManager()
+
     class Meta:
         ordering = ['message__creation_date']
 
@@ -143,3 +143,56 @@ class ForumTest(TestCase):
 
 
         self.assertEquals(MessageNotification.objects.count(), 0)
+
+    def testNotifyDigest(self):
+        for title in ['Topic 1', 'Topic 2']:
+            self.client.post(reverse('topic_create'),
+                             {'topic-title': title,
+                              'message-body': 'New message body'})
+
+        self.client.logout()
+        self.client.login(username='test2', password='test')
+        for topic in Topic.objects.all():
+            self.client.post(reverse('topic_detail', kwargs={'id': topic.id}),
+                             {'message-body': 'Answer to %s' % (topic.title)})
+        self.assertEquals(MessageNotification.objects.count(), 2)
+
+        mail.outbox = []
+        call_command('notify_forum')
+
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].to, ['%s %s <%s>' % (self.user.first_name, self.user.last_name, self.user.email)])
+        self.assertEquals(mail.outbox[0].subject, u'De nouveaux messages ont \xe9t\xe9 post\xe9s en r\xe9ponse \xe0 2 sujets')
+        self.assertTrue('Answer to Topic 1' in mail.outbox[0].body)
+        self.assertTrue('Answer to Topic 2' in mail.outbox[0].body)
+        self.assertTrue(mail.outbox[0].body.index('Answer to Topic 1') < mail.outbox[0].body.index('Answer to Topic 2'))
+        self.assertEquals(MessageNotification.objects.count(), 0)
+
+    def testNotifyDigestGroupsMessagesByTopic(self):
+        self.client.post(reverse('topic_create'),
+                         {'topic-title': 'Topic 1',
+                          'message-body': 'New message body'})
+
+        self.client.logout()
+        self.client.login(username='test2', password='test')
+        topic = Topic.objects.all()[0]
+        self.client.post(reverse('topic_detail', kwargs={'id': topic.id}),
+                         {'message-body': 'First answer'})
+        # the view keeps one notification per topic, others may be
+        # pending since the previous run
+        message = Message.objects.create(topic=topic,
+                                         author=User.objects.get(username='test2'),
+                                         body='Second answer',
+                                         creation_date=datetime.datetime.now() + datetime.timedelta(seconds=1))
+        MessageNotification.objects.create(message=message)
+        self.assertEquals(MessageNotification.objects.count(), 2)
+
+        mail.outbox = []
+        call_command('notify_forum')
+
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].subject, u'De nouveaux messages ont \xe9t\xe9 post\xe9s en r\xe9ponse \xe0 "Topic 1"')
+        body = mail.outbox[0].body
+        self.assertTrue(body.index('First answer') < body.index('Second answer'))
+        self.assertEquals(body.count('Topic 1'), 0)
+        self.assertEquals(body.count('?page=-1#last'), 1)
@@ -3,41 +3,72 @@ from newsletter.models import Message, USER_TYPE_SUBSCRIPTION_PAID, \
     USER_TYPE_SUBSCRIPTION_TRIAL, USER_TYPE_SUBSCRIPTION_EXPIRED
 from autoentrepreneur.models import Subscription
 from django.conf import settings
-from django.core.mail import send_mass_mail
-from django.template import loader
-from django.contrib.sites.models import Site
-from django.template.context import Context
+from django.db import transaction
+from core.mail import enqueue_mass_mail, send_spooled_mail, render_signature, \
+    format_recipient
+
+# recipients read by one query
+RECIPIENT_CHUNK_SIZE = 1000
+
+def iter_recipients(recipients, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """
+    Yields recipients, read by chunks of chunk_size following their ids so
+    that they are never all in memory
+    """
+    last_id = 0
+    while True:
+        chunk = list(recipients.filter(id__gt=last_id).order_by('id').values('id',
+                                                                           'owner__email',
+                                                                           'owner__first_name',
+                                                                           'owner__last_name')[:chunk_size])
+        for recipient in chunk:
+            yield recipient
+        if len(chunk) < chunk_size:
+            break
+        last_id = chunk[-1]['id']
 
 class Command(BaseCommand):
     help = 'Send newsletter emails (not already sent)'
 
     def handle(self, *args, **options):
-        signature_template = loader.get_template('newsletter/signature.html')
-        signature_context = {'site': Site.objects.get_current()}
-        signature = signature_template.render(Context(signature_context))
+        signature = render_signature()
 
         for message in Message.objects.filter(sent=False):
-            message.sent = True
-            message.save()
-            recipients = []
-            if message.to == USER_TYPE_SUBSCRIPTION_PAID:
-                recipients = Subscription.objects.get_users_with_paid_subscription()
-            elif message.to == USER_TYPE_SUBSCRIPTION_TRIAL:
-                recipients = Subscription.objects.get_users_with_trial_subscription()
-            elif message.to == USER_TYPE_SUBSCRIPTION_EXPIRED:
-                recipients = Subscription.objects.get_users_with_expired_subscription()
-
-            messages = []
-            for recipient in recipients:
-                to = '%s %s <%s>' % (recipient['owner__first_name'],
-                                     recipient['owner__last_name'],
-                                     recipient['owner__email'])
-                messages.append((message.subject,
-                                 message.message + signature,
-                                 settings.DEFAULT_FROM_EMAIL,
-                                 [to]))
-            print "Sending \"%s\" to %s ..." % (message.subject, message.get_to_display())
-            send_mass_mail(messages, fail_silently=False)
-            print "Done"
+            print "Spooling \"%s\" to %s ..." % (message.subject, message.get_to_display())
+            count = self.spool_message(message, signature)
+            print "%d messages spooled" % (count)
         else:
             print "Nothing to send"
+
+        sent, retried, failed = send_spooled_mail()
+        print "%d messages sent, %d to retry, %d failed" % (sent, retried, failed)
+
+    @transaction.commit_on_success
+    def spool_message(self, message, signature):
+        """
+        Spools the message for its recipients, it is marked sent only
+        if every message is spooled. Delivery is counted from the
+        spooled mails referencing the message.
+        """
+        recipients = Subscription.objects.none()
+        if message.to == USER_TYPE_SUBSCRIPTION_PAID:
+            recipients = Subscription.objects.get_users_with_paid_subscription()
+        elif message.to == USER_TYPE_SUBSCRIPTION_TRIAL:
+            recipients = Subscription.objects.get_users_with_trial_subscription()
+        elif message.to == USER_TYPE_SUBSCRIPTION_EXPIRED:
+            recipients = Subscription.objects.get_users_with_expired_subscription()
+
+        def get_messages():
+            body = message.message + signature
+            for recipient in iter_recipients(recipients):
+                yield (message.subject,
+                       body,
+                       settings.DEFAULT_FROM_EMAIL,
+                       [format_recipient(recipient['owner__first_name'],
+                                         recipient['owner__last_name'],
+                                         recipient['owner__email'])])
+
+        count = enqueue_mass_mail(get_messages(), message.get_mail_reference())
+        message.sent = True
+        message.save()
+        return count
@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.sites.models import Site
 from django.utils.translation import ugettext_lazy as _
+from core.models import SpooledMail, MAIL_STATE_PENDING, MAIL_STATE_SENDING, \
+    MAIL_STATE_SENT, MAIL_STATE_FAILED
 
 USER_TYPE_SUBSCRIPTION_PAID = 1
 USER_TYPE_SUBSCRIPTION_TRIAL = 2
@@ -9,6 +11,21 @@ USER_TYPE = ((USER_TYPE_SUBSCRIPTION_PAID, _('Users who have paid subscription')
              (USER_TYPE_SUBSCRIPTION_TRIAL, _('Users still in trial')),
              (USER_TYPE_SUBSCRIPTION_EXPIRED, _('Users with subscription expired')))
 
+class MessageManager(models.Manager):
+    def get_with_delivery_counts(self):
+        """
+        Returns messages with the counts of their delivered, failed and
+        pending mails, counted by one query
+        """
+        messages = list(self.all())
+        counts = SpooledMail.objects.count_by_reference([message.get_mail_reference() for message in messages])
+        for message in messages:
+            message_counts = counts[message.get_mail_reference()]
+            message.delivered_count = message_counts.get(MAIL_STATE_SENT, 0)
+            message.failed_count = message_counts.get(MAIL_STATE_FAILED, 0)
+            message.pending_count = message_counts.get(MAIL_STATE_PENDING, 0) + message_counts.get(MAIL_STATE_SENDING, 0)
+        return messages
+
 class Message(models.Model):
     to = models.IntegerField(verbose_name=_('User type'), choices=USER_TYPE)
     subject = models.CharField(verbose_name=_('Subject'), max_length=100)
@@ -16,5 +33,13 @@ class Message(models.Model):
     update_datetime = models.DateTimeField(verbose_name=_('Update date'))
     sent = models.BooleanField(verbose_name=_('Sent'), default=False)
 
+    objects = MessageManager()
+
     class Meta:
         ordering = ['-update_datetime']
+
+    def get_mail_reference(self):
+        """
+        Reference of the spooled mails of this message
+        """
+        return 'newsletter:%i' % (self.id)
@@ -1 +1,56 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from autoentrepreneur.models import Subscription
+from core.models import SpooledMail, MAIL_STATE_SENT, MAIL_STATE_FAILED
+from newsletter.models import Message, USER_TYPE_SUBSCRIPTION_TRIAL
+from newsletter.management.commands.send_emails import iter_recipients
+import datetime
 
+class SendEmailsTest(TestCase):
+    def setUp(self):
+        for i in range(3):
+            User.objects.create_user('user%i' % (i), 'user%i@example.com' % (i), 'user%i' % (i))
+        self.message = Message.objects.create(to=USER_TYPE_SUBSCRIPTION_TRIAL,
+                                              subject='News',
+                                              message='Hello',
+                                              update_datetime=datetime.datetime.now())
+        self.recipients = Subscription.objects.get_users_with_trial_subscription()
+
+    def testRecipientsAreReadByChunks(self):
+        self.assertTrue(self.recipients.count() > 1)
+        self.assertEquals(sorted([recipient['owner__email'] for recipient in iter_recipients(self.recipients, 1)]),
+                          sorted([recipient['owner__email'] for recipient in self.recipients]))
+
+    def testDeliveriesAreCountedByMessage(self):
+        call_command('send_emails')
+
+        count = self.recipients.count()
+        self.assertEquals(len(mail.outbox), count)
+        self.assertTrue(Message.objects.get(pk=self.message.id).sent)
+        self.assertEquals(SpooledMail.objects.filter(reference=self.message.get_mail_reference(),
+                                                     state=MAIL_STATE_SENT).count(), count)
+
+        mail_id = SpooledMail.objects.filter(reference=self.message.get_mail_reference())[0].id
+        SpooledMail.objects.filter(pk=mail_id).update(state=MAIL_STATE_FAILED)
+        other = Message.objects.create(to=USER_TYPE_SUBSCRIPTION_TRIAL,
+                                       subject='Other news',
+                                       message='Hello again',
+                                       update_datetime=datetime.datetime.now())
+
+        messages = dict([(message.id, message) for message in Message.objects.get_with_delivery_counts()])
+        self.assertEquals((messages[self.message.id].delivered_count,
+                           messages[self.message.id].failed_count,
+                           messages[self.message.id].pending_count), (count - 1, 1, 0))
+        self.assertEquals((messages[other.id].delivered_count,
+                           messages[other.id].failed_count,
+                           messages[other.id].pending_count), (0, 0, 0))
+
+        User.objects.create_user('staff', 'staff@example.com', 'staff')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.client.login(username='staff', password='staff')
+        response = self.client.get(reverse('email_users'))
+        self.assertEquals(response.status_code, 200)
+        self.assertContains(response, '<td>%i</td>' % (count - 1))
@@ -12,7 +12,7 @@ import datetime
 @staff_member_required
 @commit_on_success
 def email_users(request, message_id=None):
-    message_list = Message.objects.all()
+    message_list = Message.objects.get_with_delivery_counts()
 
     message = None
     if message_id:
@@ -1,60 +1,56 @@
 from django.core.management.base import BaseCommand
 from accounts.models import Invoice
-from django.template import loader
-from django.contrib.sites.models import Site
-from django.template.context import Context
-from django.conf import settings
-from django.core.mail import send_mass_mail
+from core.mail import enqueue_mass_mail, send_spooled_mail, MailRenderer, \
+    format_recipient
+from itertools import groupby
+
+def group_by_owner(invoices):
+    """
+    Yields (owner, invoices) for invoices ordered by owner
+    """
+    for owner_id, owner_invoices in groupby(invoices, lambda invoice: invoice.owner_id):
+        owner_invoices = list(owner_invoices)
+        yield owner_invoices[0].owner, owner_invoices
+
+def get_users_to_notify():
+    """
+    Yields (user, late invoices, invoices to send) ordered by user, one
+    user in memory at a time. Both lists of invoices are read in one query
+    each, with their owner and customer.
+    """
+    late_invoices = Invoice.objects.get_late_invoices_for_notification()
+    invoices_to_send = Invoice.objects.get_invoices_to_send_for_notification()
+    late_groups = group_by_owner(late_invoices.select_related('owner', 'customer').order_by('owner', 'invoice_id').iterator())
+    to_send_groups = group_by_owner(invoices_to_send.select_related('owner', 'customer').order_by('owner', 'invoice_id').iterator())
+
+    late = next(late_groups, None)
+    to_send = next(to_send_groups, None)
+    while late or to_send:
+        if to_send is None or (late and late[0].id < to_send[0].id):
+            yield late[0], late[1], []
+            late = next(late_groups, None)
+        elif late is None or to_send[0].id < late[0].id:
+            yield to_send[0], [], to_send[1]
+            to_send = next(to_send_groups, None)
+        else:
+            yield late[0], late[1], to_send[1]
+            late = next(late_groups, None)
+            to_send = next(to_send_groups, None)
 
 class Command(BaseCommand):
     help = "Send emails to user to notify them regarding their settings"
 
     def handle(self, *args, **options):
-        users = {}
-        late_invoices = Invoice.objects.get_late_invoices_for_notification()
-        for invoice in late_invoices:
-            if invoice.owner.id not in users:
-                users[invoice.owner.id] = {'user': invoice.owner}
-            if 'late_invoices' not in users[invoice.owner.id]:
-                users[invoice.owner.id]['late_invoices'] = []
-
-            users[invoice.owner.id]['late_invoices'].append(invoice)
-
-        invoices_to_send = Invoice.objects.get_invoices_to_send_for_notification()
-        for invoice in invoices_to_send:
-            if invoice.owner.id not in users:
-                users[invoice.owner.id] = {'user': invoice.owner}
-            if 'invoices_to_send' not in users[invoice.owner.id]:
-                users[invoice.owner.id]['invoices_to_send'] = []
-
-            users[invoice.owner.id]['invoices_to_send'].append(invoice)
-
-        messages = []
-        signature_template = loader.get_template('newsletter/signature.html')
-        signature_context = {'site': Site.objects.get_current()}
-        signature = signature_template.render(Context(signature_context))
-
-        for user in users.values():
-            notification_email_subject_template = loader.get_template('notification/email_subject.html')
-            notification_email_subject_context = {}
-            subject = notification_email_subject_template.render(Context(notification_email_subject_context))
-
-            notification_email_template = loader.get_template('notification/email.html')
-            notification_email_context = {'site': Site.objects.get_current()}
-
-            if 'late_invoices' in user:
-                notification_email_context['late_invoices'] = user['late_invoices']
-            if 'invoices_to_send' in user:
-                notification_email_context['invoices_to_send'] = user['invoices_to_send']
-
-            body = notification_email_template.render(Context(notification_email_context))
-
-            to = '%s %s <%s>' % (user['user'].first_name,
-                                 user['user'].last_name,
-                                 user['user'].email)
-            messages.append((subject,
-                             body + signature,
-                             settings.DEFAULT_FROM_EMAIL,
-                             [to]))
-
-        send_mass_mail(messages, fail_silently=False)
+        renderer = MailRenderer('notification/email_subject.html', 'notification/email.html')
+
+        def get_recipients():
+            for user, late_invoices, invoices_to_send in get_users_to_notify():
+                yield ([format_recipient(user.first_name, user.last_name, user.email)],
+                       {'late_invoices': late_invoices,
+                        'invoices_to_send': invoices_to_send},
+                       None)
+
+        # spooled messages are kept until they are sent, messages are
+        # rendered while they are spooled
+        enqueue_mass_mail(renderer.render_mass_mail(get_recipients()))
+        send_spooled_mail()
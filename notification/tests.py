@@ -7,6 +7,9 @@ import datetime
 from accounts.models import Invoice, INVOICE_STATE_EDITED, INVOICE_STATE_SENT
 from django.core.management import call_command
 from django.core import mail
+from django.conf import settings
+from django.db import connection
+from django.contrib.sites.models import Site
 
 class NotificationTest(TestCase):
     fixtures = ['test_users', 'test_contacts', 'test_projects']
@@ -186,3 +189,42 @@ class NotificationTest(TestCase):
         self.assertEquals(mail.outbox[1].to, ['%s %s <%s>' % (user2.first_name, user2.last_name, user2.email)])
         body = u"Vous avez des factures en attente d'une action de votre part.\n\nLe paiement des factures suivantes est en retard. Soit vous avez re\xe7u le paiement et vous avez oubli\xe9 de les mettre \xe0 jour, soit vous devriez relancer vos clients :\n\n - Facture 2 \xe0 Contact 1 (date de paiement : %s)\n\n\nRendez vous sur votre tableau de bord pour voir et modifier ces factures : https://example.com/\n\nPour modifier vos param\xe8tres de notification : https://example.com/home/notifications/\n\nL'\xe9quipe example.com\n\nVous recevez cet email car vous \xeates inscrit(e) sur https://example.com. Si vous voulez quitter le site, veuillez cliquer sur le lien ci-dessous pour vous d\xe9sinscrire. Attention, si vous avez un abonnement, celui-ci sera perdu.\nhttps://example.com/home/unregister/" % (payment_date.strftime('%d/%m/%Y'))
         self.assertEquals(mail.outbox[1].body, body)
+
+    def notify_users_with_invoices(self, count):
+        for owner_id in [1, 2]:
+            for i in range(count):
+                Invoice.objects.create(customer_id=self.proposal1.project.customer_id,
+                                       invoice_id=owner_id * 1000 + i * 2,
+                                       state=INVOICE_STATE_EDITED,
+                                       amount='100',
+                                       edition_date=datetime.date.today() - datetime.timedelta(1),
+                                       payment_date=datetime.date.today() + datetime.timedelta(1),
+                                       paid_date=None,
+                                       owner_id=owner_id)
+                Invoice.objects.create(customer_id=self.proposal1.project.customer_id,
+                                       invoice_id=owner_id * 1000 + i * 2 + 1,
+                                       state=INVOICE_STATE_SENT,
+                                       amount='100',
+                                       edition_date=datetime.date.today() - datetime.timedelta(3),
+                                       payment_date=datetime.date.today() - datetime.timedelta(1),
+                                       paid_date=None,
+                                       owner_id=owner_id)
+        # the current site is cached after the first run
+        Site.objects.clear_cache()
+        settings.DEBUG = True
+        try:
+            query_count = len(connection.queries)
+            call_command('notify_users')
+            query_count = len(connection.queries) - query_count
+        finally:
+            settings.DEBUG = False
+        return query_count
+
+    def test_queries_do_not_depend_on_invoice_count(self):
+        query_count = self.notify_users_with_invoices(1)
+        self.assertEquals(len(mail.outbox), 2)
+        Invoice.objects.all().delete()
+        mail.outbox = []
+        self.assertEquals(self.notify_users_with_invoices(10), query_count)
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(mail.outbox[0].body.count(' - Facture '), 20)
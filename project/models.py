@@ -1,9 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import unicodedata
-from reportlab.platypus import Paragraph
-from reportlab.lib.units import inch
-from reportlab.platypus import Table, TableStyle, Spacer
 
 from decimal import Decimal
 from django.db import models
@@ -13,12 +10,9 @@ from core.models import OwnedObject
 from django.db.models.signals import post_save, pre_save
 from django.utils.formats import localize
 from django.db.models.aggregates import Sum
-from core.templatetags.htmltags import to_html
 from django.conf import settings
-import ho.pisa as pisa
 from django.core.files.storage import FileSystemStorage
 from django.db.models.query_utils import Q
-from project.utils.pdf import ProposalTemplate
 
 store = FileSystemStorage(location=settings.FILE_UPLOAD_DIR)
 
@@ -58,9 +52,6 @@ class Contract(OwnedObject):
         return substitution_map
 
     def to_pdf(self, user, response):
-        css_file = open("%s%s" % (settings.MEDIA_ROOT, "/css/pisa.css"), 'r')
-        css = css_file.read()
-
         substitution_map = Contract.get_substitution_map()
 
         substitution_map[ugettext('customer')] = unicode(self.customer)
@@ -82,13 +73,8 @@ class Contract(OwnedObject):
 
         contract_content = "<h1>%s</h1>%s" % (self.title, self.content.replace('&nbsp;', ' '))
 
-        for tag, value in substitution_map.items():
-            contract_content = contract_content.replace('{{ %s }}' % (tag), value)
-
-        pdf = pisa.pisaDocument(to_html(contract_content),
-                                response,
-                                default_css=css)
-        return response
+        from project.utils.contract import contract_to_pdf
+        return contract_to_pdf(contract_content, substitution_map, response)
 
 PROJECT_STATE_PROSPECT = 1
 PROJECT_STATE_PROPOSAL_SENT = 2
@@ -261,43 +247,8 @@ class Proposal(OwnedObject):
         """
         Generate a PDF file for the proposal
         """
-        filename = ugettext('proposal_%(id)d.pdf') % {'id': self.id}
-        response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
-
-        proposal_template = ProposalTemplate(response, user)
-
-        proposal_template.init_doc(ugettext('Proposal %(reference)s') % {'reference': self.reference})
-        proposal_template.add_headers(self, self.project.customer, self.update_date)
-        proposal_template.add_title(_("PROPOSAL %s") % (self.reference))
-
-        # proposal row list
-        rows = self.proposal_rows.all()
-        proposal_template.add_rows(rows)
-
-        # total amount on the right side of footer
-        right_block = proposal_template.get_total_amount(self.amount, rows)
-
-        # left side of footer
-        data = [[[Paragraph(_("Proposal valid through : %s") % (localize(self.expiration_date) or ''), ProposalTemplate.styleN),
-                  Paragraph(_("Payment delay : %s") % (self.get_payment_delay()), ProposalTemplate.styleN)],
-                '',
-                right_block], ]
-
-        if self.begin_date and self.end_date:
-            data[0][0].append(Paragraph(_("Execution dates : %(begin_date)s to %(end_date)s") % {'begin_date': localize(self.begin_date), 'end_date' : localize(self.end_date)}, ProposalTemplate.styleN))
-
-        if self.footer_note:
-            data[0][0].append(Spacer(proposal_template.doc.width, 0.1 * inch))
-            data[0][0].append(Paragraph(self.footer_note, ProposalTemplate.styleNSmall))
-
-        footer_table = Table(data, [4.5 * inch, 0.3 * inch, 2.5 * inch], [1 * inch])
-        footer_table.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ]))
-
-        proposal_template.append_to_story(footer_table)
-
-        proposal_template.build()
-
-        return response
+        from project.utils.pdf import proposal_to_pdf
+        return proposal_to_pdf(self, user, response)
 
     @staticmethod
     def get_substitution_map():
@@ -324,9 +275,6 @@ class Proposal(OwnedObject):
         return substitution_map
 
     def contract_to_pdf(self, user, response):
-        css_file = open("%s%s" % (settings.MEDIA_ROOT, "/css/pisa.css"), 'r')
-        css = css_file.read()
-
         substitution_map = Proposal.get_substitution_map()
 
         substitution_map[ugettext('reference')] = unicode(self.reference)
@@ -350,13 +298,8 @@ class Proposal(OwnedObject):
 
         contract_content = self.contract_content.replace('&nbsp;', ' ')
 
-        for tag, value in substitution_map.items():
-            contract_content = contract_content.replace('{{ %s }}' % (tag), value)
-
-        pdf = pisa.pisaDocument(to_html(contract_content),
-                                response,
-                                default_css=css)
-        return response
+        from project.utils.contract import contract_to_pdf
+        return contract_to_pdf(contract_content, substitution_map, response)
 
 def update_project_state(sender, instance, created, **kwargs):
     proposal = instance
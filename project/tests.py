@@ -19,6 +19,15 @@ from django.contrib.auth.models import User
 from django.contrib.webdesign import lorem_ipsum
 from autoentrepreneur.models import AUTOENTREPRENEUR_REGISTER_RSEIRL
 from django.utils import simplejson
+from project.utils.cache import LRUCache
+from project.utils import pdf
+from project.utils.pdf import ProposalTemplate
+from project.utils import logo
+from project.utils import contract
+from django.conf import settings
+from PIL import Image
+import os
+import shutil
 
 class ContractPermissionTest(TestCase):
     fixtures = ['test_users', 'test_contacts']
@@ -1652,3 +1661,90 @@ class CatalogTest(TestCase):
         self.assertEquals(items.count(), 2)
         self.assertEquals(items.filter(section=section2).count(), 2)
 
+
+class LineCacheTest(TestCase):
+    fixtures = ['test_users']
+
+    def setUp(self):
+        pdf.line_cache.clear()
+
+    def testLRUCacheEviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+
+    def testLRUCacheDisabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get('a'), None)
+
+    def testBreakLinesIsCached(self):
+        template = ProposalTemplate(None, User.objects.get(username='test'))
+        label = lorem_ipsum.words(40)
+        lines = template.break_lines(label, ProposalTemplate.styleLabel, 200)
+        self.assertTrue(len(lines) > 1)
+        self.assertEquals(" ".join(lines), label)
+        self.assertEquals(pdf.line_cache.misses, 1)
+        self.assertEquals(template.break_lines(label, ProposalTemplate.styleLabel, 200), lines)
+        self.assertEquals(pdf.line_cache.hits, 1)
+        # another width is another entry
+        template.break_lines(label, ProposalTemplate.styleLabel, 300)
+        self.assertEquals(pdf.line_cache.misses, 2)
+
+class PreparedLogoTest(TestCase):
+    fixtures = ['test_users']
+
+    def setUp(self):
+        self.profile = User.objects.get(username='test').get_profile()
+        logo_dir = '%s%s/logo' % (settings.FILE_UPLOAD_DIR, self.profile.uuid)
+        if not os.path.exists(logo_dir):
+            os.makedirs(logo_dir)
+        Image.new('RGBA', (600, 300), (255, 0, 0, 128)).save('%s/big_logo.png' % (logo_dir))
+        self.profile.logo_file = '%s/logo/big_logo.png' % (self.profile.uuid)
+        self.profile.save()
+
+    def tearDown(self):
+        shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR, self.profile.uuid), True)
+
+    def testLogoIsScaledToHeaderBox(self):
+        logo.prepare_logo(self.profile)
+        prepared = Image.open(logo.get_prepared_logo_path(self.profile))
+        self.assertEquals(prepared.format, 'JPEG')
+        self.assertEquals(prepared.size, (252, 126))
+
+    def testLogoIsPreparedOnFirstRendering(self):
+        self.assertFalse(os.path.exists(logo.get_prepared_logo_path(self.profile)))
+        logo.logo_cache.clear()
+        path = logo.get_prepared_logo(self.profile)
+        self.assertEquals(path, logo.get_prepared_logo_path(self.profile))
+        self.assertTrue(os.path.exists(path))
+        self.assertEquals(logo.get_prepared_logo(self.profile), path)
+        self.assertEquals(logo.logo_cache.hits, 1)
+
+class ContractTemplateTest(TestCase):
+
+    def setUp(self):
+        contract.template_cache.clear()
+
+    def testSinglePassSubstitution(self):
+        substitution_map = {'customer': 'Bross & Clackwell',
+                            'customer_city': '{{ city }}',
+                            'city': 'Paris'}
+        html = contract.render_contract('<p>{{ customer }}, {{ customer_city }}</p>{{ unknown }}', substitution_map)
+        # values are escaped and not substituted again
+        self.assertEquals(html, u'<p>Bross &amp; Clackwell, {{ city }}</p>{{ unknown }}')
+
+    def testTemplateIsCached(self):
+        substitution_map = {'city': 'Paris'}
+        self.assertEquals(contract.render_contract('{{ city }}', substitution_map), u'Paris')
+        substitution_map['city'] = 'Lyon'
+        self.assertEquals(contract.render_contract('{{ city }}', substitution_map), u'Lyon')
+        self.assertEquals(contract.template_cache.misses, 1)
+        self.assertEquals(contract.template_cache.hits, 1)
@@ -0,0 +1,76 @@
+import threading
+
+class LRUCache(object):
+    """
+    Bounded in-process cache discarding least recently used entries
+    when max_size is reached. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map = {}
+            # circular doubly linked list of [previous, next, key, value]
+            # the oldest entry follows root, the newest precedes it
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._move_to_end(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self.map.get(key)
+            if link is not None:
+                link[3] = value
+                self._move_to_end(link)
+                return
+            while len(self.map) >= self.max_size:
+                oldest = self.root[1]
+                self.root[1] = oldest[1]
+                oldest[1][0] = self.root
+                del self.map[oldest[2]]
+            last = self.root[0]
+            link = [last, self.root, key, value]
+            last[1] = link
+            self.root[0] = link
+            self.map[key] = link
+        finally:
+            self.lock.release()
+
+    def _move_to_end(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        last = self.root[0]
+        last[1] = link
+        link[0] = last
+        link[1] = self.root
+        self.root[0] = link
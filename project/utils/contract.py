@@ -0,0 +1,73 @@
+import re
+import hashlib
+import ho.pisa as pisa
+from django.conf import settings
+from django.utils.encoding import smart_str
+from core.templatetags.htmltags import to_html
+from project.utils.cache import LRUCache
+
+TEMPLATE_CACHE_SIZE = 128
+
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+_pisa_css = None
+
+def get_pisa_css():
+    """
+    Returns the stylesheet given to pisa for contracts, read once per process
+    """
+    global _pisa_css
+    if _pisa_css is None:
+        css_file = open("%s%s" % (settings.MEDIA_ROOT, "/css/pisa.css"), 'r')
+        try:
+            _pisa_css = css_file.read()
+        finally:
+            css_file.close()
+    return _pisa_css
+
+class ContractTemplate(object):
+    """
+    Contract content split on its {{ tag }} placeholders. Text between
+    placeholders is converted to html once, rendering only has to convert
+    and join substituted values.
+    """
+
+    def __init__(self, content, tags):
+        # longest tags first so a tag never shadows another starting like it
+        tags = sorted(tags, key=len, reverse=True)
+        pattern = re.compile('{{ (%s) }}' % ('|'.join([re.escape(tag) for tag in tags])))
+        # even indexes are text, odd indexes are tags
+        self.parts = pattern.split(content)
+        for i in range(0, len(self.parts), 2):
+            self.parts[i] = unicode(to_html(self.parts[i]))
+
+    def render(self, substitution_map):
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = unicode(to_html(substitution_map[parts[i]]))
+        return u''.join(parts)
+
+def get_contract_template(content, tags):
+    """
+    Returns the compiled template of content, cached by content hash.
+    Tags are part of the key since they are translated.
+    """
+    tags = tuple(sorted(tags))
+    key = (hashlib.md5(smart_str(content)).hexdigest(), tags)
+    template = template_cache.get(key)
+    if template is None:
+        template = ContractTemplate(content, tags)
+        template_cache.set(key, template)
+    return template
+
+def render_contract(content, substitution_map):
+    """
+    Returns content as html with {{ tag }} placeholders replaced in one pass
+    """
+    return get_contract_template(content, substitution_map.keys()).render(substitution_map)
+
+def contract_to_pdf(content, substitution_map, response):
+    pisa.pisaDocument(render_contract(content, substitution_map),
+                      response,
+                      default_css=get_pisa_css())
+    return response
@@ -0,0 +1,70 @@
+import os
+import errno
+from PIL import Image
+from django.conf import settings
+from project.utils.cache import LRUCache
+
+# box of the user header on proposals and invoices, in pixels at 72 dpi
+HEADER_LOGO_SIZE = (252, 137)
+HEADER_LOGO_BACKGROUND = (255, 255, 255)
+
+logo_cache = LRUCache(256)
+
+def get_logo_path(profile):
+    return '%s%s' % (settings.FILE_UPLOAD_DIR, profile.logo_file)
+
+def get_prepared_logo_path(profile):
+    return '%s%s/cache/logo.jpg' % (settings.FILE_UPLOAD_DIR, profile.uuid)
+
+def prepare_logo(profile):
+    """
+    Store a copy of the uploaded logo fitting the header box as jpeg,
+    which reportlab embeds without decoding it
+    """
+    target = get_prepared_logo_path(profile)
+    try:
+        os.makedirs(os.path.dirname(target))
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    image = Image.open(get_logo_path(profile))
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # jpeg has no alpha channel, flatten on page color
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, HEADER_LOGO_BACKGROUND)
+        background.paste(image, mask=image.split()[3])
+        image = background
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail(HEADER_LOGO_SIZE, Image.ANTIALIAS)
+
+    # write then rename so concurrent renderings never read a partial file
+    image.save('%s.tmp' % (target), 'JPEG', quality=90, optimize=True)
+    os.rename('%s.tmp' % (target), target)
+    return target
+
+def delete_prepared_logo(profile):
+    target = get_prepared_logo_path(profile)
+    if os.path.exists(target):
+        os.remove(target)
+
+def get_prepared_logo(profile):
+    """
+    Returns the path of the prepared logo. It is prepared if missing or
+    older than the uploaded one (logos uploaded before preparation existed,
+    restored backups). Up to date logos are remembered in process so
+    renderings don't check the prepared file again.
+    Reportlab is given the path rather than the content: jpeg files are
+    embedded as is while in memory images are decoded to be identified.
+    """
+    source = get_logo_path(profile)
+    key = (source, os.path.getmtime(source))
+    target = logo_cache.get(key)
+    if target is None:
+        target = get_prepared_logo_path(profile)
+        if not os.path.exists(target) or os.path.getmtime(target) < key[1]:
+            prepare_logo(profile)
+        logo_cache.set(key, target)
+
+    return target
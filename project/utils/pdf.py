@@ -2,7 +2,6 @@
 
 from decimal import Decimal
 from reportlab.platypus import Table, TableStyle, Image, Paragraph
-from django.conf import settings
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.platypus.flowables import Spacer
@@ -16,6 +15,13 @@ from reportlab.lib.enums import TA_CENTER
 from custom_canvas import NumberedCanvas
 from django.template.defaultfilters import force_escape
 from reportlab.platypus.paragraph import FragLine, ParaLines
+from project.utils.cache import LRUCache
+from project.utils.logo import get_prepared_logo
+
+# rows share a lot of labels (catalog items, recurring invoices)
+# so line breaking results are kept between documents
+LINE_CACHE_SIZE = 4096
+line_cache = LRUCache(LINE_CACHE_SIZE)
 
 class ProposalTemplate(object):
 
@@ -132,7 +138,7 @@ class ProposalTemplate(object):
         """
 
         if self.user.get_profile().logo_file:
-            user_header = Image("%s%s" % (settings.FILE_UPLOAD_DIR, self.user.get_profile().logo_file))
+            user_header = Image(get_prepared_logo(self.user.get_profile()))
         else:
             user_header = Paragraph(user_header_content, self.styleH)
 
@@ -186,11 +192,7 @@ class ProposalTemplate(object):
         extra_rows = 0
         if row.detail:
             for line in row.detail.split("\n"):
-                para = Paragraph(force_escape(line), self.styleDetail)
-                para.width = label_width
-                splitted_para = para.breakLines(label_width)
-                for detail_row in splitted_para.lines:
-                    detail = self.get_splitted_content(detail_row)
+                for detail in self.break_lines(line, self.styleDetail, label_width):
                     data.append((detail,))
                     extra_rows += 1
         return extra_rows
@@ -246,6 +248,21 @@ class ProposalTemplate(object):
             label = " ".join(splitted[1])
         return label
 
+    def break_lines(self, text, style, width):
+        """
+        Returns the lines of text once wrapped to width.
+        Results are cached by (text, style, width)
+        """
+        key = (text, style, width)
+        lines = line_cache.get(key)
+        if lines is None:
+            para = Paragraph(force_escape(text), style)
+            para.width = width
+            splitted_para = para.breakLines(width)
+            lines = tuple([self.get_splitted_content(line) for line in splitted_para.lines])
+            line_cache.set(key, lines)
+        return lines
+
     def add_rows(self, rows):
         row_count = 0
         extra_rows = 0
@@ -261,10 +278,8 @@ class ProposalTemplate(object):
             row_count += 1
             label = self.get_label(row)
             #label = label.replace('&', '[et]')
-            para = Paragraph(force_escape(label), ProposalTemplate.styleLabel)
-            para.width = label_width
-            splitted_para = para.breakLines(label_width)
-            label = self.get_splitted_content(splitted_para.lines[0])
+            label_lines = self.break_lines(label, ProposalTemplate.styleLabel, label_width)
+            label = label_lines[0]
             quantity = row.quantity
             quantity = quantity.quantize(Decimal(1)) if quantity == quantity.to_integral() else quantity.normalize()
             unit_price = row.unit_price
@@ -279,8 +294,7 @@ class ProposalTemplate(object):
                     data_row.append('-')
             data.append(data_row)
 
-            for extra_row in splitted_para.lines[1:]:
-                label = self.get_splitted_content(extra_row)
+            for label in label_lines[1:]:
                 if self.user.get_profile().vat_number:
                     data.append([label, '', '', '', ''])
                 else:
@@ -335,3 +349,45 @@ class ProposalTemplate(object):
                             Paragraph(u"TVA non applicable, art. 293 B du CGI", ProposalTemplate.styleN)]
 
         return total_amount
+
+def proposal_to_pdf(proposal, user, response):
+    """
+    Generate a PDF file for the proposal
+    """
+    filename = ugettext('proposal_%(id)d.pdf') % {'id': proposal.id}
+    response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
+
+    proposal_template = ProposalTemplate(response, user)
+
+    proposal_template.init_doc(ugettext('Proposal %(reference)s') % {'reference': proposal.reference})
+    proposal_template.add_headers(proposal, proposal.project.customer, proposal.update_date)
+    proposal_template.add_title(_("PROPOSAL %s") % (proposal.reference))
+
+    # proposal row list
+    rows = proposal.proposal_rows.all()
+    proposal_template.add_rows(rows)
+
+    # total amount on the right side of footer
+    right_block = proposal_template.get_total_amount(proposal.amount, rows)
+
+    # left side of footer
+    data = [[[Paragraph(_("Proposal valid through : %s") % (localize(proposal.expiration_date) or ''), ProposalTemplate.styleN),
+              Paragraph(_("Payment delay : %s") % (proposal.get_payment_delay()), ProposalTemplate.styleN)],
+            '',
+            right_block], ]
+
+    if proposal.begin_date and proposal.end_date:
+        data[0][0].append(Paragraph(_("Execution dates : %(begin_date)s to %(end_date)s") % {'begin_date': localize(proposal.begin_date), 'end_date' : localize(proposal.end_date)}, ProposalTemplate.styleN))
+
+    if proposal.footer_note:
+        data[0][0].append(Spacer(proposal_template.doc.width, 0.1 * inch))
+        data[0][0].append(Paragraph(proposal.footer_note, ProposalTemplate.styleNSmall))
+
+    footer_table = Table(data, [4.5 * inch, 0.3 * inch, 2.5 * inch], [1 * inch])
+    footer_table.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ]))
+
+    proposal_template.append_to_story(footer_table)
+
+    proposal_template.build()
+
+    return response
@@ -704,7 +704,8 @@ def catalog_section_delete(request):
         if form.is_valid():
             section = get_object_or_404(CatalogSection, pk=id, owner=request.user)
             new_section = form.cleaned_data.get('section')
-            CatalogItem.objects.filter(section=section).update(section=new_section)
+            CatalogItem.objects.filter(section=section).update(section=new_section,
+                                                               modification_datetime=datetime.datetime.now())
             section.delete()
             response['error'] = 'ok'
             response['id'] = new_section.id